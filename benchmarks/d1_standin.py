@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+A local stand-in for the DataONE coordinating node serving a synthetic
+catalog, so that the harvester can be exercised and measured offline.
+
+Only what the plugin uses is implemented:
+
+* ``GET /cn/v2/query/solr/`` with the ``q``, ``fl``, ``rows``, ``start`` and
+  ``sort`` parameters. Queries may combine ``field:"value"``,
+  ``field:("a" OR "b")`` and ``field:value`` terms with ``AND``/``OR``.
+* ``GET /cn/v2/resolve/<pid>``, returning OAI-ORE RDF/XML for resource maps
+  and a payload of the advertised size for any other object.
+* ``GET /cn/v2/node``, listing a single member node, ``urn:node:STANDIN``,
+  which holds every object and serves them from ``/mn/v2/object/<pid>``.
+
+Latency and failures (``503`` responses) can be injected. Run on its own to
+serve a catalog, e.g.:
+
+  python benchmarks/d1_standin.py --port 8765 --shape nested:2x3x10 \
+      --latency 0.05 --failure-rate 0.01
+
+then point the plugin at ``http://127.0.0.1:8765/cn/v2``.
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from xml.sax.saxutils import escape, quoteattr
+
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import parse_qsl, quote, unquote, urlsplit
+
+
+ORE_FORMAT = 'http://www.openarchives.org/ore/terms'
+NODE_ID = 'urn:node:STANDIN'
+NODE_LIST = '''<?xml version="1.0" encoding="UTF-8"?>
+<ns2:nodeList xmlns:ns2="http://ns.dataone.org/service/types/v2.0">
+<node replicate="false" synchronize="false" type="mn" state="up">
+<identifier>{}</identifier>
+<name>Stand-in member node</name>
+<baseURL>http://{{}}/mn</baseURL>
+<services><service name="MNRead" version="v2" available="true"/></services>
+</node>
+</ns2:nodeList>'''.format(NODE_ID)
+EML_FORMAT = 'eml://ecoinformatics.org/eml-2.1.1'
+DATE_MODIFIED = '2017-06-01T00:00:00Z'
+_TERM = re.compile(r'(\w+):("(?:[^"\\]|\\.)*"|\([^)]*\)|\S+)|(AND|OR)')
+
+
+def make_resource_map(pid, metadata, members, base, padding=0):
+    """
+    Build an RDF/XML resource map aggregating ``metadata`` and ``members``,
+    with every member but the child resource maps documented by ``metadata``.
+
+    :param members: A list of ``(pid, documented)`` tuples.
+    :param base: The resolve URL prefix of the identifiers.
+    :param padding: Number of extra descriptive triples per member, to make
+        maps with large triple counts.
+    """
+    def uri(value, fragment=''):
+        return quoteattr(base + quote(value, safe=':') + fragment)
+
+    lines = [
+        '<?xml version="1.0" encoding="utf-8"?>',
+        '<rdf:RDF xmlns:cito="http://purl.org/spar/cito/" '
+        'xmlns:dc="http://purl.org/dc/elements/1.1/" '
+        'xmlns:dcterms="http://purl.org/dc/terms/" '
+        'xmlns:ore="http://www.openarchives.org/ore/terms/" '
+        'xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">',
+        '<rdf:Description rdf:about={}>'.format(uri(pid)),
+        '<ore:describes rdf:resource={}/>'.format(uri(pid, '#aggregation')),
+        '<dcterms:identifier>{}</dcterms:identifier>'.format(escape(pid)),
+        '</rdf:Description>'
+    ]
+    for member, documented in [(metadata, False)] + list(members):
+        lines += [
+            '<rdf:Description rdf:about={}>'.format(uri(pid, '#aggregation')),
+            '<ore:aggregates rdf:resource={}/>'.format(uri(member)),
+            '</rdf:Description>',
+            '<rdf:Description rdf:about={}>'.format(uri(member)),
+            '<dcterms:identifier>{}</dcterms:identifier>'.format(escape(member))
+        ]
+        if documented:
+            lines.append('<cito:isDocumentedBy rdf:resource={}/>'.format(
+                uri(metadata)))
+        lines += ['<dc:description>Triple {} of {}</dc:description>'.format(
+            i, escape(member)) for i in range(padding)]
+        lines.append('</rdf:Description>')
+    lines.append('</rdf:RDF>')
+    return '\n'.join(lines).encode('utf8')
+
+
+class Catalog(object):
+    """Solr documents and resource maps of synthetic DataONE packages."""
+
+    def __init__(self, file_size=1024):
+        self.file_size = file_size
+        self.docs = {}
+        self.maps = {}
+        self._count = 0
+
+    def _add(self, doc):
+        doc.setdefault('dateModified', DATE_MODIFIED)
+        doc.setdefault('checksum', hashlib.md5(
+            doc['identifier'].encode('utf8')).hexdigest())
+        doc['id'] = doc['identifier']
+        if doc['formatType'] != 'RESOURCE':
+            doc['datasource'] = NODE_ID
+        self.docs[doc['identifier']] = doc
+        return doc
+
+    def add_package(self, files, parent=None, padding=0):
+        """
+        Add a package with ``files`` data objects, nested in the package
+        ``parent`` if given.
+
+        :returns: The PID of the resource map of the new package.
+        """
+        self._count += 1
+        name = 'pkg-{}'.format(self._count)
+        pid = 'resource_map_urn:uuid:{}'.format(name)
+        metadata = 'urn:uuid:{}-metadata'.format(name)
+        data = ['urn:uuid:{}-data-{}'.format(name, i) for i in range(files)]
+        self._add({'identifier': pid, 'formatType': 'RESOURCE',
+                   'formatId': ORE_FORMAT,
+                   'resourceMap': [parent] if parent else []})
+        self._add({'identifier': metadata, 'formatType': 'METADATA',
+                   'formatId': EML_FORMAT, 'size': self.file_size,
+                   'title': 'Synthetic package {}'.format(name),
+                   'documents': [metadata] + data, 'resourceMap': [pid]})
+        for i, identifier in enumerate(data):
+            self._add({'identifier': identifier, 'formatType': 'DATA',
+                       'formatId': 'text/csv', 'size': self.file_size,
+                       'fileName': '{}-{}.csv'.format(name, i),
+                       'resourceMap': [pid]})
+        self.maps[pid] = {'metadata': metadata, 'data': data, 'children': [],
+                          'padding': padding}
+        if parent:
+            self.maps[parent]['children'].append(pid)
+        return pid
+
+    def add_nested(self, depth, breadth, files, parent=None):
+        """Add a package whose children are nested ``depth`` levels deep,
+        with ``breadth`` children per package."""
+        pid = self.add_package(files, parent=parent)
+        if depth > 0:
+            for _ in range(breadth):
+                self.add_nested(depth - 1, breadth, files, parent=pid)
+        return pid
+
+    def add_shape(self, shape):
+        """
+        Add packages described by a shape string:
+
+        * ``flat:N``: a package of N files
+        * ``nested:DxBxN``: D levels of B child packages of N files each
+        * ``large:N[xP]``: a package of N files whose resource map has P
+          extra triples per member (10 by default)
+        """
+        kind, _, spec = shape.partition(':')
+        values = [int(value) for value in spec.split('x')]
+        if kind == 'flat':
+            return self.add_package(values[0])
+        elif kind == 'nested':
+            return self.add_nested(*values)
+        elif kind == 'large':
+            return self.add_package(
+                values[0], padding=values[1] if len(values) > 1 else 10)
+        raise ValueError('Unknown package shape {}'.format(shape))
+
+    def descendants(self, pid):
+        """Count the packages and files of a package hierarchy."""
+        packages, files = 1, len(self.maps[pid]['data'])
+        for child in self.maps[pid]['children']:
+            childPackages, childFiles = self.descendants(child)
+            packages += childPackages
+            files += childFiles
+        return packages, files
+
+    def resource_map(self, pid, base):
+        package = self.maps[pid]
+        members = [(member, True) for member in package['data']] + \
+            [(child, False) for child in package['children']]
+        return make_resource_map(pid, package['metadata'], members, base,
+                                 padding=package['padding'])
+
+    def search(self, q):
+        """Return the documents matching a (limited) Solr query."""
+        disjunction = [[]]
+        for field, value, operator in _TERM.findall(q):
+            if operator == 'OR':
+                disjunction.append([])
+            elif field:
+                if value.startswith('('):
+                    values = re.findall(r'"((?:[^"\\]|\\.)*)"', value)
+                else:
+                    values = [value.strip('"')]
+                disjunction[-1].append((field, set(values)))
+        return [doc for doc in self.docs.values()
+                if any(all(_matches(doc, field, values)
+                           for field, values in conjunction)
+                       for conjunction in disjunction if conjunction)]
+
+
+def _matches(doc, field, values):
+    value = doc.get(field)
+    if isinstance(value, list):
+        return bool(values.intersection(value))
+    return value in values
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, contentType, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        if parts.path.startswith('/cn/v2/query/solr'):
+            endpoint = 'solr'
+        elif parts.path.startswith('/cn/v2/resolve/'):
+            endpoint = 'resolve'
+        elif parts.path == '/cn/v2/node':
+            endpoint = 'node'
+        elif parts.path.startswith('/mn/v2/object/'):
+            endpoint = 'object'
+        else:
+            endpoint = 'other'
+        if not self.server.admit(endpoint):
+            self._send(503, b'Service Unavailable', 'text/plain',
+                       {'Retry-After': '0'})
+        elif endpoint == 'solr':
+            self._solr(dict(parse_qsl(parts.query, keep_blank_values=True)))
+        elif endpoint == 'resolve':
+            self._resolve(unquote(parts.path[len('/cn/v2/resolve/'):]))
+        elif endpoint == 'node':
+            self._send(200, NODE_LIST.format(self.headers['Host']).encode(
+                'utf8'), 'text/xml')
+        elif endpoint == 'object':
+            self._resolve(unquote(parts.path[len('/mn/v2/object/'):]))
+        else:
+            self._send(404, b'Not Found', 'text/plain')
+
+    def _solr(self, params):
+        docs = self.server.catalog.search(params.get('q', ''))
+        docs.sort(key=lambda doc: doc['id'],
+                  reverse=params.get('sort', '').endswith('desc'))
+        start = int(params.get('start', 0))
+        rows = int(params.get('rows', 10))
+        fields = params.get('fl', '*').split(',')
+        body = json.dumps({
+            'responseHeader': {'status': 0, 'QTime': 0, 'params': params},
+            'response': {
+                'numFound': len(docs), 'start': start,
+                'docs': [{key: value for key, value in doc.items()
+                          if '*' in fields or key in fields}
+                         for doc in docs[start:start + rows]]
+            }
+        })
+        self._send(200, body.encode('utf8'), 'application/json')
+
+    def _resolve(self, pid):
+        catalog = self.server.catalog
+        if pid in catalog.maps:
+            base = 'http://{}/cn/v2/resolve/'.format(self.headers['Host'])
+            self._send(200, catalog.resource_map(pid, base),
+                       'application/rdf+xml')
+        elif pid in catalog.docs:
+            self._send(200, b'0' * int(catalog.docs[pid].get('size', 0)),
+                       'application/octet-stream')
+        else:
+            self._send(404, b'Not Found', 'text/plain')
+
+
+class StandInServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Serve a :class:`Catalog`, delaying every response by ``latency`` seconds
+    (plus up to ``jitter`` seconds) and failing a ``failure_rate`` fraction of
+    them with a 503.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, catalog, host='127.0.0.1', port=0, latency=0.0,
+                 jitter=0.0, failure_rate=0.0, seed=0):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), StandInHandler)
+        self.catalog = catalog
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.counts = {}
+
+    @property
+    def url(self):
+        return 'http://{}:{}/cn/v2'.format(*self.server_address[:2])
+
+    def admit(self, endpoint):
+        """Count and delay a request, and decide whether it fails."""
+        with self._lock:
+            self.counts[endpoint] = self.counts.get(endpoint, 0) + 1
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            failed = self._random.random() < self.failure_rate
+        if delay:
+            time.sleep(delay)
+        if failed:
+            with self._lock:
+                self.counts['failed'] = self.counts.get('failed', 0) + 1
+        return not failed
+
+    def reset_counts(self):
+        with self._lock:
+            self.counts = {}
+
+    def start(self):
+        """Serve from a daemon thread, returns the base URL."""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self.url
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--shape', action='append', default=[],
+                        help='flat:N, nested:DxBxN or large:N[xP]')
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    catalog = Catalog()
+    for shape in args.shape or ['flat:10']:
+        pid = catalog.add_shape(shape)
+        print('{}: {} ({} packages, {} files)'.format(
+            shape, pid, *catalog.descendants(pid)))
+    server = StandInServer(catalog, host=args.host, port=args.port,
+                           latency=args.latency, jitter=args.jitter,
+                           failure_rate=args.failure_rate)
+    print('Serving on {}'.format(server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measure the throughput and memory use of DataONE package registration and
+lookup against a local stand-in server (see d1_standin.py).
+
+Girder and this plugin must be installed and the database must be reachable.
+Everything is written to a scratch user and folder, so use a scratch
+database, e.g.:
+
+  GIRDER_MONGO_URI=mongodb://localhost:27017/wt_benchmark \
+      python benchmarks/registration.py --shape flat:100 --shape nested:2x4x25 \
+      --shape large:5000 --latency 0.02 --repeat 3
+
+The shared Solr cache is disabled while the benchmarks run, and the
+in-process resource map cache is cleared before every run, so every run
+issues all of its upstream requests.
+"""
+
+import argparse
+import json
+import time
+import tracemalloc
+import uuid
+
+from girder.utility.model_importer import ModelImporter
+from girder.utility.progress import noProgress
+from girder.plugins.wholetale import dataone_register
+from girder.plugins.wholetale.constants import PluginSettings
+from girder.plugins.wholetale.rest import harvester
+
+from d1_standin import Catalog, StandInServer
+
+
+def measure(func, memory=True):
+    """Run ``func``, returns its result (or exception), duration and peak
+    memory in bytes (None if not traced)."""
+    if memory:
+        tracemalloc.start()
+    start = time.time()
+    try:
+        result = func()
+    except Exception as exc:
+        result = exc
+    elapsed = time.time() - start
+    peak = None
+    if memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def point_plugin_at(url):
+    """Send every DataONE call of the plugin to ``url`` instead of the CN."""
+    dataone_register.D1_BASE = url
+    harvester.D1_BASE = url
+    dataone_register._member_nodes.clear()
+
+
+def benchmark_user():
+    userModel = ModelImporter.model('user')
+    user = userModel.findOne({'login': 'wtbenchmark'})
+    if user is None:
+        user = userModel.createUser(
+            login='wtbenchmark', password='wtbenchmark', firstName='WT',
+            lastName='Benchmark', email='wtbenchmark@localhost')
+    return user
+
+
+def run_register(server, user, pid, packages, files, memory):
+    folderModel = ModelImporter.model('folder')
+    parent = folderModel.createFolder(
+        user, 'benchmark-{}'.format(uuid.uuid4()), parentType='user',
+        creator=user)
+    dataone_register._resource_maps.clear()
+    server.reset_counts()
+    try:
+        result, elapsed, peak = measure(
+            lambda: harvester.register_DataONE_resource(
+                parent, 'folder', noProgress, user, pid), memory=memory)
+    finally:
+        folderModel.remove(parent)
+    return {
+        'operation': 'register',
+        'seconds': elapsed,
+        'packages/s': packages / elapsed,
+        'files/s': files / elapsed,
+        'peak MB': peak / 2.**20 if peak is not None else None,
+        'requests': sum(count for endpoint, count in server.counts.items()
+                        if endpoint != 'failed'),
+        'error': repr(result) if isinstance(result, Exception) else None
+    }
+
+
+def run_lookup(server, catalog, lookups, batch, memory):
+    pids = sorted(pid for pid, doc in catalog.docs.items()
+                  if doc['formatType'] == 'DATA')[:lookups]
+    server.reset_counts()
+    if batch:
+        result, elapsed, peak = measure(
+            lambda: dataone_register.D1_lookup_batch(pids), memory=memory)
+    else:
+        result, elapsed, peak = measure(
+            lambda: [dataone_register.D1_lookup(pid) for pid in pids],
+            memory=memory)
+    return {
+        'operation': 'lookup_batch' if batch else 'lookup',
+        'seconds': elapsed,
+        'lookups/s': len(pids) / elapsed,
+        'peak MB': peak / 2.**20 if peak is not None else None,
+        'requests': sum(count for endpoint, count in server.counts.items()
+                        if endpoint != 'failed'),
+        'error': repr(result) if isinstance(result, Exception) else None
+    }
+
+
+def print_table(results):
+    columns = ['shape', 'operation', 'run', 'seconds', 'packages/s', 'files/s',
+               'lookups/s', 'peak MB', 'requests']
+    print(' '.join('{:>14}'.format(column) for column in columns))
+    for result in results:
+        cells = []
+        for column in columns:
+            value = result.get(column)
+            if value is None:
+                cells.append('{:>14}'.format('-'))
+            elif isinstance(value, float):
+                cells.append('{:>14.3f}'.format(value))
+            else:
+                cells.append('{:>14}'.format(value))
+        print(' '.join(cells))
+        if result.get('error'):
+            print('    error: {}'.format(result['error']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--shape', action='append', default=[],
+                        help='flat:N, nested:DxBxN or large:N[xP] '
+                        '(default: flat:100, nested:2x3x10, large:2000)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--lookups', type=int, default=100,
+                        help='Number of data objects looked up per shape')
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--no-memory', action='store_true',
+                        help='Do not trace memory, which slows runs down')
+    parser.add_argument('--json', action='store_true',
+                        help='Print the results as JSON')
+    args = parser.parse_args()
+
+    settingModel = ModelImporter.model('setting')
+    cacheTtl = settingModel.get(PluginSettings.SOLR_CACHE_TTL)
+    settingModel.set(PluginSettings.SOLR_CACHE_TTL, 0)
+    user = benchmark_user()
+    results = []
+    try:
+        for shape in args.shape or ['flat:100', 'nested:2x3x10', 'large:2000']:
+            catalog = Catalog()
+            pid = catalog.add_shape(shape)
+            packages, files = catalog.descendants(pid)
+            server = StandInServer(
+                catalog, latency=args.latency, jitter=args.jitter,
+                failure_rate=args.failure_rate)
+            point_plugin_at(server.start())
+            try:
+                for run in range(args.repeat):
+                    for result in (
+                            run_register(server, user, pid, packages, files,
+                                         not args.no_memory),
+                            run_lookup(server, catalog, args.lookups, False,
+                                       not args.no_memory),
+                            run_lookup(server, catalog, args.lookups, True,
+                                       not args.no_memory)):
+                        result.update(shape=shape, run=run)
+                        results.append(result)
+            finally:
+                server.shutdown()
+                server.server_close()
+    finally:
+        if cacheTtl is None:
+            settingModel.unset(PluginSettings.SOLR_CACHE_TTL)
+        else:
+            settingModel.set(PluginSettings.SOLR_CACHE_TTL, cacheTtl)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_table(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare the streaming resource map parser with the rdflib one on synthetic
+OAI-ORE resource maps of increasing size.
+
+Run from an environment where Girder and this plugin are installed:
+
+  python benchmarks/resource_map_parser.py --members 1000 10000 50000
+"""
+
+import argparse
+import time
+import tracemalloc
+
+from girder.plugins.wholetale.dataone_register import ResourceMap
+
+from d1_standin import make_resource_map
+
+
+RESOLVE = 'https://cn.dataone.org/cn/v2/resolve/'
+
+
+def measure(parse):
+    tracemalloc.start()
+    start = time.time()
+    result = parse()
+    elapsed = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--members', type=int, nargs='+',
+                        default=[100, 1000, 10000])
+    parser.add_argument('--chunk-size', type=int, default=65536)
+    args = parser.parse_args()
+
+    print('{:>8} {:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+        'members', 'size (kB)', 'rdflib s', 'rdflib MB', 'stream s',
+        'stream MB'))
+    for members in args.members:
+        data = make_resource_map(
+            'resource_map', 'urn:uuid:metadata',
+            [('urn:uuid:data-{}'.format(i), True) for i in range(members)],
+            RESOLVE)
+        base = RESOLVE + 'resource_map'
+        graph, graph_time, graph_peak = measure(
+            lambda: ResourceMap.from_graph('resource_map', data, base=base))
+        stream, stream_time, stream_peak = measure(
+            lambda: ResourceMap.from_stream(
+                'resource_map',
+                (data[i:i + args.chunk_size]
+                 for i in range(0, len(data), args.chunk_size)),
+                base=base))
+        assert graph.aggregated_identifiers == stream.aggregated_identifiers
+        assert graph.documenting_identifiers == stream.documenting_identifiers
+        print('{:>8} {:>10.0f} {:>10.3f} {:>10.1f} {:>10.3f} {:>10.1f}'.format(
+            members, len(data) / 1024., graph_time, graph_peak / 2.**20,
+            stream_time, stream_peak / 2.**20))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,10 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import httmock
 import json
 import six
+import time
 from tests import base
 
 
@@ -75,6 +77,237 @@ class WholeTaleTestCase(base.TestCase):
                 'message': "%s's data structure could not be decoded." % k
             })
 
+    def testHttpSettings(self):
+        from girder.plugins.wholetale.constants import PluginSettings
+        from girder.plugins.wholetale.http_session import get_session
+
+        for key, message in (
+                (PluginSettings.HTTP_TIMEOUT,
+                 'HTTP timeout must be a positive number.'),
+                (PluginSettings.HTTP_POOL_SIZE,
+                 'HTTP pool size must be a positive integer.')):
+            for value in ('blah', '-1'):
+                resp = self.request('/system/setting', user=self.admin,
+                                    method='PUT',
+                                    params={'key': key, 'value': value})
+                self.assertStatus(resp, 400)
+                self.assertEqual(resp.json, {
+                    'field': 'value',
+                    'type': 'validation',
+                    'message': message
+                })
+
+        session = get_session()
+        self.assertIs(session, get_session())
+        resp = self.request('/system/setting', user=self.admin, method='PUT',
+                            params={'key': PluginSettings.HTTP_TIMEOUT,
+                                    'value': '12.5'})
+        self.assertStatusOk(resp)
+        self.assertIsNot(session, get_session())
+        self.assertEqual(get_session().timeout, 12.5)
+
+    def testUpstreamGovernor(self):
+        from girder.plugins.wholetale.constants import PluginSettings
+        from girder.plugins.wholetale.http_session import get_session
+        from girder.plugins.wholetale.throttle import TokenBucket
+
+        for key, value in ((PluginSettings.UPSTREAM_RATE_LIMIT, '-1'),
+                           (PluginSettings.UPSTREAM_CONCURRENCY, '0'),
+                           (PluginSettings.UPSTREAM_MAX_RETRIES, 'blah'),
+                           (PluginSettings.UPSTREAM_THROTTLED_HOSTS, [1])):
+            resp = self.request('/system/setting', user=self.admin,
+                                method='PUT',
+                                params={'key': key, 'value': value})
+            self.assertStatus(resp, 400)
+
+        resp = self.request('/system/setting', user=self.admin, method='PUT',
+                            params={'list': json.dumps([
+                                {'key': PluginSettings.UPSTREAM_RATE_LIMIT,
+                                 'value': 1000},
+                                {'key': PluginSettings.UPSTREAM_MAX_RETRIES,
+                                 'value': 2},
+                                {'key': PluginSettings.UPSTREAM_THROTTLED_HOSTS,
+                                 'value': 'dataone.org, example.com'}])})
+        self.assertStatusOk(resp)
+        governor = get_session().governor
+        self.assertEqual(governor.rate, 1000)
+        self.assertEqual(governor.max_retries, 2)
+        self.assertEqual(governor.throttled_hosts,
+                         ('dataone.org', 'example.com'))
+        self.assertEqual(governor.host('cn.dataone.org').bucket.rate, 1000)
+        # Other hosts are not rate limited
+        self.assertEqual(governor.host('data.org:8080').bucket.rate, 0)
+
+        calls = []
+
+        @httmock.urlmatch(scheme='https', netloc='^busy.example.com$')
+        def mockBusy(url, request):
+            calls.append(url.path)
+            if url.path == '/recovers' and len(calls) > 2:
+                return httmock.response(200, 'ok', {}, None, 5, request)
+            return httmock.response(
+                503 if len(calls) % 2 else 429, 'busy', {'Retry-After': '0'},
+                None, 5, request)
+
+        with httmock.HTTMock(mockBusy):
+            resp = get_session().get('https://busy.example.com/recovers')
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(len(calls), 3)
+
+            del calls[:]
+            resp = get_session().get('https://busy.example.com/down')
+            self.assertEqual(resp.status_code, 429)
+            self.assertEqual(len(calls), 3)
+
+        stats = governor.stats()['busy.example.com']
+        self.assertEqual(stats['calls'], 6)
+        self.assertEqual(stats['throttled'], 4)
+        self.assertLess(stats['rate'], 1000)
+
+        # 5 calls per second, bursts of 1
+        bucket = TokenBucket(5, capacity=1)
+        start = time.time()
+        for _ in range(4):
+            bucket.acquire()
+        self.assertGreaterEqual(time.time() - start, 0.55)
+
+    def testBulkCreateLinkFiles(self):
+        from girder.plugins.wholetale.utils import bulkCreateLinkFiles
+
+        folder = self.model('folder').createFolder(
+            self.user, 'links', parentType='user', creator=self.user)
+
+        def link(name, url, size, meta=None):
+            return {'name': name, 'url': url, 'size': size,
+                    'mimeType': 'text/plain', 'meta': meta or {}}
+
+        items = bulkCreateLinkFiles(folder, self.user, [
+            link('a.txt', 'http://x.org/a.txt', 10, {'source': 'x'}),
+            link('a.txt', 'http://y.org/a.txt', 5),
+            link('b.txt', 'http://x.org/b.txt', 1)])
+        self.assertEqual([item['name'] for item in items],
+                         ['a.txt', 'a.txt (1)', 'b.txt'])
+        self.assertEqual([item['size'] for item in items], [10, 5, 1])
+        self.assertEqual(items[0]['meta'], {'source': 'x'})
+        self.assertEqual(self.model('folder').load(
+            folder['_id'], force=True)['size'], 16)
+
+        # Same name and URL: the item is reused, its size and file updated
+        # and its metadata merged
+        again = bulkCreateLinkFiles(folder, self.user, [
+            link('a.txt', 'http://y.org/a.txt', 7),
+            link('a.txt', 'http://x.org/a.txt', 12, {'checked': True})])
+        self.assertEqual([item['_id'] for item in again],
+                         [items[1]['_id'], items[0]['_id']])
+        self.assertEqual([item['size'] for item in again], [7, 12])
+        item = self.model('item').load(items[0]['_id'], force=True)
+        self.assertEqual(item['meta'], {'source': 'x', 'checked': True})
+        self.assertEqual(item['size'], 12)
+        files = list(self.model('item').childFiles(item))
+        self.assertEqual(len(files), 1)
+        self.assertEqual(files[0]['linkUrl'], 'http://x.org/a.txt')
+        self.assertEqual(files[0]['size'], 12)
+        self.assertEqual(self.model('folder').load(
+            folder['_id'], force=True)['size'], 20)
+        self.assertEqual(self.model('user').load(
+            self.user['_id'], force=True)['size'], 20)
+
+        # An item that is not a link to the URL is never overwritten
+        upload = self.model('item').createItem('c.txt', self.user, folder)
+        items = bulkCreateLinkFiles(folder, self.user, [
+            link('c.txt', 'http://x.org/c.txt', 4),
+            link('a.txt', 'http://z.org/a.txt', 1)])
+        self.assertEqual([item['name'] for item in items],
+                         ['c.txt (1)', 'a.txt (2)'])
+        self.assertEqual(list(self.model('item').childFiles(upload)), [])
+        self.assertEqual(self.model('folder').load(
+            folder['_id'], force=True)['size'], 25)
+
+    def testCatalogEntries(self):
+        from girder.api.rest import RestException
+        from girder.plugins.wholetale.utils import createRegisteredFolder, \
+            findCatalogEntry, setCatalogEntry
+
+        parent = self.model('folder').createFolder(
+            self.user, 'catalog', parentType='user', creator=self.user)
+
+        def register(identifier):
+            return createRegisteredFolder(
+                parent, 'folder', 'Title', self.user, 'DataONE', identifier,
+                'dataoneState.resourceMap')
+
+        first = setCatalogEntry(register('pid:1'), 'DataONE', 'pid:1')
+        # Another package with the same title gets its own folder
+        second = register('pid:2')
+        self.assertEqual(second['name'], 'Title (1)')
+        self.assertEqual(register('pid:1')['_id'], first['_id'])
+        self.assertEqual(
+            findCatalogEntry('DataONE', 'pid:1')['_id'], first['_id'])
+
+        # The folder of an existing entry is never moved to another one
+        with self.assertRaises(RestException):
+            setCatalogEntry(first, 'DataONE', 'pid:3')
+
+        # The loser of a concurrent registration is removed
+        duplicate = self.model('folder').createFolder(
+            parent, 'Duplicate', parentType='folder', creator=self.user)
+        entry = setCatalogEntry(duplicate, 'DataONE', 'pid:1')
+        self.assertEqual(entry['_id'], first['_id'])
+        self.assertIsNone(
+            self.model('folder').load(duplicate['_id'], force=True))
+
+    def testThrottledProgress(self):
+        import threading
+        from girder.plugins.wholetale.constants import PluginSettings
+        from girder.plugins.wholetale.progress import ThrottledProgress
+
+        resp = self.request('/system/setting', user=self.admin, method='PUT',
+                            params={'key': PluginSettings.PROGRESS_INTERVAL,
+                                    'value': '-1'})
+        self.assertStatus(resp, 400)
+        self.assertEqual(resp.json['message'],
+                         'Progress interval must be a non-negative number.')
+
+        class Recorder(object):
+            def __init__(self):
+                self.updates = []
+
+            def update(self, **kwargs):
+                self.updates.append(kwargs)
+
+        recorder = Recorder()
+        with ThrottledProgress(recorder, interval=60) as progress:
+            progress.update(total=10, message='Starting')
+            for i in range(9):
+                progress.update(increment=1, message='File {}'.format(i))
+            self.assertEqual(len(recorder.updates), 1)
+            progress.update(current=5)
+            progress.update(increment=2, message='Important', force=True)
+            progress.update(total=12, state='error')
+        self.assertEqual(recorder.updates, [
+            {'force': True, 'total': 10, 'message': 'Starting'},
+            {'force': True, 'current': 7, 'message': 'Important'},
+            {'force': True, 'total': 12, 'state': 'error'}
+        ])
+
+        # Increments made by several threads all add up
+        recorder = Recorder()
+        progress = ThrottledProgress(recorder, interval=0.01)
+
+        def work():
+            for _ in range(200):
+                progress.update(increment=1)
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        progress.flush()
+        self.assertEqual(
+            sum(update.get('increment', 0) for update in recorder.updates), 800)
+        self.assertLess(len(recorder.updates), 800)
+
     def testListing(self):
         user = self.user
         c1 = self.model('collection').createCollection('c1', user)
@@ -1,11 +1,14 @@
 
 import base64
+import copy
+import datetime
 import httmock
 import json
 import mock
 import operator
 import os
 import six
+import time
 from tests import base
 from girder.constants import ROOT_DIR
 from girder.api.rest import RestException
@@ -59,6 +62,9 @@ D1_MAP = {
             'formatId': 'eml://ecoinformatics.org/eml-2.1.1',
             'formatType': 'METADATA',
             'identifier': 'urn:uuid:c878ae53-06cf-40c9-a830-7f6f564133f9',
+            'resourceMap': [
+                'resource_map_urn:uuid:c878ae53-06cf-40c9-a830-7f6f564133f9'
+            ],
             'size': 21702,
             'title': 'Thaw depth in the ITEX plots at Barrow and Atqasuk, Alaska'
         }, {
@@ -66,18 +72,27 @@ D1_MAP = {
             'formatId': 'text/csv',
             'formatType': 'DATA',
             'identifier': 'urn:uuid:dc29f3cf-022a-4a33-9eed-8dc9ba6e0218',
+            'resourceMap': [
+                'resource_map_urn:uuid:c878ae53-06cf-40c9-a830-7f6f564133f9'
+            ],
             'size': 7770
         }, {
             'fileName': '1995-20XX Barrow Atqasuk ITEX Thaw metadata - Copy.txt',
             'formatId': 'text/plain',
             'formatType': 'DATA',
             'identifier': 'urn:uuid:428fcb96-03a9-42b3-81d1-2944ac686e55',
+            'resourceMap': [
+                'resource_map_urn:uuid:c878ae53-06cf-40c9-a830-7f6f564133f9'
+            ],
             'size': 3971
         }, {
             'fileName': '2016 Barrow Atqasuk ITEX Thaw v1.csv',
             'formatId': 'text/csv',
             'formatType': 'DATA',
             'identifier': 'urn:uuid:bd7754a7-d4db-4217-8bf0-4c5d3691c0bc',
+            'resourceMap': [
+                'resource_map_urn:uuid:c878ae53-06cf-40c9-a830-7f6f564133f9'
+            ],
             'size': 7439
         }],
         'numFound': 4,
@@ -100,41 +115,21 @@ def setUpModule():
     base.startServer()
 
 
-class MockResponse(object):
-
-    def __init__(self, data=None, url=None, info={}, code=200, msg='OK'):
-        self.stream = six.StringIO(data)
-        self.code = code
-        self.msg = msg
-        self._info = info
-        self.url = url
-        self.headers = {'content-type': 'application/rdf xml'}
-
-    def read(self, *args, **kwargs):
-        return self.stream.read(*args, **kwargs)
-
-    def getcode(self):
-        return self.code
-
-    def info(self):
-        return self._info
-
-    def geturl(self):
-        return self.url
-
-    def close(self):
-        return self.stream.close()
-
-
-def fake_urlopen(url):
+def _load_resource_map():
     fname = os.path.join(ROOT_DIR, 'plugins', 'wholetale', 'plugin_tests',
                          'dataone_test01.json')
     with open(fname, 'r') as fp:
         data = json.load(fp)
-    data['data'] = base64.b64decode(
-        data['data'].encode('utf8')).decode('utf8')
-    f = MockResponse(**data)
-    return f
+    data['data'] = base64.b64decode(data['data'].encode('utf8'))
+    return data
+
+
+@httmock.urlmatch(scheme='https', netloc='^cn.dataone.org$',
+                  path='^/cn/v2/resolve/resource_map_', method='GET')
+def mockResolveDataONE(url, request):
+    data = _load_resource_map()
+    headers = {'Content-Type': data['info']['Content-Type']}
+    return httmock.response(200, data['data'], headers, None, 5, request)
 
 
 def tearDownModule():
@@ -163,8 +158,6 @@ class DataONEHarversterTestCase(base.TestCase):
         })
         self.admin, self.user = [self.model('user').createUser(**user)
                                  for user in users]
-        self.patcher = mock.patch('rdflib.parser.urlopen', fake_urlopen)
-        self.patcher.start()
 
     def testLookup(self):
         # TODO: mock this if it's necessary
@@ -200,7 +193,7 @@ class DataONEHarversterTestCase(base.TestCase):
             return httmock.response(200, {}, headers, None, 5, request)
 
         with httmock.HTTMock(mockSearchDataONE, mockCurldrop,
-                             self.mockOtherRequest):
+                             mockResolveDataONE, self.mockOtherRequest):
             resp = self.request(
                 path='/repository/lookup', method='GET',
                 params={'dataId':
@@ -238,7 +231,7 @@ class DataONEHarversterTestCase(base.TestCase):
         dataFolder = resp.json[0]
 
         with httmock.HTTMock(mockSearchDataONE, mockCurldrop,
-                             self.mockOtherRequest):
+                             mockResolveDataONE, self.mockOtherRequest):
             resp = self.request(
                 path='/dataset/register', method='POST',
                 params={'dataMap': json.dumps(dataMap),
@@ -325,7 +318,1122 @@ class DataONEHarversterTestCase(base.TestCase):
         self.assertEqual(resp.json['nItems'], 2)
         self.assertEqual(resp.json['nFolders'], 2)
 
+    def testLookupStream(self):
+        @httmock.urlmatch(scheme='https', netloc='^cn.dataone.org$',
+                          path='^/cn/v2/query/solr/$', method='GET')
+        def mockEmptySearch(url, request):
+            return json.dumps({
+                'response': {'docs': [], 'numFound': 0, 'start': 0},
+                'responseHeader': {'status': 0}
+            })
+
+        @httmock.urlmatch(scheme='http', netloc='^use.yt$', method='HEAD')
+        def mockHead(url, request):
+            headers = {'Content-Type': 'text/plain', 'Content-Length': '42'}
+            return httmock.response(200, {}, headers, None, 5, request)
+
+        dataId = ['urn:uuid:streamed', 'http://use.yt/upload/streamed.txt']
+        with httmock.HTTMock(mockEmptySearch, mockHead, self.mockOtherRequest):
+            resp = self.request(
+                path='/repository/lookup', method='GET', isJson=False,
+                params={'dataId': json.dumps(dataId), 'stream': True})
+            self.assertStatusOk(resp)
+            self.assertEqual(resp.headers['Content-Type'],
+                             'application/x-ndjson')
+            records = [json.loads(line)
+                       for line in self.getBody(resp).splitlines()]
+
+        self.assertEqual(records[:-1], [{
+            'dataId': 'http://use.yt/upload/streamed.txt',
+            'doi': 'unknown',
+            'name': 'streamed.txt',
+            'repository': 'HTTP',
+            'size': 42
+        }])
+        summary = records[-1]['summary']
+        self.assertEqual(summary['resolved'], 1)
+        self.assertEqual(summary['unresolved'], ['urn:uuid:streamed'])
+
+    def testLookupRouting(self):
+        from girder.plugins.wholetale.rest import repository
+        from girder.plugins.wholetale.rest.repository import resolvers
+
+        self.assertEqual(resolvers('urn:uuid:c878ae53'), ('DataONE',))
+        self.assertEqual(resolvers('doi:10.5063/F1Z899CZ'), ('DataONE',))
+        self.assertEqual(resolvers('https://doi.org/10.5063/F1Z899CZ'),
+                         ('DataONE',))
+        self.assertEqual(resolvers('http://use.yt/upload/10.5063/data.csv'),
+                         ('DataONE', 'HTTP'))
+        self.assertEqual(resolvers('http://use.yt/upload/routed'), ('HTTP',))
+
+        queries = []
+        heads = []
+
+        @httmock.urlmatch(scheme='https', netloc='^cn.dataone.org$',
+                          path='^/cn/v2/query/solr/$', method='GET')
+        def mockEmptySearch(url, request):
+            queries.append(request.url)
+            return json.dumps({
+                'response': {'docs': [], 'numFound': 0, 'start': 0},
+                'responseHeader': {'status': 0}
+            })
+
+        @httmock.urlmatch(scheme='http', netloc='^use.yt$', method='HEAD')
+        def mockMissing(url, request):
+            heads.append(url.path)
+            return httmock.response(404, {}, {}, None, 5, request)
+
+        dataId = ['urn:uuid:routed', 'http://use.yt/upload/routed']
+        with httmock.HTTMock(mockEmptySearch, mockMissing,
+                             self.mockOtherRequest), \
+                mock.patch.object(repository, 'D1_lookup_batch',
+                                  wraps=repository.D1_lookup_batch) as batch:
+            for i in range(2):
+                resp = self.request(
+                    path='/repository/lookup', method='GET',
+                    params={'dataId': json.dumps(dataId)})
+                self.assertStatusOk(resp)
+                self.assertEqual(resp.json, [])
+
+        # No Solr query for the URL, no HEAD for the UUID, and neither is
+        # looked up again while the failures are cached
+        self.assertTrue(queries)
+        self.assertFalse([query for query in queries if 'use.yt' in query])
+        self.assertEqual(heads, ['/upload/routed'])
+        batch.assert_called_once_with(['urn:uuid:routed'])
+
+    def testPagedQuery(self):
+        from girder.plugins.wholetale.dataone_register import \
+            iter_query, query
+
+        numFound = 25
+        pages = []
+
+        @httmock.urlmatch(scheme='https', netloc='^cn.dataone.org$',
+                          path='^/cn/v2/query/solr/$', method='GET')
+        def mockPagedSearch(url, request):
+            params = dict(_.split('=', 1) for _ in url.query.split('&'))
+            start, rows = int(params['start']), int(params['rows'])
+            pages.append(start)
+            docs = [{'identifier': 'urn:uuid:{}'.format(i)}
+                    for i in range(start, min(start + rows, numFound))]
+            return json.dumps({
+                'response': {'docs': docs, 'numFound': numFound,
+                             'start': start},
+                'responseHeader': {'status': 0}
+            })
+
+        with httmock.HTTMock(mockPagedSearch, self.mockOtherRequest):
+            docs = list(iter_query('resourceMap:"blah"', rows=10))
+            self.assertEqual(pages, [0, 10, 20])
+            self.assertEqual([_['identifier'] for _ in docs],
+                             ['urn:uuid:{}'.format(i) for i in range(numFound)])
+
+            with six.assertRaisesRegex(self, RestException, 'truncated'):
+                query('resourceMap:"blah"', rows=10)
+
+            # Streamed pages are decoded incrementally and never cached
+            del pages[:]
+            streamed = list(iter_query('resourceMap:"blah"', rows=10,
+                                       stream=True))
+            self.assertEqual(pages, [0, 10, 20])
+            self.assertEqual(streamed, docs)
+
+    def testBatchLookup(self):
+        from girder.plugins.wholetale.dataone_register import D1_lookup_batch
+
+        pids = ['urn:uuid:{}'.format(i) for i in range(5)]
+        queries = []
+
+        @httmock.urlmatch(scheme='https', netloc='^cn.dataone.org$',
+                          path='^/cn/v2/query/solr/$', method='GET')
+        def mockBatchSearch(url, request):
+            q = six.moves.urllib.parse.unquote_plus(url.query.split('&')[0])
+            queries.append(q)
+            # Every PID but the last one is known, each in its own package
+            known = [pid for pid in pids[:-1] if '"{}"'.format(pid) in q]
+            if q.startswith('q=identifier'):
+                docs = [{'identifier': pid, 'formatType': 'DATA',
+                         'resourceMap': ['rm_' + pid]} for pid in known]
+            else:
+                docs = [{'identifier': 'meta_' + pid, 'formatType': 'METADATA',
+                         'title': 'Title ' + pid, 'size': 1, 'documents': [pid],
+                         'resourceMap': ['rm_' + pid]}
+                        for pid in pids[:-1] if '"rm_{}"'.format(pid) in q]
+            return json.dumps({
+                'response': {'docs': docs, 'numFound': len(docs), 'start': 0},
+                'responseHeader': {'status': 0}
+            })
+
+        with httmock.HTTMock(mockBatchSearch, self.mockOtherRequest):
+            results = D1_lookup_batch(pids)
+
+        self.assertEqual(len(queries), 2)
+        self.assertEqual(list(results.keys()), pids)
+        for pid in pids[:-1]:
+            self.assertEqual(results[pid], {
+                'dataId': 'rm_' + pid, 'doi': 'meta_' + pid, 'size': 1,
+                'name': 'Title ' + pid, 'repository': 'DataONE'})
+        self.assertIsInstance(results[pids[-1]], RestException)
+        self.assertEqual(
+            results[pids[-1]].message,
+            'No object was found in the index for {}.'.format(pids[-1]))
+
+    def testConcurrentImport(self):
+        import threading
+        from girder.plugins.wholetale.rest import harvester
+        from girder.utility.progress import noProgress
+
+        parent = self.model('folder').createFolder(
+            self.user, 'Concurrent', parentType='user', creator=self.user)
+        dataMap = [{
+            'dataId': 'urn:uuid:concurrent-{}'.format(i),
+            'doi': 'unknown',
+            'name': 'Package {}'.format(i),
+            'repository': 'DataONE',
+            'size': 42
+        } for i in range(4)]
+        lock = threading.Lock()
+        running = []
+        peak = []
+        writers = []
+
+        def mockFetch(pid, progress, checkpoint=None, executor=None):
+            with lock:
+                running.append(pid)
+                peak.append(len(running))
+            # Later entries complete first
+            time.sleep(0.05 * (4 - len(peak)))
+            progress.update(increment=1, message=pid)
+            with lock:
+                running.remove(pid)
+            return {pid: {'pid': pid, 'children': []}}
+
+        def mockRegister(parent, parentType, progress, user, packages, pid,
+                         name=None, checkpoint=None):
+            self.assertIn(pid, packages)
+            writers.append(threading.current_thread())
+            return self.model('folder').createFolder(
+                parent, name, parentType=parentType, creator=user)
+
+        with mock.patch.object(harvester, '_fetch_package_tree',
+                               side_effect=mockFetch), \
+                mock.patch.object(harvester, '_register_package',
+                                  side_effect=mockRegister):
+            importedData = harvester.import_data(
+                parent, 'folder', noProgress, self.user, dataMap)
+
+        # Packages are fetched concurrently, but written by the caller
+        self.assertEqual(writers, [threading.current_thread()] * 4)
+        self.assertGreater(max(peak), 1)
+        self.assertEqual([folder['name'] for folder in importedData['folder']],
+                         [data['name'] for data in dataMap])
+        self.model('folder').remove(parent)
+
+    def testNestedPackages(self):
+        from girder.plugins.wholetale.rest import harvester
+        from girder.utility.progress import noProgress
+
+        parent = self.model('folder').createFolder(
+            self.user, 'Nested', parentType='user', creator=self.user)
+        # c is nested twice, and b also nests the root package
+        tree = {'root': ['a', 'b'], 'a': ['c'], 'b': ['c', 'root'], 'c': []}
+        fetched = []
+        written = []
+        writePackage = harvester._write_package
+
+        def mockFetch(pid, state=None):
+            fetched.append(pid)
+            return {'pid': pid, 'metadata': {'title': pid, 'identifier': pid},
+                    'state': {'resourceMap': pid, 'digest': pid,
+                              'children': tree[pid]},
+                    'data': [], 'children': tree[pid]}
+
+        def mockWrite(parent, parentType, user, package, name, **kwargs):
+            written.append((parent['name'], package['pid']))
+            return writePackage(parent, parentType, user, package, name,
+                                **kwargs)
+
+        with mock.patch.object(harvester, '_fetch_package',
+                               side_effect=mockFetch), \
+                mock.patch.object(harvester, '_write_package',
+                                  side_effect=mockWrite):
+            folder = harvester.register_DataONE_resource(
+                parent, 'folder', noProgress, self.user, 'root')
+
+        # Every package is fetched once, and written in the order of the tree
+        self.assertEqual(sorted(fetched), ['a', 'b', 'c', 'root'])
+        self.assertEqual(written, [('Nested', 'root'), ('root', 'a'),
+                                   ('a', 'c'), ('root', 'b'), ('b', 'c')])
+        self.assertEqual(folder['meta']['dataoneState']['resourceMap'], 'root')
+        self.model('folder').remove(parent)
+
+    def testHttpDirectory(self):
+        from girder.plugins.wholetale.constants import PluginSettings
+        from girder.plugins.wholetale.http_directory import parse_listing
+
+        listings = {
+            '/pub/': ['?C=N;O=D', '../', 'a.csv', 'b%20c.txt', 'sub/',
+                      'http://elsewhere.org/pub/x.txt', 'a.csv#top'],
+            '/pub/sub/': ['/pub/', 'd.txt', 'missing.txt', 'deeper/'],
+            '/pub/sub/deeper/': ['e.txt']
+        }
+        requests = []
+
+        @httmock.urlmatch(scheme='http', netloc='^data.example.org$')
+        def mockDirectory(url, request):
+            requests.append((request.method, url.path))
+            if url.path in listings:
+                body = ''.join('<a href="{0}">{0}</a>\n'.format(href)
+                               for href in listings[url.path])
+                return httmock.response(
+                    200, '<html><body><pre>{}</pre></body></html>'.format(body),
+                    {'Content-Type': 'text/html;charset=UTF-8'}, None, 5,
+                    request)
+            if url.path.endswith('missing.txt'):
+                return httmock.response(404, {}, {}, None, 5, request)
+            headers = {'Content-Type': 'text/plain', 'Content-Length': '10'}
+            return httmock.response(200, {}, headers, None, 5, request)
+
+        self.assertEqual(
+            parse_listing('<a href="b%20c.txt">b c.txt</a><a href="s/">s/</a>',
+                          'http://data.example.org/pub'),
+            [('b c.txt', 'http://data.example.org/pub/b%20c.txt', False),
+             ('s', 'http://data.example.org/pub/s/', True)])
+
+        resp = self.request('/system/setting', user=self.admin, method='PUT',
+                            params={'key': PluginSettings.HTTP_DIRECTORY_DEPTH,
+                                    'value': '-1'})
+        self.assertStatus(resp, 400)
+        self.model('setting').set(PluginSettings.HTTP_DIRECTORY_DEPTH, 1)
+
+        url = 'http://data.example.org/pub/'
+        with httmock.HTTMock(mockDirectory, self.mockOtherRequest):
+            resp = self.request(
+                path='/repository/lookup', method='GET', user=self.user,
+                params={'dataId': json.dumps([url])})
+            self.assertStatusOk(resp)
+            self.assertEqual(resp.json, [{
+                'dataId': url, 'doi': 'unknown', 'name': 'pub',
+                'repository': 'HTTPDirectory', 'size': 0}])
+
+            private = self.model('folder').findOne(
+                {'parentId': self.user['_id'], 'name': 'Private'})
+            resp = self.request(
+                path='/dataset/register', method='POST', user=self.user,
+                params={'dataMap': json.dumps(resp.json),
+                        'parentId': str(private['_id']),
+                        'parentType': 'folder', 'copyToHome': False})
+            self.assertStatusOk(resp)
+            self.assertEqual(
+                [failure['dataId'] for failure in resp.json['failed']],
+                ['{}sub/missing.txt'.format(url)])
+        self.model('setting').unset(PluginSettings.HTTP_DIRECTORY_DEPTH)
+
+        self.assertEqual(
+            sorted(path for method, path in requests if method == 'GET'),
+            ['/pub/', '/pub/sub/'])
+        self.assertEqual(
+            sorted(path for method, path in requests if method == 'HEAD'),
+            ['/pub/', '/pub/a.csv', '/pub/b%20c.txt', '/pub/sub/d.txt',
+             '/pub/sub/missing.txt'])
+
+        folder = self.model('folder').findOne(
+            {'parentId': private['_id'], 'name': 'pub'})
+        self.assertEqual(folder['meta'],
+                         {'provider': 'HTTPDirectory', 'identifier': url})
+        self.assertEqual(folder['size'], 20)
+        self.assertEqual(
+            sorted(item['name'] for item in
+                   self.model('folder').childItems(folder)),
+            ['a.csv', 'b c.txt'])
+        subfolders = list(self.model('folder').childFolders(
+            folder, 'folder', user=self.user))
+        self.assertEqual([_['name'] for _ in subfolders], ['sub'])
+        self.assertEqual(
+            [item['name'] for item in
+             self.model('folder').childItems(subfolders[0])], ['d.txt'])
+        self.assertEqual(list(self.model('folder').childFolders(
+            subfolders[0], 'folder', user=self.user)), [])
+        files = list(self.model('item').childFiles(
+            self.model('item').findOne({'folderId': folder['_id'],
+                                        'name': 'b c.txt'})))
+        self.assertEqual(files[0]['linkUrl'], url + 'b%20c.txt')
+        self.model('folder').remove(folder)
+
+    def testHttpMetadataCache(self):
+        from girder.plugins.wholetale.http_session import head
+
+        url = 'http://use.yt/upload/cached.txt'
+        upstream = {'ETag': '"v1"', 'Content-Length': '42'}
+        heads = []
+
+        @httmock.urlmatch(scheme='http', netloc='^use.yt$', method='HEAD')
+        def mockConditionalHead(url, request):
+            heads.append(request.headers.get('If-None-Match'))
+            if request.headers.get('If-None-Match') == upstream['ETag']:
+                return httmock.response(
+                    304, {}, {'ETag': upstream['ETag']}, None, 5, request)
+            headers = dict(upstream, **{'Content-Type': 'text/plain'})
+            return httmock.response(200, {}, headers, None, 5, request)
+
+        @httmock.urlmatch(scheme='https', netloc='^cn.dataone.org$',
+                          path='^/cn/v2/query/solr/$', method='GET')
+        def mockEmptySearch(url, request):
+            return json.dumps({
+                'response': {'docs': [], 'numFound': 0, 'start': 0},
+                'responseHeader': {'status': 0}
+            })
+
+        cache = self.model('http_cache', 'wholetale')
+        cache.purge(resetStats=True)
+
+        def expire():
+            cache.collection.update_one(
+                {'url': url}, {'$set': {'freshUntil': datetime.datetime(1970, 1, 1)}})
+
+        with httmock.HTTMock(mockConditionalHead, mockEmptySearch,
+                             self.mockOtherRequest):
+            resp = self.request(
+                path='/repository/lookup', method='GET',
+                params={'dataId': json.dumps([url])})
+            self.assertStatusOk(resp)
+            self.assertEqual(resp.json[0]['size'], 42)
+            # Registration reuses the headers of the lookup
+            self.assertEqual(head(url).headers['content-length'], '42')
+            self.assertEqual(heads, [None])
+
+            expire()
+            self.assertEqual(head(url).headers['Content-Type'], 'text/plain')
+            self.assertEqual(heads, [None, '"v1"'])
+
+            upstream.update({'ETag': '"v2"', 'Content-Length': '43'})
+            expire()
+            self.assertEqual(head(url).headers['Content-Length'], '43')
+            self.assertEqual(heads, [None, '"v1"', '"v1"'])
+
+        self.assertEqual(cache.stats(), {'entries': 1, 'hits': 1, 'misses': 1,
+                                         'revalidated': 1})
+
+    def testImportJob(self):
+        from girder.plugins.jobs.constants import JobStatus
+        from girder.plugins.jobs.models.job import Job
+        from girder.plugins.wholetale.tasks import import_data
+
+        parent = self.model('folder').createFolder(
+            self.user, 'Imports', parentType='user', creator=self.user)
+        dataMap = [{
+            'dataId': 'http://use.yt/upload/{}'.format(name),
+            'doi': 'unknown',
+            'name': name,
+            'repository': 'HTTP',
+            'size': 42
+        } for name in ('first.txt', 'second.txt')]
+        heads = []
+
+        @httmock.urlmatch(scheme='http', netloc='^use.yt$', method='HEAD')
+        def mockFlakyHead(url, request):
+            heads.append(url.path)
+            if url.path.endswith('second.txt') and \
+                    heads.count(url.path) == 1:
+                raise Exception('Connection reset by peer')
+            headers = {'Content-Type': 'text/plain', 'Content-Length': '42'}
+            return httmock.response(200, {}, headers, None, 5, request)
+
+        with httmock.HTTMock(mockFlakyHead, self.mockOtherRequest), \
+                mock.patch.object(Job, 'scheduleJob') as scheduleJob:
+            resp = self.request(
+                path='/dataset/register', method='POST', user=self.user,
+                params={'dataMap': json.dumps(dataMap), 'asJob': True,
+                        'parentId': str(parent['_id']), 'parentType': 'folder',
+                        'copyToHome': False})
+            self.assertStatusOk(resp)
+            self.assertEqual(scheduleJob.call_count, 1)
+            job = Job().load(resp.json['_id'], force=True)
+            self.assertEqual(job['type'], import_data.JOB_TYPE)
+            # It has not failed, so it cannot be resumed yet
+            resp = self.request(
+                path='/dataset/register/{}/resume'.format(job['_id']),
+                method='POST', user=self.user)
+            self.assertStatus(resp, 400)
+
+            # The job is run in place of the jobs plugin, and registers the
+            # first file only
+            import_data.run(job)
+            job = Job().load(job['_id'], force=True)
+            self.assertEqual(job['status'], JobStatus.ERROR)
+            self.assertIn('Could not register http://use.yt/upload/second.txt',
+                          job['log'][-1])
+            self.assertEqual(len(job['wtCheckpoint']['entries']), 1)
+
+            resp = self.request(
+                path='/dataset/register/{}/resume'.format(job['_id']),
+                method='POST', user=self.user)
+            self.assertStatusOk(resp)
+            resumed = Job().load(resp.json['_id'], force=True)
+            self.assertEqual(resumed['wtResumedFrom'], job['_id'])
+
+            import_data.run(resumed)
+            resumed = Job().load(resumed['_id'], force=True)
+            self.assertEqual(resumed['status'], JobStatus.SUCCESS)
+
+            resp = self.request(
+                path='/dataset/register/{}/resume'.format(resumed['_id']),
+                method='POST', user=self.user)
+            self.assertStatus(resp, 400)
+
+            # A running job is resumed only once it stopped being updated
+            Job().collection.update_one(
+                {'_id': resumed['_id']},
+                {'$set': {'status': JobStatus.RUNNING}})
+            resp = self.request(
+                path='/dataset/register/{}/resume'.format(resumed['_id']),
+                method='POST', user=self.user)
+            self.assertStatus(resp, 400)
+            Job().collection.update_one(
+                {'_id': resumed['_id']},
+                {'$set': {'updated': datetime.datetime.utcnow() -
+                          datetime.timedelta(
+                              seconds=import_data.STALE_JOB_TIMEOUT + 1)}})
+            resp = self.request(
+                path='/dataset/register/{}/resume'.format(resumed['_id']),
+                method='POST', user=self.user)
+            self.assertStatusOk(resp)
+
+        # The first file was not probed again by the resumed job
+        self.assertEqual(sorted(heads), ['/upload/first.txt',
+                                         '/upload/second.txt',
+                                         '/upload/second.txt'])
+        items = list(self.model('folder').childItems(parent))
+        self.assertEqual(sorted(item['name'] for item in items),
+                         ['first.txt', 'second.txt'])
+
+    def testImportJobCopyToHome(self):
+        from girder.plugins.jobs.constants import JobStatus
+        from girder.plugins.jobs.models.job import Job
+        from girder.plugins.wholetale.tasks import import_data
+
+        parent = self.model('folder').createFolder(
+            self.user, 'Imports', parentType='user', creator=self.user,
+            reuseExisting=True)
+        dataFolder = self.model('folder').findOne({
+            'parentId': self.user['_id'], 'parentCollection': 'user',
+            'name': 'Data'})
+        names = ('third.txt', 'fourth.txt')
+        dataMap = [{
+            'dataId': 'http://use.yt/upload/{}'.format(name),
+            'doi': 'unknown',
+            'name': name,
+            'repository': 'HTTP',
+            'size': 42
+        } for name in names]
+        heads = []
+
+        @httmock.urlmatch(scheme='http', netloc='^use.yt$', method='HEAD')
+        def mockFlakyHead(url, request):
+            heads.append(url.path)
+            if url.path.endswith('fourth.txt') and \
+                    heads.count(url.path) == 1:
+                raise Exception('Connection reset by peer')
+            headers = {'Content-Type': 'text/plain', 'Content-Length': '42'}
+            return httmock.response(200, {}, headers, None, 5, request)
+
+        def copies():
+            return sorted(
+                item['name'] for item in
+                self.model('folder').childItems(dataFolder)
+                if item['name'] in names)
+
+        with httmock.HTTMock(mockFlakyHead, self.mockOtherRequest), \
+                mock.patch.object(Job, 'scheduleJob'):
+            resp = self.request(
+                path='/dataset/register', method='POST', user=self.user,
+                params={'dataMap': json.dumps(dataMap), 'asJob': True,
+                        'parentId': str(parent['_id']), 'parentType': 'folder',
+                        'copyToHome': True})
+            self.assertStatusOk(resp)
+            job = Job().load(resp.json['_id'], force=True)
+
+            # The first file is registered and copied to the workspace
+            import_data.run(job)
+            job = Job().load(job['_id'], force=True)
+            self.assertEqual(job['status'], JobStatus.ERROR)
+            self.assertEqual(len(job['wtCheckpoint']['copied']), 1)
+            self.assertEqual(copies(), ['third.txt'])
+
+            resp = self.request(
+                path='/dataset/register/{}/resume'.format(job['_id']),
+                method='POST', user=self.user)
+            self.assertStatusOk(resp)
+            resumed = Job().load(resp.json['_id'], force=True)
+            import_data.run(resumed)
+            resumed = Job().load(resumed['_id'], force=True)
+            self.assertEqual(resumed['status'], JobStatus.SUCCESS)
+            self.assertEqual(len(resumed['wtCheckpoint']['copied']), 2)
+
+        # The resumed job copied the second file only
+        self.assertEqual(copies(), ['fourth.txt', 'third.txt'])
+
+    def testMemberNodes(self):
+        from girder.plugins.wholetale import dataone_register
+        from girder.plugins.wholetale.rest.harvester import _fetch_package
+
+        pid = 'resource_map_urn:uuid:c878ae53-06cf-40c9-a830-7f6f564133f9'
+        docs = copy.deepcopy(D1_MAP['response']['docs'])
+        docs[0]['datasource'] = 'urn:node:KNB'
+        docs[1]['datasource'] = 'urn:node:KNB'
+        docs[1]['replicaMN'] = ['urn:node:KNB', 'urn:node:mnUCSB1']
+        docs[2]['datasource'] = 'urn:node:DOWN'
+        nodeLists = []
+
+        @httmock.urlmatch(scheme='https', netloc='^cn.dataone.org$',
+                          path='^/cn/v2/query/solr/$', method='GET')
+        def mockNodeSearch(url, request):
+            return json.dumps({
+                'response': {'docs': docs, 'numFound': len(docs), 'start': 0},
+                'responseHeader': {'status': 0}
+            })
+
+        @httmock.urlmatch(scheme='https', netloc='^cn.dataone.org$',
+                          path='^/cn/v2/node$', method='GET')
+        def mockNodeList(url, request):
+            nodeLists.append(url.path)
+            return """<?xml version="1.0" encoding="UTF-8"?>
+<ns2:nodeList xmlns:ns2="http://ns.dataone.org/service/types/v2.0">
+  <node type="mn" state="up"><identifier>urn:node:KNB</identifier>
+    <baseURL>https://knb.ecoinformatics.org/knb/d1/mn</baseURL>
+    <services><service name="MNRead" version="v1" available="true"/>
+      <service name="MNRead" version="v2" available="true"/></services>
+  </node>
+  <node type="mn" state="up"><identifier>urn:node:mnUCSB1</identifier>
+    <baseURL>https://mn-ucsb-1.dataone.org/knb/d1/mn/</baseURL>
+    <services><service name="MNRead" version="v1" available="true"/></services>
+  </node>
+  <node type="mn" state="down"><identifier>urn:node:DOWN</identifier>
+    <baseURL>https://down.dataone.org/mn</baseURL>
+    <services><service name="MNRead" version="v2" available="true"/></services>
+  </node>
+  <node type="cn" state="up"><identifier>urn:node:CN</identifier>
+    <baseURL>https://cn.dataone.org/cn</baseURL>
+  </node>
+</ns2:nodeList>"""
+
+        dataone_register._member_nodes.clear()
+        with httmock.HTTMock(mockNodeSearch, mockNodeList, mockResolveDataONE,
+                             self.mockOtherRequest):
+            package = _fetch_package(pid, state={})
+            _fetch_package(pid, state={})
+        self.assertEqual(len(nodeLists), 1)
+
+        urls = {doc['identifier']: doc for doc in
+                package['data'] + [package['metadata']]}
+        resolve = 'https://cn.dataone.org/cn/v2/resolve/'
+        meta = urls[docs[0]['identifier']]
+        self.assertEqual(meta['url'], '{}{}'.format(
+            'https://knb.ecoinformatics.org/knb/d1/mn/v2/object/',
+            docs[0]['identifier']))
+        self.assertEqual(meta['resolveUrl'], resolve + docs[0]['identifier'])
+        replicated = urls[docs[1]['identifier']]
+        self.assertEqual(replicated['replicaUrls'], ['{}{}'.format(
+            'https://mn-ucsb-1.dataone.org/knb/d1/mn/v1/object/',
+            docs[1]['identifier'])])
+        # Objects held by unknown or unavailable nodes go through the CN
+        for doc in docs[2:]:
+            self.assertEqual(urls[doc['identifier']]['url'],
+                             resolve + doc['identifier'])
+            self.assertEqual(urls[doc['identifier']]['replicaUrls'], [])
+        dataone_register._member_nodes.clear()
+
+    def testMetrics(self):
+        from girder.plugins.wholetale import metrics
+        from girder.plugins.wholetale.constants import PluginSettings
+
+        @httmock.urlmatch(scheme='https', netloc='^cn.dataone.org$',
+                          path='^/cn/v2/query/solr/$', method='GET')
+        def mockEmptySearch(url, request):
+            return json.dumps({
+                'response': {'docs': [], 'numFound': 0, 'start': 0},
+                'responseHeader': {'status': 0}
+            })
+
+        @httmock.urlmatch(scheme='http', netloc='^use.yt$', method='HEAD')
+        def mockMissing(url, request):
+            return httmock.response(404, {}, {}, None, 5, request)
+
+        resp = self.request('/repository/metrics', method='DELETE',
+                            user=self.user)
+        self.assertStatus(resp, 403)
+        resp = self.request('/repository/metrics', method='DELETE',
+                            user=self.admin)
+        self.assertStatusOk(resp)
+
+        self.model('setting').set(PluginSettings.SLOW_REQUEST_THRESHOLD, 0)
+        with httmock.HTTMock(mockEmptySearch, mockMissing,
+                             self.mockOtherRequest), \
+                mock.patch.object(metrics.logger, 'warning') as warning:
+            resp = self.request(
+                path='/repository/lookup', method='GET',
+                params={'dataId': json.dumps(['urn:uuid:metrics',
+                                              'http://use.yt/upload/missing'])})
+            self.assertStatusOk(resp)
+        self.model('setting').unset(PluginSettings.SLOW_REQUEST_THRESHOLD)
+
+        self.assertEqual(warning.call_count, 1)
+        message = warning.call_args[0][0]
+        self.assertIn('Slow request repository/lookup', message)
+        self.assertIn('head use.yt [404]: 1 calls', message)
+        self.assertIn('solr cn.dataone.org [200]', message)
+
+        resp = self.request('/repository/metrics', method='GET',
+                            user=self.admin)
+        self.assertStatusOk(resp)
+        calls = {(_['host'], _['endpoint'], _['status']): _
+                 for _ in resp.json['calls']}
+        self.assertEqual(calls[('use.yt', 'head', '404')]['count'], 1)
+        solr = calls[('cn.dataone.org', 'solr', '200')]
+        self.assertGreaterEqual(solr['count'], 1)
+        self.assertEqual(sum(count for bound, count in solr['buckets']),
+                         solr['count'])
+        self.assertLessEqual(solr['p50'], solr['max'])
+
+        with self.assertRaises(Exception):
+            self.model('setting').set(PluginSettings.SLOW_REQUEST_THRESHOLD,
+                                      -1)
+
+    def testRegisterKnownIdentifier(self):
+        from pymongo.errors import DuplicateKeyError
+        from girder.plugins.wholetale.constants import CATALOG_NAME
+        from girder.plugins.wholetale.utils import getOrCreateRootFolder
+
+        url = 'http://use.yt/upload/known.txt'
+        dataMap = [{'dataId': url, 'doi': 'unknown', 'name': 'known.txt',
+                    'repository': 'HTTP', 'size': 42}]
+        heads = []
+
+        @httmock.urlmatch(scheme='http', netloc='^use.yt$', method='HEAD')
+        def mockHead(url, request):
+            heads.append(url.path)
+            if url.path.endswith('missing.txt'):
+                return httmock.response(404, {}, {}, None, 5, request)
+            headers = {'Content-Type': 'text/plain', 'Content-Length': '42'}
+            return httmock.response(200, {}, headers, None, 5, request)
+
+        with httmock.HTTMock(mockHead, self.mockOtherRequest):
+            for name in ('known.txt', 'renamed.txt'):
+                dataMap[0]['name'] = name
+                resp = self.request(
+                    path='/dataset/register', method='POST', user=self.user,
+                    params={'dataMap': json.dumps(dataMap),
+                            'copyToHome': False})
+                self.assertStatusOk(resp)
+
+            # Failures are reported once everything else is registered
+            missing = dict(dataMap[0], name='missing.txt',
+                           dataId='http://use.yt/upload/missing.txt')
+            resp = self.request(
+                path='/dataset/register', method='POST', user=self.user,
+                params={'dataMap': json.dumps([missing] + dataMap),
+                        'copyToHome': False})
+            self.assertStatusOk(resp)
+            self.assertEqual(len(resp.json['failed']), 1)
+            self.assertEqual(resp.json['failed'][0]['dataId'],
+                             'http://use.yt/upload/missing.txt')
+        self.assertEqual(heads, ['/upload/known.txt', '/upload/missing.txt'])
+
+        catalog = getOrCreateRootFolder(CATALOG_NAME)
+        items = list(self.model('folder').childItems(
+            catalog, filters={'name': {'$in': ['known.txt', 'renamed.txt']}}))
+        self.assertEqual(len(items), 1)
+        self.assertEqual(items[0]['wtCatalog'],
+                         {'provider': 'HTTP', 'identifier': url})
+
+        other = self.model('item').createItem('other.txt', self.user, catalog)
+        with self.assertRaises(DuplicateKeyError):
+            self.model('item').collection.update_one(
+                {'_id': other['_id']},
+                {'$set': {'wtCatalog': {'provider': 'HTTP', 'identifier': url}}})
+        self.model('item').remove(other)
+        self.model('item').remove(items[0])
+
+    def testReregistration(self):
+        from girder.plugins.wholetale.constants import PluginSettings
+        from girder.plugins.wholetale.rest.harvester import \
+            register_DataONE_resource
+        from girder.utility.progress import noProgress
+
+        pid = 'resource_map_urn:uuid:c878ae53-06cf-40c9-a830-7f6f564133f9'
+        docs = copy.deepcopy(D1_MAP['response']['docs'])
+        for doc in docs:
+            doc['dateModified'] = '2017-06-01T00:00:00Z'
+            doc['checksum'] = doc['identifier'][-12:]
+        queries = []
+        resolved = []
+
+        @httmock.urlmatch(scheme='https', netloc='^cn.dataone.org$',
+                          path='^/cn/v2/query/solr/$', method='GET')
+        def mockStateSearch(url, request):
+            params = dict(six.moves.urllib.parse.parse_qsl(url.query))
+            queries.append(params['q'])
+            fields = params['fl'].split(',')
+            return json.dumps({
+                'response': {
+                    'docs': [{key: value for key, value in doc.items()
+                              if key in fields} for doc in docs],
+                    'numFound': len(docs), 'start': 0},
+                'responseHeader': {'status': 0}
+            })
+
+        @httmock.urlmatch(scheme='https', netloc='^cn.dataone.org$',
+                          path='^/cn/v2/resolve/', method='GET')
+        def mockCountResolve(url, request):
+            resolved.append(url.path)
+            return mockResolveDataONE(url, request)
+
+        def register():
+            del queries[:]
+            del resolved[:]
+            with httmock.HTTMock(mockStateSearch, mockCountResolve,
+                                 self.mockOtherRequest):
+                folder = register_DataONE_resource(
+                    parent, 'folder', noProgress, self.user, pid)
+            items = self.model('folder').childItems(folder, sort=[('name', 1)])
+            return folder, {item['name']: item['updated'] for item in items}
+
+        self.model('setting').set(PluginSettings.SOLR_CACHE_TTL, 0)
+        parent = self.model('folder').createFolder(
+            self.user, 'Refresh', parentType='user', creator=self.user)
+
+        folder, updated = register()
+        self.assertEqual(len(queries), 2)
+        self.assertEqual(folder['meta']['dataoneState']['resourceMap'], pid)
+        self.assertEqual(folder['meta']['dataoneState']['dateModified'],
+                         '2017-06-01T00:00:00Z')
+        self.assertEqual(len(updated), 3)
+
+        # Nothing changed upstream: a single probe and no writes
+        again, unchanged = register()
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(resolved, [])
+        self.assertEqual(again['_id'], folder['_id'])
+        self.assertEqual(unchanged, updated)
+
+        # A single member changed: only its item is written
+        docs[1]['dateModified'] = '2017-07-01T00:00:00Z'
+        again, changed = register()
+        self.assertEqual(len(queries), 2)
+        self.assertEqual(again['_id'], folder['_id'])
+        self.assertNotEqual(again['meta']['dataoneState']['digest'],
+                            folder['meta']['dataoneState']['digest'])
+        self.assertEqual(
+            sorted(name for name in changed if changed[name] != updated[name]),
+            [docs[1]['fileName']])
+
+        self.model('setting').unset(PluginSettings.SOLR_CACHE_TTL)
+
+    def testResourceMapCache(self):
+        from girder.plugins.wholetale import dataone_register
+        from girder.plugins.wholetale.cache import TTLCache
+
+        pid = 'resource_map_urn:uuid:c878ae53-06cf-40c9-a830-7f6f564133f9'
+        fetched = []
+
+        @httmock.urlmatch(scheme='https', netloc='^cn.dataone.org$',
+                          path='^/cn/v2/resolve/', method='GET')
+        def mockCountResolve(url, request):
+            fetched.append(url.path)
+            return mockResolveDataONE(url, request)
+
+        dataone_register._resource_maps.clear()
+        with httmock.HTTMock(mockCountResolve, self.mockOtherRequest):
+            aggregated = dataone_register.get_aggregated_identifiers(pid)
+            documenting = dataone_register.get_documenting_identifiers(pid)
+        self.assertEqual(len(fetched), 1)
+        self.assertEqual(len(aggregated), 4)
+        self.assertEqual(documenting,
+                         {'urn:uuid:c878ae53-06cf-40c9-a830-7f6f564133f9'})
+
+        cache = TTLCache(maxsize=3, ttl=0.5, getsizeof=len)
+        cache.set('a', 'x')
+        cache.set('b', 'xy')
+        self.assertEqual(cache.get('a'), 'x')
+        cache.set('c', 'z')  # evicts the least recently used 'b'
+        self.assertNotIn('b', cache)
+        self.assertEqual(cache.get('a'), 'x')
+        cache.set('d', 'toolong')  # larger than the cache, never stored
+        self.assertIsNone(cache.get('d'))
+        time.sleep(0.6)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.size, 1)
+
+    def testResourceMapParser(self):
+        from girder.plugins.wholetale.dataone_register import ResourceMap
+
+        data = _load_resource_map()['data']
+        base = ('https://cn.dataone.org/cn/v2/resolve/resource_map_urn%3A'
+                'uuid%3Ac878ae53-06cf-40c9-a830-7f6f564133f9')
+        graph = ResourceMap.from_graph('resource_map', data, base=base)
+        stream = ResourceMap.from_stream(
+            'resource_map', (data[i:i + 128] for i in range(0, len(data), 128)),
+            base=base)
+        for attr in ('aggregated_identifiers', 'documenting_identifiers',
+                     'identifiers'):
+            self.assertEqual(getattr(graph, attr), getattr(stream, attr))
+        self.assertEqual(len(stream.aggregated_identifiers), 4)
+
+    def testSeedCatalog(self):
+        from girder.plugins.jobs.constants import JobStatus
+        from girder.plugins.jobs.models.job import Job
+        from girder.plugins.wholetale.constants import CATALOG_NAME
+        from girder.plugins.wholetale.rest import harvester
+        from girder.plugins.wholetale.tasks import ingest
+        from girder.plugins.wholetale.utils import getOrCreateRootFolder
+
+        catalog = getOrCreateRootFolder(CATALOG_NAME)
+        queries = []
+
+        @httmock.urlmatch(scheme='https', netloc='^cn.dataone.org$',
+                          path='^/cn/v2/query/solr/$', method='GET')
+        def mockSeedSearch(url, request):
+            queries.append(url.query)
+            docs = [
+                {'identifier': 'resource_map_seed_1', 'formatType': 'RESOURCE'},
+                {'identifier': 'seed_1', 'formatType': 'METADATA',
+                 'resourceMap': ['resource_map_seed_1']},
+                {'identifier': 'seed_2', 'formatType': 'METADATA',
+                 'resourceMap': ['resource_map_seed_2']}
+            ]
+            return json.dumps({
+                'response': {'docs': docs, 'numFound': 3, 'start': 0},
+                'responseHeader': {'status': 0}
+            })
+
+        def mockFetch(pid, progress, checkpoint=None, executor=None):
+            return {pid: {'pid': pid, 'children': []}}
+
+        def mockRegister(parent, parentType, progress, user, packages, pid,
+                         name=None, checkpoint=None):
+            return self.model('folder').createFolder(
+                parent, pid, parentType=parentType, creator=user)
+
+        resp = self.request(path='/dataset/ingest', method='POST',
+                            user=self.user, params={'query': 'keywords:seed'})
+        self.assertStatus(resp, 403)
+
+        with httmock.HTTMock(mockSeedSearch, self.mockOtherRequest), \
+                mock.patch.object(Job, 'scheduleJob'), \
+                mock.patch.object(harvester, '_fetch_package_tree',
+                                  side_effect=mockFetch), \
+                mock.patch.object(harvester, '_register_package',
+                                  side_effect=mockRegister) as register:
+            resp = self.request(path='/dataset/ingest', method='POST',
+                                user=self.admin,
+                                params={'query': 'keywords:seed'})
+            self.assertStatusOk(resp)
+            job = Job().load(resp.json['_id'], force=True)
+            self.assertEqual(job['type'], ingest.JOB_TYPE)
+            ingest.run(job)
+
+            # Packages are registered once, and not again by a second run
+            self.assertEqual(register.call_count, 2)
+            job = Job().load(job['_id'], force=True)
+            self.assertEqual(job['status'], JobStatus.SUCCESS)
+            self.assertEqual(job['wtIngest'],
+                             {'lastId': 'seed_2', 'registered': 2, 'failed': 0})
+            resp = self.request(
+                path='/dataset/ingest/{}/resume'.format(job['_id']),
+                method='POST', user=self.admin)
+            self.assertStatus(resp, 400)
+
+            ingest.run(ingest.createIngestJob(self.admin, 'keywords:seed'))
+            self.assertEqual(register.call_count, 2)
+
+            # A resumed job only reads the documents after its cursor
+            ingest.run(ingest.resumeIngestJob(
+                dict(job, status=JobStatus.ERROR), self.admin))
+            self.assertEqual(register.call_count, 2)
+
+        self.assertIn('obsoletedBy', queries[0])
+        self.assertNotIn('TO *]', six.moves.urllib.parse.unquote_plus(
+            queries[0]))
+        self.assertIn('AND id:{"seed_2" TO *]',
+                      six.moves.urllib.parse.unquote_plus(queries[-1]))
+        folders = list(self.model('folder').find(
+            {'parentId': catalog['_id'],
+             'wtCatalog.identifier': {'$regex': '^resource_map_seed_'}}))
+        self.assertEqual(sorted(folder['name'] for folder in folders),
+                         ['resource_map_seed_1', 'resource_map_seed_2'])
+        for folder in folders:
+            self.model('folder').remove(folder)
+
+    def testSolrCache(self):
+        from girder.plugins.wholetale.dataone_register import query
+
+        queries = []
+
+        @httmock.urlmatch(scheme='https', netloc='^cn.dataone.org$',
+                          path='^/cn/v2/query/solr/$', method='GET')
+        def mockCountSearch(url, request):
+            queries.append(url.query)
+            return json.dumps(D1_QUERY)
+
+        resp = self.request('/repository/cache', method='DELETE',
+                            user=self.user)
+        self.assertStatus(resp, 403)
+        resp = self.request('/repository/cache', method='DELETE',
+                            user=self.admin, params={'resetStats': True})
+        self.assertStatusOk(resp)
+
+        q = 'identifier:"urn%3Auuid%3Ac878ae53"'
+        with httmock.HTTMock(mockCountSearch, self.mockOtherRequest):
+            first = query(q, fields=['identifier', 'formatType'])
+            second = query(q, fields=['identifier', 'formatType'])
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(first, second)
+
+        resp = self.request('/repository/cache', method='GET', user=self.admin)
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json, {'entries': 1, 'hits': 1, 'misses': 1})
+
+        resp = self.request('/repository/cache', method='DELETE',
+                            user=self.admin)
+        self.assertStatusOk(resp)
+        with httmock.HTTMock(mockCountSearch, self.mockOtherRequest):
+            query(q, fields=['identifier', 'formatType'])
+        self.assertEqual(len(queries), 2)
+
+        from girder.plugins.wholetale.models.solr_cache import SolrCache
+        self.assertEqual(
+            SolrCache.normalize('https://cn.dataone.org/q/?rows=1&q=a%3Ab'),
+            SolrCache.normalize('https://CN.dataone.org/q/?q=a:b&rows=1'))
+
+    def testSolrStream(self):
+        from girder.plugins.wholetale.dataone_register import SolrStream
+
+        docs = [{'identifier': 'urn:uuid:{}'.format(i),
+                 'title': u'Caf\xe9 "docs": [{}] \\'.format(i)}
+                for i in range(20)]
+        response = {
+            'responseHeader': {'status': 0, 'params': {'q': '"docs":[]'}},
+            'response': {'numFound': 20, 'start': 0, 'docs': docs}
+        }
+        data = json.dumps(response, indent=1).encode('utf8')
+        for size in (1, 7, len(data)):
+            stream = SolrStream(
+                data[i:i + size] for i in range(0, len(data), size))
+            self.assertEqual(stream.content['response'],
+                             {'numFound': 20, 'start': 0, 'docs': []})
+            self.assertEqual(list(stream.docs()), docs)
+
+        error = json.dumps({'responseHeader': {'status': 400},
+                            'error': {'msg': 'undefined field'}})
+        stream = SolrStream([error.encode('utf8')])
+        self.assertEqual(stream.content['error']['msg'], 'undefined field')
+        self.assertEqual(list(stream.docs()), [])
+
+        stream = SolrStream([data[:len(data) // 2]])
+        with self.assertRaises(ValueError):
+            list(stream.docs())
+
+    def testSyncCatalog(self):
+        from girder.plugins.jobs.constants import JobStatus
+        from girder.plugins.jobs.models.job import Job
+        from girder.plugins.wholetale.constants import CATALOG_NAME, \
+            PluginSettings
+        from girder.plugins.wholetale.rest import harvester
+        from girder.plugins.wholetale.tasks import sync
+        from girder.plugins.wholetale.utils import findCatalogEntry, \
+            getOrCreateRootFolder
+
+        docs = [
+            {'identifier': 'resource_map_sync_1', 'formatType': 'RESOURCE'},
+            {'identifier': 'sync_1', 'formatType': 'DATA',
+             'resourceMap': ['resource_map_sync_1']},
+            {'identifier': 'resource_map_sync_2', 'formatType': 'RESOURCE'},
+            {'identifier': 'resource_map_sync_4', 'formatType': 'RESOURCE',
+             'obsoletedBy': 'resource_map_sync_5'}
+        ]
+
+        @httmock.urlmatch(scheme='https', netloc='^cn.dataone.org$',
+                          path='^/cn/v2/query/solr/$', method='GET')
+        def mockSyncSearch(url, request):
+            return json.dumps({
+                'response': {'docs': docs, 'numFound': len(docs), 'start': 0},
+                'responseHeader': {'status': 0}
+            })
+
+        def mockRegister(parent, parentType, progress, user, pid, name=None):
+            return self.model('folder').createFolder(
+                parent, name or pid, parentType=parentType, creator=user,
+                reuseExisting=True)
+
+        catalog = getOrCreateRootFolder(CATALOG_NAME)
+        folders = []
+        # The 3rd package is gone upstream, the 4th one was obsoleted
+        for i, digest in ((1, harvester._package_state(
+                'resource_map_sync_1', docs[:2])['digest']), (2, 'outdated'),
+                (3, 'gone'), (4, 'obsoleted')):
+            folder = self.model('folder').createFolder(
+                catalog, 'Sync {}'.format(i), creator=self.admin)
+            folders.append(self.model('folder').setMetadata(folder, {
+                'provider': 'DataONE', 'dataoneState': {
+                    'resourceMap': 'resource_map_sync_{}'.format(i),
+                    'digest': digest}}))
+
+        resp = self.request(path='/dataset/sync', method='POST',
+                            user=self.user)
+        self.assertStatus(resp, 403)
+
+        with httmock.HTTMock(mockSyncSearch, self.mockOtherRequest), \
+                mock.patch.object(Job, 'scheduleJob'), \
+                mock.patch.object(sync, 'register_DataONE_resource',
+                                  side_effect=mockRegister) as register:
+            resp = self.request(path='/dataset/sync', method='POST',
+                                user=self.admin)
+            self.assertStatusOk(resp)
+            job = Job().load(resp.json['_id'], force=True)
+            self.assertEqual(job['type'], sync.JOB_TYPE)
+            sync.run(job)
+
+            # Only the package that changed upstream is registered again,
+            # along with the new version of the obsoleted one
+            self.assertEqual([args[0][4] for args in register.call_args_list],
+                             ['resource_map_sync_2', 'resource_map_sync_5'])
+            job = Job().load(job['_id'], force=True)
+            self.assertEqual(job['status'], JobStatus.SUCCESS)
+            for folder in folders:
+                folder = self.model('folder').load(folder['_id'], force=True)
+                self.assertIn(sync.SYNC_FIELD, folder)
+            gone, obsoleted = [
+                self.model('folder').load(folder['_id'], force=True)['meta']
+                for folder in folders[2:]]
+            self.assertTrue(gone['dataoneGone'])
+            self.assertEqual(obsoleted['dataoneObsoletedBy'],
+                             'resource_map_sync_5')
+            successor = findCatalogEntry('DataONE', 'resource_map_sync_5')
+            folders.append(successor)
+
+            # The old version is not checked again, and the gone package is
+            # unflagged once it reappears
+            docs.append({'identifier': 'resource_map_sync_3',
+                         'formatType': 'RESOURCE'})
+            sync.run(sync.createSyncJob(self.admin))
+            self.assertEqual(
+                [args[0][4] for args in register.call_args_list[2:]],
+                ['resource_map_sync_2', 'resource_map_sync_3'])
+            self.assertNotIn('dataoneGone', self.model('folder').load(
+                folders[2]['_id'], force=True)['meta'])
+
+            # A sync is scheduled once per interval, by a single process
+            self.assertIsNone(sync.scheduleSync())
+            self.model('setting').set(
+                PluginSettings.CATALOG_SYNC_INTERVAL, 3600)
+            self.assertEqual(sync.scheduleSync()['type'], sync.JOB_TYPE)
+            self.assertIsNone(sync.scheduleSync())
+            self.model('setting').unset(PluginSettings.CATALOG_SYNC_INTERVAL)
+
+        for folder in folders:
+            self.model('folder').remove(folder)
+
     def tearDown(self):
         self.model('user').remove(self.user)
         self.model('user').remove(self.admin)
-        self.patcher.stop()
@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import cherrypy
+from cherrypy.process.plugins import Monitor
 from cryptography.exceptions import UnsupportedAlgorithm
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization
@@ -17,6 +19,7 @@ from girder.utility import assetstore_utilities, setting_utilities
 from girder.utility.model_importer import ModelImporter
 
 from .constants import PluginSettings
+from .http_session import reset_session
 from .rest.dataset import Dataset
 from .rest.recipe import Recipe
 from .rest.image import Image
@@ -25,6 +28,8 @@ from .rest.harvester import listImportedData
 from .rest.tale import Tale
 from .rest.instance import Instance
 from .rest.wholetale import wholeTale
+from .tasks.sync import SYNC_CHECK_FREQUENCY, scheduleSync
+from .utils import ensureCatalogIndices
 
 
 @setting_utilities.validator(PluginSettings.HUB_PRIV_KEY)
@@ -79,6 +84,74 @@ def validateTmpNbUrl(doc):
             'TmpNB URL must not be empty.', 'value')
 
 
+def _numberValidator(key, name, cast, positive):
+    """
+    Register the validator of a numeric setting, which casts its value with
+    ``cast`` (int or float) and rejects negative values, or zero too when
+    ``positive``.
+    """
+    message = '{} must be a {} {}.'.format(
+        name, 'positive' if positive else 'non-negative',
+        'integer' if cast is int else 'number')
+
+    def validate(doc):
+        try:
+            doc['value'] = cast(doc['value'])
+            if doc['value'] < 0 or (positive and not doc['value']):
+                raise ValueError
+        except (TypeError, ValueError):
+            raise ValidationException(message, 'value')
+
+    setting_utilities.registerValidator(key, validate)
+
+
+for _key, _name, _cast, _positive in (
+        (PluginSettings.HTTP_TIMEOUT, 'HTTP timeout', float, True),
+        (PluginSettings.HTTP_POOL_SIZE, 'HTTP pool size', int, True),
+        (PluginSettings.SOLR_CACHE_TTL, 'Solr cache TTL', int, False),
+        (PluginSettings.HTTP_METADATA_CACHE_TTL, 'HTTP metadata cache TTL',
+         int, False),
+        (PluginSettings.SLOW_REQUEST_THRESHOLD, 'Slow request threshold',
+         float, False),
+        (PluginSettings.UPSTREAM_RATE_LIMIT, 'Upstream rate limit', float,
+         False),
+        (PluginSettings.UPSTREAM_CONCURRENCY, 'Upstream concurrency', int,
+         True),
+        (PluginSettings.UPSTREAM_MAX_RETRIES, 'Upstream max retries', int,
+         False),
+        (PluginSettings.CATALOG_SYNC_INTERVAL, 'Catalog sync interval', int,
+         False),
+        (PluginSettings.CATALOG_SYNC_TIME_BUDGET, 'Catalog sync time budget',
+         float, True),
+        (PluginSettings.CATALOG_SYNC_REQUEST_BUDGET,
+         'Catalog sync request budget', int, True),
+        (PluginSettings.PROGRESS_INTERVAL, 'Progress interval', float, False),
+        (PluginSettings.HTTP_DIRECTORY_DEPTH, 'HTTP directory depth', int,
+         False)):
+    _numberValidator(_key, _name, _cast, _positive)
+
+
+@setting_utilities.validator(PluginSettings.UPSTREAM_THROTTLED_HOSTS)
+def validateUpstreamThrottledHosts(doc):
+    if isinstance(doc['value'], six.string_types):
+        doc['value'] = [host.strip() for host in doc['value'].split(',')]
+    if not isinstance(doc['value'], list) or not all(
+            isinstance(host, six.string_types) and host
+            for host in doc['value']):
+        raise ValidationException(
+            'Upstream throttled hosts must be a list of host names.', 'value')
+
+
+def resetHttpSession(event):
+    if event.info.get('key') in (PluginSettings.HTTP_TIMEOUT,
+                                 PluginSettings.HTTP_POOL_SIZE,
+                                 PluginSettings.UPSTREAM_RATE_LIMIT,
+                                 PluginSettings.UPSTREAM_CONCURRENCY,
+                                 PluginSettings.UPSTREAM_MAX_RETRIES,
+                                 PluginSettings.UPSTREAM_THROTTLED_HOSTS):
+        reset_session()
+
+
 @access.public(scope=TokenScope.DATA_READ)
 @loadmodel(model='folder', level=AccessType.READ)
 @describeRoute(
@@ -265,6 +338,7 @@ def load(info):
     events.bind('jobs.job.update.after', 'wholetale', image.updateImageStatus)
     events.unbind('model.user.save.created', CoreEventHandler.USER_DEFAULT_FOLDERS)
     events.bind('model.user.save.created', 'wholetale', addDefaultFolders)
+    events.bind('model.setting.save.after', 'wholetale', resetHttpSession)
     info['apiRoot'].repository = Repository()
     info['apiRoot'].folder.route('GET', ('registered',), listImportedData)
     info['apiRoot'].folder.route('GET', (':id', 'listing'), listFolder)
@@ -276,3 +350,8 @@ def load(info):
     info['apiRoot'].user.route('GET', ('settings',), getUserMetadata)
     ModelImporter.model('user').exposeFields(
         level=AccessType.WRITE, fields=('meta',))
+    ModelImporter.model('folder').ensureIndex(
+        ('meta.dataoneState.resourceMap', {'sparse': True}))
+    ensureCatalogIndices()
+    Monitor(cherrypy.engine, scheduleSync, frequency=SYNC_CHECK_FREQUENCY,
+            name='WholeTale catalog sync').subscribe()
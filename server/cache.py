@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import collections
+import threading
+import time
+
+
+class TTLCache(object):
+    """
+    A thread-safe, in-process LRU cache whose entries expire ``ttl`` seconds
+    after they were stored.
+
+    The cache holds at most ``maxsize`` units, where the size of each value is
+    reported by ``getsizeof`` (every value counts as 1 by default). Least
+    recently used entries are evicted first once that limit is exceeded.
+    """
+
+    def __init__(self, maxsize, ttl, getsizeof=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.getsizeof = getsizeof or (lambda value: 1)
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            return entry is not None and entry[0] > time.time()
+
+    @property
+    def size(self):
+        return self._size
+
+    def _remove(self, key):
+        expires, size, value = self._data.pop(key)
+        self._size -= size
+        return value
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] <= time.time():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def set(self, key, value, ttl=None):
+        size = self.getsizeof(value)
+        if size > self.maxsize:
+            # Would evict everything else and still not fit
+            return
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (expires, size, value)
+            self._size += size
+            while self._size > self.maxsize:
+                self._remove(next(iter(self._data)))
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            return self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._size = 0
+
+    def stats(self):
+        return {'entries': len(self._data), 'size': self._size,
+                'maxsize': self.maxsize, 'hits': self.hits,
+                'misses': self.misses}
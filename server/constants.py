@@ -20,6 +20,20 @@ class PluginSettings:
     TMPNB_URL = 'wholetale.tmpnb_url'
     HUB_PRIV_KEY = 'wholetale.priv_key'
     HUB_PUB_KEY = 'wholetale.pub_key'
+    HTTP_TIMEOUT = 'wholetale.http_timeout'
+    HTTP_POOL_SIZE = 'wholetale.http_pool_size'
+    SOLR_CACHE_TTL = 'wholetale.solr_cache_ttl'
+    HTTP_METADATA_CACHE_TTL = 'wholetale.http_metadata_cache_ttl'
+    SLOW_REQUEST_THRESHOLD = 'wholetale.slow_request_threshold'
+    UPSTREAM_RATE_LIMIT = 'wholetale.upstream_rate_limit'
+    UPSTREAM_CONCURRENCY = 'wholetale.upstream_concurrency'
+    UPSTREAM_MAX_RETRIES = 'wholetale.upstream_max_retries'
+    UPSTREAM_THROTTLED_HOSTS = 'wholetale.upstream_throttled_hosts'
+    CATALOG_SYNC_INTERVAL = 'wholetale.catalog_sync_interval'
+    CATALOG_SYNC_TIME_BUDGET = 'wholetale.catalog_sync_time_budget'
+    CATALOG_SYNC_REQUEST_BUDGET = 'wholetale.catalog_sync_request_budget'
+    PROGRESS_INTERVAL = 'wholetale.progress_interval'
+    HTTP_DIRECTORY_DEPTH = 'wholetale.http_directory_depth'
 
 
 # Constants representing the setting keys for this plugin
@@ -13,18 +13,51 @@ which, after being run, would write a file in the working directory named like
 'wt-package....json'.
 """
 
+import codecs
 import re
 import json
-import six.moves.urllib as urllib
+import threading
+from collections import OrderedDict
 import requests
+import six.moves.urllib as urllib
 import rdflib
+from pymongo.errors import PyMongoError
+from xml.etree import ElementTree
 
 from girder import logger
 from girder.api.rest import RestException
+from girder.utility.model_importer import ModelImporter
+
+from .cache import TTLCache
+from .constants import PluginSettings
+from .http_session import get_session
 
 # http://blog.crossref.org/2015/08/doi-regular-expressions.html
 _DOI_REGEX = re.compile('(10.\d{4,9}/[-._;()/:A-Z0-9]+)', re.IGNORECASE)
+# A complete JSON string literal, quotes included
+_JSON_STRING = re.compile(r'"(?:[^"\\]|\\.)*"')
 D1_BASE = "https://cn.dataone.org/cn/v2"
+# Number of documents requested per page by iter_query
+SOLR_PAGE_SIZE = 1000
+# Sort order used for paged queries, 'id' is the unique key of the D1 index
+SOLR_SORT = "id asc"
+# Maximum number of identifiers OR'ed together in a single Solr query
+LOOKUP_BATCH_SIZE = 50
+# Default time (in seconds) Solr responses are kept in the shared cache
+SOLR_CACHE_TTL = 300
+# Size (in characters) above which Solr responses are not cached, well below
+# the maximum size of a Mongo document
+SOLR_CACHE_MAX_SIZE = 4 * 1024 * 1024
+# Size (in bytes) of the chunks resource maps are parsed in
+RESOURCE_MAP_CHUNK_SIZE = 65536
+# Size (in bytes) of the chunks read from streamed Solr responses
+SOLR_CHUNK_SIZE = 65536
+# Total number of identifiers kept in cached resource maps
+RESOURCE_MAP_CACHE_SIZE = 100000
+# Time (in seconds) a parsed resource map stays in the cache
+RESOURCE_MAP_CACHE_TTL = 3600
+# Time (in seconds) the list of member nodes stays in the cache
+NODE_LIST_CACHE_TTL = 3600
 
 
 def esc(value):
@@ -38,55 +71,313 @@ def unesc(value):
     return urllib.parse.unquote_plus(value)
 
 
-def query(q, fields=["identifier"], rows=1000, start=0):
-    """Query a DataONE Solr index."""
+def _query_url(q, fields, rows, start, sort=None):
+    """Build the URL of a single page of a DataONE Solr query."""
 
     fl = ",".join(fields)
     query_url = "{}/query/solr/?q={}&fl={}&rows={}&start={}&wt=json".format(
         D1_BASE, q, fl, rows, start)
+    if sort is not None:
+        query_url += "&sort={}".format(esc(sort))
+    return query_url
+
+
+def _query_page(q, fields, rows, start, sort=None):
+    """Fetch a single page of results from the DataONE Solr index."""
+
+    query_url = _query_url(q, fields, rows, start, sort)
 
-    req = requests.get(query_url)
-    content = json.loads(req.content.decode('utf8'))
+    cache = ModelImporter.model('solr_cache', 'wholetale')
+    ttl = int(ModelImporter.model('setting').get(
+        PluginSettings.SOLR_CACHE_TTL, default=SOLR_CACHE_TTL))
+    raw = cache.lookup(query_url) if ttl > 0 else None
+    if raw is not None:
+        return json.loads(raw)
+
+    req = get_session().get(query_url)
+    if req.status_code != 200:
+        raise RestException(
+            "Solr query failed ({}).\n{}".format(req.status_code, query_url))
+    raw = req.content.decode('utf8')
+    content = json.loads(raw)
 
     # Fail if the Solr query failed rather than fail later
     if content['responseHeader']['status'] != 0:
         raise RestException(
             "Solr query was not successful.\n{}\n{}".format(query_url, content))
 
-    # Stop if the number of results is equal to the number of rows requested
-    # Fix this in the future by supporting paginated queries.
-    if content['response']['numFound'] == rows:
+    if ttl > 0 and len(raw) <= SOLR_CACHE_MAX_SIZE:
+        try:
+            cache.store(query_url, raw, ttl)
+        except PyMongoError as exc:
+            # The response is still good, only the next lookup misses
+            logger.warning('Could not cache {}: {}'.format(query_url, exc))
+    return content
+
+
+class SolrStream(object):
+    """
+    Incremental decoder of the JSON response of a Solr query.
+
+    The part of the response preceding ``response.docs`` (the response header,
+    ``numFound`` and ``start``) is decoded on creation and exposed as
+    ``content``, with an empty list of docs. The documents themselves are then
+    decoded one at a time by :meth:`docs` as chunks are read, so memory use is
+    bounded by the size of a chunk and of a single document rather than by the
+    size of the page.
+
+    :param chunks: An iterable of byte strings with the response.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._text = codecs.getincrementaldecoder('utf8')()
+        self._json = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        self._in_docs = False
+        self.content = self._read_header()
+
+    def _more(self):
+        """Append the next chunk to the buffer, False if there is none."""
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            return False
+        self._buffer = self._buffer[self._pos:] + self._text.decode(chunk)
+        self._pos = 0
+        return True
+
+    def _char(self, i):
+        """The character at ``i``, reading chunks as needed, or None."""
+        while i >= len(self._buffer):
+            if not self._more():
+                return None
+        return self._buffer[i]
+
+    def _read_header(self):
+        """
+        Scan the response up to the opening bracket of ``response.docs`` and
+        decode what precedes it. Responses without docs (e.g. errors) are
+        decoded whole.
+        """
+        closers = []
+        key = None
+        i = 0
+        while True:
+            char = self._char(i)
+            if char is None:
+                return json.loads(self._buffer)
+            if char == '"':
+                match = _JSON_STRING.match(self._buffer, i)
+                if match is None:
+                    # The string continues in the next chunk
+                    if not self._more():
+                        return json.loads(self._buffer)
+                    continue
+                key = match.group()
+                i = match.end()
+                continue
+            if char in '{[':
+                closers.append('}' if char == '{' else ']')
+            elif char in '}]':
+                closers.pop()
+            elif char == ':' and key == '"docs"' and closers == ['}', '}']:
+                break
+            if not char.isspace() and char != ':':
+                key = None
+            i += 1
+
+        # Skip to the opening bracket of the docs
+        while self._char(i) != '[':
+            if self._char(i) is None:
+                raise ValueError('Truncated Solr response')
+            i += 1
+        header = self._buffer[:i] + '[]' + ''.join(reversed(closers))
+        self._pos = i + 1
+        self._in_docs = True
+        return json.loads(header)
+
+    def docs(self):
+        """Yield the documents of the response as they are decoded."""
+        while self._in_docs:
+            if self._pos == len(self._buffer):
+                if not self._more():
+                    raise ValueError('Truncated Solr response')
+                continue
+            char = self._buffer[self._pos]
+            if char.isspace() or char == ',':
+                self._pos += 1
+            elif char == ']':
+                self._in_docs = False
+            else:
+                try:
+                    doc, end = self._json.raw_decode(self._buffer, self._pos)
+                except ValueError:
+                    # The document continues in the next chunk
+                    if not self._more():
+                        raise
+                    continue
+                self._pos = end
+                yield doc
+
+
+def _stream_page(q, fields, rows, start, sort=None):
+    """
+    Fetch a single page of results from the DataONE Solr index, decoding the
+    documents as they are read off the connection with :class:`SolrStream`.
+
+    The shared Solr cache is bypassed, since caching the page would mean
+    holding all of it in memory.
+
+    :returns: The response (with an empty list of docs) and a generator of
+        the docs. The connection is released once the generator is exhausted
+        or closed.
+    """
+
+    query_url = _query_url(q, fields, rows, start, sort)
+
+    req = get_session().get(query_url, stream=True)
+    try:
+        if req.status_code != 200:
+            raise RestException(
+                "Solr query failed ({}).\n{}".format(req.status_code,
+                                                     query_url))
+        stream = SolrStream(req.iter_content(chunk_size=SOLR_CHUNK_SIZE))
+        content = stream.content
+        if content['responseHeader']['status'] != 0:
+            raise RestException(
+                "Solr query was not successful.\n{}\n{}".format(
+                    query_url, content))
+        if 'docs' not in content.get('response', {}):
+            req.close()
+            return content, iter(())
+    except ValueError as exc:
+        req.close()
         raise RestException(
-            "Number of results returned equals number of rows requested. "
-            "This could mean the query result is truncated. "
-            "Implement paged queries.")
+            "Failed to decode the Solr response: {}\n{}".format(exc, query_url))
+    except Exception:
+        req.close()
+        raise
 
-    return content
+    def docs():
+        try:
+            for doc in stream.docs():
+                yield doc
+        except ValueError as exc:
+            raise RestException(
+                "Failed to decode the Solr response: {}\n{}".format(
+                    exc, query_url))
+        finally:
+            req.close()
 
+    return content, docs()
 
-def find_package_pid(pid):
+
+def query(q, fields=["identifier"], rows=1000, start=0):
+    """Query a DataONE Solr index.
+
+    Only a single page of results is fetched. Use :func:`iter_query` when the
+    number of results may exceed ``rows``.
     """
-    Find the PID of the resource map for a given PID, which may be a resource map
+
+    content = _query_page(q, fields, rows, start)
+
+    # Stop if the result does not fit in the page that was requested
+    if int(content['response']['numFound']) > start + rows:
+        raise RestException(
+            "Number of results exceeds the number of rows requested. "
+            "The query result is truncated, use a paged query instead.")
+
+    return content
+
+
+def iter_query(q, fields=["identifier"], rows=SOLR_PAGE_SIZE, start=0,
+               stream=False):
+    """Iterate over every document matching a DataONE Solr query.
+
+    Results are fetched ``rows`` documents at a time and yielded one by one,
+    so only a single page of the response is held in memory. Pages are sorted
+    on the unique key to keep start/rows paging stable, so that an iteration
+    can be picked up where it stopped by passing the number of documents
+    already seen as ``start``.
+
+    With ``stream``, each page is decoded incrementally as it is received (see
+    :class:`SolrStream`) instead of being read and decoded whole, so that only
+    a single document is held in memory and the first documents are yielded
+    before the page is fully read. Streamed pages are not cached.
     """
 
-    result = query(
-        "identifier:\"{}\"".format(esc(pid)),
-        fields=["identifier", "formatType", "formatId", "resourceMap"])
-    result_len = int(result['response']['numFound'])
+    while True:
+        if stream:
+            content, docs = _stream_page(q, fields, rows, start,
+                                         sort=SOLR_SORT)
+        else:
+            content = _query_page(q, fields, rows, start, sort=SOLR_SORT)
+        if 'response' not in content or 'docs' not in content['response']:
+            raise RestException(
+                "Failed to get a result for the query\n {}".format(content))
+        if not stream:
+            docs = content['response']['docs']
+
+        count = 0
+        for doc in docs:
+            count += 1
+            yield doc
+
+        start += count
+        if not count or start >= int(content['response']['numFound']):
+            return
 
-    if result_len == 0:
+
+def _any_of(field, values):
+    """Build a Solr clause matching any of the given values of a field."""
+
+    return "{}:({})".format(
+        field, " OR ".join("\"{}\"".format(esc(value)) for value in values))
+
+
+def _in_batches(values, resolve):
+    """
+    Call ``resolve`` on chunks of at most LOOKUP_BATCH_SIZE unique values and
+    merge the dicts it returns. If a batched query fails as a whole, each value
+    of the chunk is retried on its own, so that the failure is only reported
+    for the offending value(s).
+    """
+
+    results = {}
+    values = list(OrderedDict.fromkeys(values))
+    for i in range(0, len(values), LOOKUP_BATCH_SIZE):
+        chunk = values[i:i + LOOKUP_BATCH_SIZE]
+        try:
+            results.update(resolve(chunk))
+        except RestException as exc:
+            if len(chunk) == 1:
+                results[chunk[0]] = exc
+                continue
+            for value in chunk:
+                try:
+                    results.update(resolve([value]))
+                except RestException as exc:
+                    results[value] = exc
+    return results
+
+
+def _package_pid(pid, docs):
+    """Find the PID of the resource map given the Solr documents of a PID."""
+
+    if len(docs) == 0:
         raise RestException('No object was found in the index for {}.'.format(pid))
-    elif result_len > 1:
+    elif len(docs) > 1:
         raise RestException(
             'More than one object was found in the index for the identifier '
             '{} which is an unexpected state.'.format(pid))
 
     # Find out if the PID is an OAI-ORE PID and return early if so
-    if result['response']['docs'][0]['formatType'] == 'RESOURCE':
-        return(result['response']['docs'][0]['identifier'])
+    if docs[0]['formatType'] == 'RESOURCE':
+        return docs[0]['identifier']
 
-    if len(result['response']['docs'][0]['resourceMap']) == 1:
-        return result['response']['docs'][0]['resourceMap'][0]
+    if len(docs[0]['resourceMap']) == 1:
+        return docs[0]['resourceMap'][0]
 
     # Error out if the document passed in has multiple resource maps. What I can
     # still do here is determine the most likely resource map given the set.
@@ -96,6 +387,75 @@ def find_package_pid(pid):
         "Multiple resource maps were found and this is not implemented.")
 
 
+def find_package_pid(pid):
+    """
+    Find the PID of the resource map for a given PID, which may be a resource map
+    """
+
+    result = query(
+        "identifier:\"{}\"".format(esc(pid)),
+        fields=["identifier", "formatType", "formatId", "resourceMap"])
+    return _package_pid(pid, result['response']['docs'])
+
+
+def find_package_pids(pids):
+    """
+    Find the resource map PIDs for many PIDs, with one Solr query per
+    LOOKUP_BATCH_SIZE identifiers.
+
+    :returns: A dict mapping each PID to its resource map PID, or to the
+        RestException explaining why it could not be found.
+    """
+
+    def resolve(chunk):
+        docs = {}
+        for doc in iter_query(
+                _any_of("identifier", chunk),
+                fields=["identifier", "formatType", "formatId", "resourceMap"]):
+            docs.setdefault(doc['identifier'], []).append(doc)
+
+        results = {}
+        for pid in chunk:
+            try:
+                results[pid] = _package_pid(pid, docs.get(pid, []))
+            except RestException as exc:
+                results[pid] = exc
+        return results
+
+    return _in_batches(pids, resolve)
+
+
+def find_primary_metadata(package_pids):
+    """
+    Find the primary metadata document, i.e. the one documenting the other
+    members, of many packages with one Solr query per LOOKUP_BATCH_SIZE
+    packages.
+
+    :returns: A dict mapping each package PID to its metadata document, or to
+        the RestException explaining why it could not be found.
+    """
+
+    def resolve(chunk):
+        metadata = {}
+        q = "{} AND formatType:METADATA".format(_any_of("resourceMap", chunk))
+        for doc in iter_query(q, ["identifier", "formatType", "title", "size",
+                                  "documents", "resourceMap"]):
+            if doc['formatType'] != 'METADATA':
+                continue
+            for package_pid in doc.get('resourceMap', []):
+                current = metadata.get(package_pid)
+                if current is None or \
+                        ('documents' in doc and 'documents' not in current):
+                    metadata[package_pid] = doc
+
+        return {
+            pid: metadata.get(pid, RestException('No metadata found.'))
+            for pid in chunk
+        }
+
+    return _in_batches(package_pids, resolve)
+
+
 def find_initial_pid(path):
     """Given some arbitrary path, which may be a landing page, resolve URI or
     something else, find the PID the user intended (the package PID).
@@ -119,29 +479,222 @@ def find_initial_pid(path):
         return path
 
 
-def get_aggregated_identifiers(pid):
-    """Process an OAI-ORE aggregation into a set of aggregated identifiers."""
+_RDF_NS = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#'
+_ORE_AGGREGATES = 'http://www.openarchives.org/ore/terms/aggregates'
+_CITO_IS_DOCUMENTED_BY = 'http://purl.org/spar/cito/isDocumentedBy'
+_DCTERMS_IDENTIFIER = 'http://purl.org/dc/terms/identifier'
+
+
+def _tag(uri):
+    """ElementTree tag of an RDF/XML element for a given property URI"""
+    namespace, name = re.match(r'(.*[#/])([^#/]+)$', uri).groups()
+    return '{{{}}}{}'.format(namespace, name)
+
+
+class _ResourceMapParser(object):
+    """
+    Collects ``ore:aggregates``, ``cito:isDocumentedBy`` and
+    ``dcterms:identifier`` statements from the start/end events of an RDF/XML
+    document.
+    """
+
+    _rdf = '{{{}}}'.format(_RDF_NS)
+
+    def __init__(self, base=None):
+        self.base = base or ''
+        self.relations = {_tag(_ORE_AGGREGATES): set(),
+                          _tag(_CITO_IS_DOCUMENTED_BY): set()}
+        self.identifiers = {}  # subject URI -> set of identifiers
+        self._identifier_tag = _tag(_DCTERMS_IDENTIFIER)
+        self._blank_nodes = 0
+        # A (role, subject, tag) tuple for each open element, where role is
+        # 'root', 'node' or 'property'
+        self._stack = []
+        self._root = None
+
+    def _uri(self, elem):
+        rdf = self._rdf
+        if rdf + 'about' in elem.attrib:
+            return urllib.parse.urljoin(self.base, elem.get(rdf + 'about'))
+        if rdf + 'ID' in elem.attrib:
+            return '{}#{}'.format(self.base, elem.get(rdf + 'ID'))
+        if rdf + 'nodeID' in elem.attrib:
+            return '_:' + elem.get(rdf + 'nodeID')
+        self._blank_nodes += 1
+        return '_:n{}'.format(self._blank_nodes)
+
+    def _add(self, tag, obj):
+        if tag in self.relations:
+            self.relations[tag].add(obj)
+
+    def start(self, elem):
+        rdf = self._rdf
+        role, subject, tag = self._stack[-1] if self._stack else \
+            ('root', None, None)
+        if self._root is None:
+            self._root = elem
+            if elem.tag == rdf + 'RDF':
+                self._stack.append(('root', None, elem.tag))
+                return
+
+        if role != 'node':
+            # A node, which is the object of the enclosing property if any
+            node = self._uri(elem)
+            if role == 'property':
+                self._add(tag, node)
+            self._stack.append(('node', node, elem.tag))
+        elif elem.get(rdf + 'parseType') == 'Resource':
+            # A property whose object is a blank node holding the children
+            node = self._uri(elem)
+            self._add(elem.tag, node)
+            self._stack.append(('node', node, elem.tag))
+        else:
+            if rdf + 'resource' in elem.attrib:
+                self._add(elem.tag, urllib.parse.urljoin(
+                    self.base, elem.get(rdf + 'resource')))
+            elif rdf + 'nodeID' in elem.attrib:
+                self._add(elem.tag, self._uri(elem))
+            self._stack.append(('property', subject, elem.tag))
+
+    def end(self, elem):
+        role, subject, tag = self._stack.pop()
+        text = (elem.text or '').strip()
+        if role == 'property' and tag == self._identifier_tag and text:
+            self.identifiers.setdefault(subject, set()).add(unesc(text))
+        elem.clear()
+        if len(self._stack) == 1:
+            # Drop the top-level nodes that were processed
+            self._root.clear()
+
+    def _identifiers_of(self, subjects):
+        pids = set()
+        for subject in subjects:
+            pids.update(self.identifiers.get(subject, ()))
+        return frozenset(pids)
+
+    @property
+    def aggregated_identifiers(self):
+        return self._identifiers_of(self.relations[_tag(_ORE_AGGREGATES)])
+
+    @property
+    def documenting_identifiers(self):
+        return self._identifiers_of(
+            self.relations[_tag(_CITO_IS_DOCUMENTED_BY)])
+
+    @property
+    def all_identifiers(self):
+        return frozenset(
+            pid for pids in self.identifiers.values() for pid in pids)
+
+
+def parse_resource_map(chunks, base=None):
+    """
+    Stream-parse an OAI-ORE resource map serialized as RDF/XML.
+
+    Only ``ore:aggregates``, ``cito:isDocumentedBy`` and ``dcterms:identifier``
+    statements are collected and every element is discarded as soon as it has
+    been read, so memory use is bounded by the size of the output rather than
+    by the size of the document.
+
+    :param chunks: An iterable of byte strings with the document.
+    :param base: The URL of the document, used to resolve relative URIs.
+    :returns: A tuple of frozensets: the aggregated identifiers, the
+        documenting identifiers and all the identifiers in the resource map.
+    """
+    parser = ElementTree.XMLPullParser(events=('start', 'end'))
+    handler = _ResourceMapParser(base=base)
+    for chunk in chunks:
+        parser.feed(chunk)
+        for event, elem in parser.read_events():
+            getattr(handler, event)(elem)
+    parser.close()
 
-    g = rdflib.Graph()
+    return (handler.aggregated_identifiers, handler.documenting_identifiers,
+            handler.all_identifiers)
 
-    graph_url = "{}/resolve/{}".format(D1_BASE, esc(pid))
-    g.parse(graph_url, format='xml')
 
-    ore_aggregates = rdflib.term.URIRef(
-        'http://www.openarchives.org/ore/terms/aggregates')
-    dcterms_identifier = rdflib.term.URIRef(
-        'http://purl.org/dc/terms/identifier')
+class ResourceMap(object):
+    """
+    An OAI-ORE resource map, downloaded and parsed once.
+
+    Only the sets of identifiers needed during registration are kept, the
+    parsed document itself is discarded.
+    """
 
-    aggregated = g.objects(None, ore_aggregates)
+    def __init__(self, pid, aggregated_identifiers, documenting_identifiers,
+                 identifiers):
+        self.pid = pid
+        self.aggregated_identifiers = aggregated_identifiers
+        self.documenting_identifiers = documenting_identifiers
+        self.identifiers = identifiers
+
+    def __len__(self):
+        return len(self.identifiers)
+
+    @classmethod
+    def from_graph(cls, pid, data, base=None):
+        """Parse a resource map by loading it into an rdflib.Graph."""
+        g = rdflib.Graph()
+        g.parse(data=data, format='xml', publicID=base)
+
+        def _identifiers(objects):
+            pids = set()
+            for obj in objects:
+                pids.update(
+                    unesc(id) for id in g.objects(obj, dcterms_identifier))
+            return frozenset(pids)
+
+        dcterms_identifier = rdflib.term.URIRef(_DCTERMS_IDENTIFIER)
+        return cls(
+            pid,
+            _identifiers(g.objects(None, rdflib.term.URIRef(_ORE_AGGREGATES))),
+            _identifiers(
+                g.objects(None, rdflib.term.URIRef(_CITO_IS_DOCUMENTED_BY))),
+            frozenset(unesc(id) for id in g.objects(None, dcterms_identifier)))
+
+    @classmethod
+    def from_stream(cls, pid, chunks, base=None):
+        """Parse a resource map with :func:`parse_resource_map`."""
+        return cls(pid, *parse_resource_map(chunks, base=base))
+
+    @classmethod
+    def fetch(cls, pid):
+        graph_url = "{}/resolve/{}".format(D1_BASE, esc(pid))
+        req = get_session().get(graph_url, stream=True)
+        try:
+            if req.status_code != 200:
+                raise RestException(
+                    "Failed to fetch the resource map {} ({}).".format(
+                        pid, req.status_code))
+            return cls.from_stream(
+                pid, req.iter_content(chunk_size=RESOURCE_MAP_CHUNK_SIZE),
+                base=req.url)
+        except ElementTree.ParseError as exc:
+            raise RestException(
+                "Failed to parse the resource map {}: {}".format(pid, exc))
+        finally:
+            req.close()
+
+
+# Parsed resource maps, sized by the number of identifiers they hold
+_resource_maps = TTLCache(maxsize=RESOURCE_MAP_CACHE_SIZE,
+                          ttl=RESOURCE_MAP_CACHE_TTL, getsizeof=len)
+
+
+def get_resource_map(pid):
+    """Return the (possibly cached) ResourceMap for a given resource map PID."""
+
+    resource_map = _resource_maps.get(pid)
+    if resource_map is None:
+        resource_map = ResourceMap.fetch(pid)
+        _resource_maps.set(pid, resource_map)
+    return resource_map
 
-    pids = set()
 
-    # Get the PID of the aggregated Objects in the package
-    for object in aggregated:
-        identifiers = g.objects(object, dcterms_identifier)
-        [pids.add(unesc(id)) for id in identifiers]
+def get_aggregated_identifiers(pid):
+    """Process an OAI-ORE aggregation into a set of aggregated identifiers."""
 
-    return pids
+    return set(get_resource_map(pid).aggregated_identifiers)
 
 
 def get_documenting_identifiers(pid):
@@ -150,26 +703,80 @@ def get_documenting_identifiers(pid):
     other members of that resource map.
     """
 
-    g = rdflib.Graph()
+    return set(get_resource_map(pid).documenting_identifiers)
+
+
+# Object endpoints of the member nodes, keyed by node identifier
+_member_nodes = TTLCache(maxsize=1, ttl=NODE_LIST_CACHE_TTL)
+_member_nodes_lock = threading.Lock()
 
-    graph_url = "{}/resolve/{}".format(D1_BASE, esc(pid))
-    g.parse(graph_url, format='xml')
 
-    cito_isDocumentedBy = rdflib.term.URIRef(
-        'http://purl.org/spar/cito/isDocumentedBy')
-    dcterms_identifier = rdflib.term.URIRef(
-        'http://purl.org/dc/terms/identifier')
+def _read_endpoint(node):
+    """The object endpoint of a member node element, preferring MNRead v2."""
+    versions = set(
+        service.get('version') for service in node.iter('service')
+        if service.get('name') == 'MNRead' and
+        service.get('available', 'true') == 'true')
+    for version in ('v2', 'v1'):
+        if version in versions:
+            return '{}/{}/object/'.format(
+                node.findtext('baseURL').rstrip('/'), version)
+
+
+def get_member_nodes():
+    """
+    Return a dict mapping the identifiers of the member nodes that are up to
+    the URL their objects are read from. The node list is fetched from the CN
+    once per NODE_LIST_CACHE_TTL seconds, and is empty if it can't be fetched.
+    """
 
-    documenting = g.objects(None, cito_isDocumentedBy)
+    nodes = _member_nodes.get('nodes')
+    if nodes is not None:
+        return nodes
+    with _member_nodes_lock:
+        nodes = _member_nodes.get('nodes')
+        if nodes is not None:
+            return nodes
+        nodes = {}
+        try:
+            req = get_session().get("{}/node".format(D1_BASE))
+            req.raise_for_status()
+            for node in ElementTree.fromstring(req.content).iter('node'):
+                endpoint = _read_endpoint(node)
+                if node.get('type') == 'mn' and node.get('state', 'up') == 'up' \
+                        and endpoint:
+                    nodes[node.findtext('identifier')] = endpoint
+        except (requests.RequestException, ElementTree.ParseError) as exc:
+            logger.warning('Failed to list DataONE member nodes: {}'.format(exc))
+        _member_nodes.set('nodes', nodes)
+        return nodes
+
+
+def object_locations(doc):
+    """
+    Return the URLs an object can be read from directly, i.e. from the member
+    nodes holding it, the authoritative one first. ``doc`` is the Solr
+    document of the object, with its ``datasource`` and ``replicaMN`` fields.
+    """
 
-    pids = set()
+    node_ids = OrderedDict.fromkeys(
+        ([doc['datasource']] if 'datasource' in doc else []) +
+        doc.get('replicaMN', []))
+    if not node_ids:
+        return []
+    nodes = get_member_nodes()
+    return [nodes[node_id] + urllib.parse.quote(doc['identifier'], safe=':')
+            for node_id in node_ids if node_id in nodes]
 
-    # Get the PID of the documenting Objects in the package
-    for object in documenting:
-        identifiers = g.objects(object, dcterms_identifier)
-        [pids.add(unesc(id)) for id in identifiers]
 
-    return pids
+def _data_map(package_pid, metadata):
+    return {
+        'dataId': package_pid,
+        'size': metadata.get('size', -1),
+        'name': metadata.get('title', 'no title'),
+        'doi': metadata.get('identifier', 'no DOI').split('doi:')[-1],
+        'repository': 'DataONE',
+    }
 
 
 def D1_lookup(path):
@@ -182,27 +789,47 @@ def D1_lookup(path):
     package_pid = find_package_pid(initial_pid)
     logger.debug('Found package PID of {}.'.format(package_pid))
 
-    # query for things in the resource map
-    result = query('resourceMap:"{}"'.format(esc(package_pid)),
-                   ["identifier", "formatType", "title", "size", "formatId",
-                    "fileName", "documents"])
+    # query for things in the resource map, the primary metadata is the one
+    # documenting other objects so stop paging as soon as it turns up
+    metadata = None
+    for doc in iter_query('resourceMap:"{}"'.format(esc(package_pid)),
+                          ["identifier", "formatType", "title", "size",
+                           "formatId", "fileName", "documents"]):
+        if doc['formatType'] != 'METADATA':
+            continue
+        if metadata is None or 'documents' in doc:
+            metadata = doc
+        if 'documents' in doc:
+            break
+
+    if metadata is None:
+        raise RestException('No metadata found.')
 
-    if 'response' not in result or 'docs' not in result['response']:
-        raise RestException(
-            "Failed to get a result for the query\n {}".format(result))
+    return _data_map(package_pid, metadata)
 
-    docs = result['response']['docs']
 
-    # Filter the Solr result by TYPE so we can construct the package
-    metadata = [doc for doc in docs if doc['formatType'] == 'METADATA']
-    if not metadata:
-        raise RestException('No metadata found.')
+def D1_lookup_batch(paths):
+    """
+    Create the maps describing many Data Packages at once. Identifiers are
+    resolved with a few OR'ed Solr queries instead of several queries each.
 
-    dataMap = {
-        'dataId': package_pid,
-        'size': metadata[0].get('size', -1),
-        'name': metadata[0].get('title', 'no title'),
-        'doi': metadata[0].get('identifier', 'no DOI').split('doi:')[-1],
-        'repository': 'DataONE',
-    }
-    return dataMap
+    :returns: An OrderedDict mapping each path to its data map, or to the
+        RestException explaining why it could not be resolved.
+    """
+    initial_pids = OrderedDict(
+        (path, find_initial_pid(path)) for path in paths)
+    package_pids = find_package_pids(initial_pids.values())
+    metadata = find_primary_metadata(
+        [pid for pid in package_pids.values()
+         if not isinstance(pid, RestException)])
+
+    results = OrderedDict()
+    for path, initial_pid in initial_pids.items():
+        package_pid = package_pids[initial_pid]
+        if isinstance(package_pid, RestException):
+            results[path] = package_pid
+        elif isinstance(metadata[package_pid], RestException):
+            results[path] = metadata[package_pid]
+        else:
+            results[path] = _data_map(package_pid, metadata[package_pid])
+    return results
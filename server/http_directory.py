@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Parsing of HTTP directory listings, such as the autoindex pages of Apache and
+nginx or any HTML page linking to the files of a directory.
+
+Only links to the direct children of the listed directory are kept, i.e. the
+parent directory, sorting links (with a query string) and links to other
+locations are skipped. Links ending with a slash are subdirectories.
+"""
+
+from collections import OrderedDict
+
+import six.moves.urllib as urllib
+from six.moves.html_parser import HTMLParser
+
+from girder.api.rest import RestException
+
+from .http_session import get_session
+
+
+# Default number of subdirectory levels crawled below a listing
+DEFAULT_DIRECTORY_DEPTH = 3
+
+
+class _LinkParser(HTMLParser):
+    """Collect the targets of the links of an HTML page."""
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.links = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            href = dict(attrs).get('href')
+            if href:
+                self.links.append(href)
+
+
+def directory_name(url):
+    """The name of the directory at a URL, or its host for a root URL."""
+    parts = urllib.parse.urlsplit(url)
+    return urllib.parse.unquote(
+        parts.path.rstrip('/').rsplit('/', 1)[-1]) or parts.netloc
+
+
+def parse_listing(html, base):
+    """
+    Read the entries of a directory listing.
+
+    :param html: The HTML of the listing.
+    :param base: The URL of the listing.
+    :returns: A list of ``(name, url, isDirectory)``, in the order of the
+        listing and without duplicates.
+    """
+    if not base.endswith('/'):
+        base += '/'
+    parser = _LinkParser()
+    parser.feed(html)
+    parser.close()
+
+    entries = OrderedDict()
+    for href in parser.links:
+        url = urllib.parse.urldefrag(urllib.parse.urljoin(base, href))[0]
+        if not url.startswith(base) or urllib.parse.urlsplit(url).query:
+            continue
+        path = url[len(base):]
+        name = path[:-1] if path.endswith('/') else path
+        if not name or '/' in name:
+            continue
+        entries[url] = (urllib.parse.unquote(name), url, path.endswith('/'))
+    return list(entries.values())
+
+
+def fetch_listing(url):
+    """
+    Download and parse a directory listing, see :func:`parse_listing`.
+
+    :raises: RestException if the URL cannot be reached or is not an HTML
+        page.
+    """
+    req = get_session().get(url)
+    if req.status_code >= 400:
+        raise RestException('{} answered with status {}.'.format(
+            url, req.status_code))
+    if 'html' not in req.headers.get('Content-Type', ''):
+        raise RestException('{} is not a directory listing.'.format(url))
+    return parse_listing(req.text, req.url)
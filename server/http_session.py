@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+A process-wide, connection-pooled HTTP session shared by every outbound call
+the plugin makes (DataONE, arbitrary HTTP resources and GitHub).
+
+Connections are kept alive and reused per host, so a package registration
+issuing hundreds of requests to the same server only pays for a handful of
+TCP/TLS handshakes. Calls are also rate limited, capped and retried per host
+(see :mod:`.throttle`).
+
+The metadata of HTTP resources is looked up with :func:`head`, which caches
+it for all processes and revalidates it with conditional requests.
+"""
+
+import collections
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from six.moves.http_cookiejar import DefaultCookiePolicy
+from six.moves.urllib.parse import urlsplit
+
+from girder.utility.model_importer import ModelImporter
+
+from .constants import PluginSettings
+from .metrics import record_call
+from .throttle import \
+    DEFAULT_CONCURRENCY, \
+    DEFAULT_MAX_RETRIES, \
+    DEFAULT_RATE_LIMIT, \
+    DEFAULT_THROTTLED_HOSTS, \
+    Governor
+
+
+# Default timeout (in seconds) for establishing a connection and waiting
+# for a response
+DEFAULT_TIMEOUT = 60.0
+# Number of hosts for which a connection pool is kept
+DEFAULT_POOL_HOSTS = 16
+# Maximum number of connections kept alive per host
+DEFAULT_POOL_SIZE = 10
+# Default time (in seconds) the metadata of an HTTP resource is fresh
+DEFAULT_METADATA_CACHE_TTL = 300
+# Time (in seconds) stale metadata is kept to be revalidated
+METADATA_RETENTION = 86400
+# Response headers kept in the metadata cache
+METADATA_HEADERS = ('Content-Disposition', 'Content-Length', 'Content-Range',
+                    'Content-Type', 'ETag', 'Last-Modified')
+
+Metadata = collections.namedtuple('Metadata', ['status', 'headers'])
+
+_session = None
+_session_lock = threading.Lock()
+
+
+class _RejectAllCookies(DefaultCookiePolicy):
+    """Keep the shared session stateless, so that it is safe to use it
+    concurrently on behalf of different users."""
+
+    def set_ok(self, cookie, request):
+        return False
+
+    def return_ok(self, cookie, request):
+        return False
+
+
+class PooledSession(requests.Session):
+    """
+    A requests session with per-host connection pools and a default timeout.
+    Calls go through a :class:`.throttle.Governor`, and the latency and
+    outcome of every attempt is recorded (see :mod:`.metrics`), up to the
+    response headers for streamed responses.
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, pool_hosts=DEFAULT_POOL_HOSTS,
+                 pool_size=DEFAULT_POOL_SIZE, rate_limit=DEFAULT_RATE_LIMIT,
+                 concurrency=DEFAULT_CONCURRENCY,
+                 max_retries=DEFAULT_MAX_RETRIES,
+                 throttled_hosts=DEFAULT_THROTTLED_HOSTS):
+        super(PooledSession, self).__init__()
+        self.timeout = timeout
+        self.governor = Governor(rate=rate_limit, concurrency=concurrency,
+                                 max_retries=max_retries,
+                                 throttled_hosts=throttled_hosts)
+        self.cookies.set_policy(_RejectAllCookies())
+        adapter = HTTPAdapter(pool_connections=pool_hosts,
+                              pool_maxsize=pool_size)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.governor.call(
+            urlsplit(url).netloc.lower(),
+            lambda: self._send(method, url, **kwargs))
+
+    def _send(self, method, url, **kwargs):
+        start = time.time()
+        try:
+            response = super(PooledSession, self).request(method, url, **kwargs)
+        except Exception as exc:
+            record_call(method, url, type(exc).__name__, time.time() - start)
+            raise
+        record_call(method, url, response.status_code, time.time() - start)
+        return response
+
+
+def _session_settings():
+    setting = ModelImporter.model('setting')
+    return {
+        'timeout': float(setting.get(PluginSettings.HTTP_TIMEOUT,
+                                     default=DEFAULT_TIMEOUT)),
+        'pool_size': int(setting.get(PluginSettings.HTTP_POOL_SIZE,
+                                     default=DEFAULT_POOL_SIZE)),
+        'rate_limit': float(setting.get(PluginSettings.UPSTREAM_RATE_LIMIT,
+                                        default=DEFAULT_RATE_LIMIT)),
+        'concurrency': int(setting.get(PluginSettings.UPSTREAM_CONCURRENCY,
+                                       default=DEFAULT_CONCURRENCY)),
+        'max_retries': int(setting.get(PluginSettings.UPSTREAM_MAX_RETRIES,
+                                       default=DEFAULT_MAX_RETRIES)),
+        'throttled_hosts': setting.get(
+            PluginSettings.UPSTREAM_THROTTLED_HOSTS,
+            default=list(DEFAULT_THROTTLED_HOSTS)),
+    }
+
+
+def get_session():
+    """Return the shared HTTP session, creating it on first use."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = PooledSession(**_session_settings())
+    return _session
+
+
+def reset_session():
+    """Drop the shared session, e.g. after its settings have changed. A new
+    session is created on next use, requests still in flight finish on the
+    old one."""
+    global _session
+    with _session_lock:
+        _session = None
+
+
+def _metadata_headers(headers):
+    return {name: headers[name] for name in METADATA_HEADERS if name in headers}
+
+
+def head(url):
+    """
+    Look up the metadata of an HTTP resource, with a HEAD request or from the
+    shared cache (see :class:`..models.http_cache.HttpCache`).
+
+    Successful responses are cached for the configured TTL. Stale entries
+    with an ETag or a Last-Modified date are revalidated with a conditional
+    request, and reused as is if the resource did not change.
+
+    :returns: A :class:`Metadata` tuple with the response status and
+        headers.
+    """
+    ttl = int(ModelImporter.model('setting').get(
+        PluginSettings.HTTP_METADATA_CACHE_TTL,
+        default=DEFAULT_METADATA_CACHE_TTL))
+    if ttl <= 0:
+        response = get_session().head(url)
+        return Metadata(response.status_code, response.headers)
+
+    cache = ModelImporter.model('http_cache', 'wholetale')
+    entry = cache.lookup(url)
+    if entry is not None and entry['fresh']:
+        return Metadata(200, CaseInsensitiveDict(entry['headers']))
+
+    conditions = {}
+    if entry is not None:
+        if 'ETag' in entry['headers']:
+            conditions['If-None-Match'] = entry['headers']['ETag']
+        if 'Last-Modified' in entry['headers']:
+            conditions['If-Modified-Since'] = entry['headers']['Last-Modified']
+    response = get_session().head(url, headers=conditions)
+
+    if response.status_code == 304 and conditions:
+        headers = dict(entry['headers'], **_metadata_headers(response.headers))
+        cache.store(url, headers, ttl, retention=METADATA_RETENTION,
+                    revalidated=True)
+        return Metadata(200, CaseInsensitiveDict(headers))
+    if response.ok:
+        headers = _metadata_headers(response.headers)
+        validated = 'ETag' in headers or 'Last-Modified' in headers
+        cache.store(url, headers, ttl,
+                    retention=METADATA_RETENTION if validated else 0)
+    elif entry is not None:
+        cache.forget(url)
+    return Metadata(response.status_code, response.headers)
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Latency and error instrumentation of the outbound HTTP calls made by the
+plugin.
+
+Every call issued through the shared session (see :mod:`.http_session`) is
+recorded in an in-process histogram keyed on the host, the type of endpoint
+(Solr query, resolve, HEAD, ...) and the response status. Calls made while a
+:func:`trace` is active are also attributed to that trace, which logs a
+per-request breakdown when the request is slower than the configured
+threshold.
+"""
+
+import contextlib
+import threading
+import time
+from six.moves.urllib.parse import urlsplit
+
+from girder import logger
+from girder.utility.model_importer import ModelImporter
+
+from .constants import PluginSettings
+
+
+# Upper bounds (in seconds) of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+           30.0, 60.0, float('inf'))
+# Requests taking longer than this many seconds get their breakdown logged
+DEFAULT_SLOW_REQUEST_THRESHOLD = 10.0
+# Maximum number of hosts with their own histograms, calls to further hosts
+# are recorded under OTHER_HOSTS
+MAX_HOSTS = 256
+OTHER_HOSTS = 'other'
+
+
+def endpoint_type(method, url):
+    """Classify an outbound call by the kind of upstream endpoint it hits."""
+    path = urlsplit(url).path
+    if method.upper() == 'HEAD':
+        return 'head'
+    elif '/query/solr' in path:
+        return 'solr'
+    elif '/resolve/' in path:
+        return 'resolve'
+    return 'other'
+
+
+class Histogram(object):
+    """Counts of observed durations per bucket, along with their sum, min
+    and max."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q):
+        """Estimate a quantile as the upper bound of the bucket holding it."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+            'buckets': [[str(bound), count]
+                        for bound, count in zip(self.buckets, self.counts)]
+        }
+
+
+class UpstreamMetrics(object):
+    """
+    Latency histograms of outbound calls, per host, endpoint and status. Only
+    the first MAX_HOSTS hosts since the last reset get their own histograms.
+    """
+
+    def __init__(self):
+        self._histograms = {}
+        self._hosts = set()
+        self._since = time.time()
+        self._lock = threading.Lock()
+
+    def record(self, host, endpoint, status, elapsed):
+        with self._lock:
+            if host not in self._hosts:
+                if len(self._hosts) < MAX_HOSTS:
+                    self._hosts.add(host)
+                else:
+                    host = OTHER_HOSTS
+            key = (host, endpoint, str(status))
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(elapsed)
+
+    def snapshot(self):
+        with self._lock:
+            calls = []
+            for (host, endpoint, status), histogram in sorted(
+                    self._histograms.items()):
+                entry = histogram.summary()
+                entry.update(host=host, endpoint=endpoint, status=status)
+                calls.append(entry)
+            return {'since': self._since, 'calls': calls}
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._hosts.clear()
+            self._since = time.time()
+
+
+upstream = UpstreamMetrics()
+_local = threading.local()
+
+
+class RequestTrace(object):
+    """The outbound calls made on behalf of a single request or job."""
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.time()
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def add(self, host, endpoint, status, elapsed):
+        with self._lock:
+            self.calls.append((host, endpoint, str(status), elapsed))
+
+    def breakdown(self):
+        """Aggregate the calls per host, endpoint and status."""
+        totals = {}
+        with self._lock:
+            for host, endpoint, status, elapsed in self.calls:
+                count, total, slowest = totals.get(
+                    (host, endpoint, status), (0, 0.0, 0.0))
+                totals[(host, endpoint, status)] = (
+                    count + 1, total + elapsed, max(slowest, elapsed))
+        return sorted(totals.items(), key=lambda item: -item[1][1])
+
+    def log(self, elapsed):
+        lines = ['Slow request {} took {:.3f}s, {} outbound calls:'.format(
+            self.name, elapsed, len(self.calls))]
+        for (host, endpoint, status), (count, total, slowest) in \
+                self.breakdown():
+            lines.append(
+                '  {} {} [{}]: {} calls, {:.3f}s total, {:.3f}s max'.format(
+                    endpoint, host, status, count, total, slowest))
+        logger.warning('\n'.join(lines))
+
+
+def _slow_request_threshold():
+    return float(ModelImporter.model('setting').get(
+        PluginSettings.SLOW_REQUEST_THRESHOLD,
+        default=DEFAULT_SLOW_REQUEST_THRESHOLD))
+
+
+@contextlib.contextmanager
+def trace(name):
+    """
+    Attribute the outbound calls made by the current thread, and by callables
+    wrapped with :func:`bind`, to a request named ``name``. The breakdown of
+    those calls is logged if the request exceeds the slow request threshold.
+    """
+    previous = getattr(_local, 'trace', None)
+    current = _local.trace = RequestTrace(name)
+    try:
+        yield current
+    finally:
+        _local.trace = previous
+        elapsed = time.time() - current.start
+        if elapsed > _slow_request_threshold():
+            current.log(elapsed)
+
+
+def bind(func):
+    """
+    Wrap a callable so that, when run in a worker thread, its outbound calls
+    are attributed to the trace active in the calling thread.
+    """
+    current = getattr(_local, 'trace', None)
+    if current is None:
+        return func
+
+    def wrapper(*args, **kwargs):
+        previous = getattr(_local, 'trace', None)
+        _local.trace = current
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.trace = previous
+    return wrapper
+
+
+def record_call(method, url, status, elapsed):
+    """Record an outbound call in the histograms and in the active trace."""
+    host = urlsplit(url).netloc.lower()
+    endpoint = endpoint_type(method, url)
+    upstream.record(host, endpoint, status, elapsed)
+    current = getattr(_local, 'trace', None)
+    if current is not None:
+        current.add(host, endpoint, status, elapsed)
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+from girder.models.model_base import Model
+
+
+_STATS_ID = 'stats'
+
+
+class CacheModel(Model):
+    """
+    Base of the caches shared by all Girder processes using the same database.
+    Entries are removed by a TTL index once their ``expires`` date is past,
+    and the counters listed in ``counters`` are kept in a single document of
+    the same collection.
+
+    Subclasses set ``self.name`` before calling :meth:`initialize`.
+    """
+
+    counters = ('hits', 'misses')
+
+    def initialize(self):
+        self.ensureIndices(
+            (([('expires', 1)], {'expireAfterSeconds': 0}),)
+        )
+
+    def validate(self, doc):
+        return doc
+
+    def _count(self, field):
+        self.collection.update_one(
+            {'_id': _STATS_ID}, {'$inc': {field: 1}}, upsert=True)
+
+    def stats(self):
+        stats = self.collection.find_one({'_id': _STATS_ID}) or {}
+        result = {
+            'entries': self.collection.count({'expires': {'$exists': True}})
+        }
+        result.update((field, stats.get(field, 0)) for field in self.counters)
+        return result
+
+    def purge(self, resetStats=False):
+        """Remove every cached entry and optionally reset the counters."""
+        query = {} if resetStats else {'_id': {'$ne': _STATS_ID}}
+        self.collection.delete_many(query)
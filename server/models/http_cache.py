@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import hashlib
+
+from .cache_base import CacheModel
+
+
+class HttpCache(CacheModel):
+    """
+    Metadata (size, type, name and validators) of HTTP resources, as returned
+    by HEAD requests, shared by all Girder processes using the same database.
+
+    Entries are fresh for a TTL, after which they are revalidated with a
+    conditional request if they carry an ETag or a Last-Modified date. They
+    are kept for ``retention`` seconds past their freshness for that purpose,
+    then removed by a TTL index.
+    """
+
+    counters = ('hits', 'misses', 'revalidated')
+
+    def initialize(self):
+        self.name = 'http_cache'
+        super(HttpCache, self).initialize()
+
+    @staticmethod
+    def _key(url):
+        return hashlib.sha1(url.encode('utf8')).hexdigest()
+
+    def lookup(self, url):
+        """
+        Return the cached entry of a URL, with a ``fresh`` flag telling
+        whether it can be used without revalidation, or None.
+        """
+        now = datetime.datetime.utcnow()
+        doc = self.collection.find_one(
+            {'_id': self._key(url), 'expires': {'$gt': now}})
+        if doc is None:
+            self._count('misses')
+            return None
+        doc['fresh'] = doc['freshUntil'] > now
+        if doc['fresh']:
+            self._count('hits')
+        return doc
+
+    def store(self, url, headers, ttl, retention=0, revalidated=False):
+        """
+        Cache the metadata headers of a URL.
+
+        :param url: The URL of the resource.
+        :type url: str
+        :param headers: The response headers to keep.
+        :type headers: dict
+        :param ttl: Time (in seconds) the entry is fresh.
+        :type ttl: int
+        :param retention: Time (in seconds) the entry is kept once stale, so
+            that it can be revalidated.
+        :type retention: int
+        :param revalidated: Whether the entry was confirmed by a conditional
+            request.
+        :type revalidated: bool
+        """
+        now = datetime.datetime.utcnow()
+        freshUntil = now + datetime.timedelta(seconds=ttl)
+        self.collection.replace_one(
+            {'_id': self._key(url)},
+            {'url': url, 'headers': headers, 'created': now,
+             'freshUntil': freshUntil,
+             'expires': freshUntil + datetime.timedelta(seconds=retention)},
+            upsert=True)
+        if revalidated:
+            self._count('revalidated')
+
+    def forget(self, url):
+        self.collection.delete_one({'_id': self._key(url)})
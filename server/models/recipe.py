@@ -8,6 +8,8 @@ from girder.models.model_base import \
     AccessControlledModel, ValidationException
 from girder.constants import AccessType
 
+from ..http_session import get_session
+
 
 _GIT_REPO_REGEX = re.compile('(\w+://)(.+@)*([\w\d\.]+)(:[\d]+){0,1}/*(.*)')
 
@@ -40,7 +42,7 @@ class Recipe(AccessControlledModel):
                 'URL does not contain repository name: %s.' % recipe['url'],
                 field='url')
         try:
-            resp = requests.get(
+            resp = get_session().get(
                 'https://api.github.com/repos/%s/%s' % (repo[0], repo[1]))
             resp.raise_for_status()
         except requests.HTTPError:
@@ -49,7 +51,7 @@ class Recipe(AccessControlledModel):
                 field='url')
 
         try:
-            resp = requests.get(
+            resp = get_session().get(
                 'https://api.github.com/repos/%s/%s/commits/%s' %
                 (repo[0], repo[1], recipe['commitId']))
             resp.raise_for_status()
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import hashlib
+
+from six.moves.urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from .cache_base import CacheModel
+
+
+class SolrCache(CacheModel):
+    """
+    Responses of the DataONE Solr index shared by all Girder processes using
+    the same database. Entries are keyed on the normalized query URL and are
+    removed by a TTL index once they expire.
+    """
+
+    def initialize(self):
+        self.name = 'solr_cache'
+        super(SolrCache, self).initialize()
+
+    @staticmethod
+    def normalize(url):
+        """Sort the query parameters, so identical queries share an entry."""
+        parts = urlsplit(url)
+        query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+        return urlunsplit((parts.scheme, parts.netloc.lower(), parts.path,
+                           query, ''))
+
+    @classmethod
+    def _key(cls, url):
+        return hashlib.sha1(cls.normalize(url).encode('utf8')).hexdigest()
+
+    def lookup(self, url):
+        """
+        Return the cached response body for a query URL, or None if there is
+        no valid entry.
+        """
+        doc = self.collection.find_one_and_update(
+            {'_id': self._key(url),
+             'expires': {'$gt': datetime.datetime.utcnow()}},
+            {'$inc': {'hits': 1}})
+        self._count('hits' if doc else 'misses')
+        return doc['content'] if doc else None
+
+    def store(self, url, content, ttl):
+        """
+        Cache a response body for ``ttl`` seconds.
+
+        :param url: The Solr query URL.
+        :type url: str
+        :param content: The undecoded response body.
+        :type content: str
+        :param ttl: Time to live in seconds.
+        :type ttl: int
+        """
+        now = datetime.datetime.utcnow()
+        self.collection.replace_one(
+            {'_id': self._key(url)},
+            {'url': self.normalize(url), 'content': content, 'hits': 0,
+             'created': now, 'expires': now + datetime.timedelta(seconds=ttl)},
+            upsert=True)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Coalescing of progress updates.
+
+Registrations report progress for every package and file, and each update of
+a progress context is a write to Mongo (a notification, or the job document
+for jobs). :class:`ThrottledProgress` merges the updates made during an
+interval into a single one, so a large registration costs a few writes per
+second instead of one per file.
+"""
+
+import threading
+import time
+
+
+# Default minimum time (in seconds) between two writes of the progress
+DEFAULT_PROGRESS_INTERVAL = 0.5
+
+
+class ThrottledProgress(object):
+    """
+    Wrap a progress context (a :class:`girder.utility.progress.ProgressContext`
+    or anything with the same ``update`` method) so that it is updated at most
+    once per ``interval`` seconds. It is safe to use from several threads.
+
+    Increments are added up and the last total, current value, message and
+    any other field (e.g. the ``state`` of a notification) are kept, so the
+    wrapped context always ends up with exact counts. Updates
+    passed with ``force=True`` are written right away, and :meth:`flush` (also
+    called when leaving a ``with`` block) writes whatever is pending.
+    """
+
+    def __init__(self, progress, interval=DEFAULT_PROGRESS_INTERVAL):
+        self.progress = progress
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._lastWrite = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.flush()
+
+    def _merge(self, increment, total, current, message, fields):
+        pending = self._pending
+        pending.update(fields)
+        if current is not None:
+            pending.pop('increment', None)
+            pending['current'] = current
+        if increment:
+            if 'current' in pending:
+                pending['current'] += increment
+            else:
+                pending['increment'] = pending.get('increment', 0) + increment
+        if total is not None:
+            pending['total'] = total
+        if message is not None:
+            pending['message'] = message
+
+    def _write(self):
+        if self._pending:
+            self.progress.update(force=True, **self._pending)
+            self._pending = {}
+        self._lastWrite = time.time()
+
+    def update(self, increment=None, total=None, current=None, message=None,
+               force=False, **kwargs):
+        with self._lock:
+            self._merge(increment, total, current, message, kwargs)
+            if force or self._lastWrite is None or \
+                    time.time() - self._lastWrite >= self.interval:
+                self._write()
+
+    def flush(self):
+        """Write the pending updates, if any."""
+        with self._lock:
+            self._write()
@@ -3,17 +3,20 @@
 from girder.api import access
 from girder.api.docs import addModel
 from girder.api.describe import Description, autoDescribeRoute
-from girder.api.rest import Resource
+from girder.api.rest import Resource, RestException
 from girder.constants import AccessType, SortDir, TokenScope
 from girder.models.model_base import ValidationException
+from girder.plugins.jobs.models.job import Job
 from girder.utility import path as path_util
 from girder.utility.progress import ProgressContext
 from ..constants import CATALOG_NAME
+from ..metrics import trace
 from ..schema.misc import dataMapListSchema
 from ..utils import getOrCreateRootFolder
-from .harvester import \
-    register_http_resource, \
-    register_DataONE_resource
+from ..tasks import ingest, sync
+from ..tasks.import_data import JOB_TYPE, createImportJob, isResumable, \
+    resumeImportJob
+from .harvester import copy_to_home, import_data
 
 
 datasetModel = {
@@ -97,6 +100,10 @@ class Dataset(Resource):
         self.route('GET', (':id',), self.getDataset)
         self.route('PUT', (':id',), self.copyDatasetToHome)
         self.route('POST', ('register',), self.importData)
+        self.route('POST', ('register', ':id', 'resume'), self.resumeImport)
+        self.route('POST', ('ingest',), self.ingestCatalog)
+        self.route('POST', ('ingest', ':id', 'resume'), self.resumeIngest)
+        self.route('POST', ('sync',), self.syncCatalog)
 
     @access.public
     @autoDescribeRoute(
@@ -183,7 +190,10 @@ class Dataset(Resource):
                'those references will not delete the underlying data. This '
                'operation is currently only supported for DataONE repositories.\n'
                'If the parentId and the parentType is not provided, data will be '
-               'registered into home directory of the user calling the endpoint')
+               'registered into home directory of the user calling the endpoint.\n'
+               'Resources that could not be registered do not prevent the '
+               'others from being registered, they are listed with the error '
+               'that occurred under "failed" in the response.')
         .param('parentId', 'Parent ID for the new parent of this folder.',
                required=False)
         .param('parentType', "Type of the folder's parent", required=False,
@@ -194,12 +204,17 @@ class Dataset(Resource):
         .param('copyToHome', 'Whether to copy imported data to /User/Data/. '
                'Defaults to True.',
                required=False, dataType='boolean', default=True)
+        .param('asJob', 'Whether to register the data in a background job. '
+               'The job is returned immediately, instead of nothing once the '
+               'data is registered, and can be resumed if it fails. '
+               'Recommended for large data maps. Defaults to False.',
+               required=False, dataType='boolean', default=False)
         .jsonParam('dataMap', 'A list of data mappings',
                    paramType='body', schema=dataMapListSchema)
         .errorResponse('Write access denied for parent collection.', 403)
     )
-    def importData(self, parentId, parentType, public, copyToHome, dataMap,
-                   params):
+    def importData(self, parentId, parentType, public, copyToHome, asJob,
+                   dataMap, params):
         user = self.getCurrentUser()
 
         if not parentId or parentType not in ('folder', 'item'):
@@ -209,35 +224,96 @@ class Dataset(Resource):
             parent = self.model(parentType).load(
                 parentId, user=user, level=AccessType.WRITE, exc=True)
 
+        if asJob:
+            job = createImportJob(user, parent, parentType, dataMap, copyToHome)
+            return Job().filter(job, user)
+
         progress = True
-        importedData = dict(folder=[], item=[])
-        with ProgressContext(progress, user=user,
-                             title='Registering resources') as ctx:
-            for data in dataMap:
-                if data['repository'] == 'DataONE':
-                    importedData['folder'].append(
-                        register_DataONE_resource(
-                            parent, parentType, ctx, user,
-                            data['dataId'], name=data['name'])
-                    )
-                elif data['repository'] == 'HTTP':
-                    importedData['item'].append(
-                        register_http_resource(parent, parentType, ctx, user,
-                                               data['dataId'], data['name'])
-                    )
+        with trace('dataset/register'), \
+                ProgressContext(progress, user=user,
+                                title='Registering resources') as ctx:
+            importedData = import_data(parent, parentType, ctx, user, dataMap)
 
         if copyToHome:
             with ProgressContext(progress, user=user,
                                  title='Copying to workspace') as ctx:
-                userDataFolder = path_util.lookUpPath('/user/%s/Data' % user['login'], user)
-                for folder in importedData['folder']:
-                    self.model('folder').copyFolder(
-                        folder, creator=user, name=folder['name'],
-                        parentType='folder', parent=userDataFolder['document'],
-                        description=folder['description'],
-                        public=folder['public'], progress=ctx)
-                for item in importedData['item']:
-                    self.model('item').copyItem(
-                        item, creator=user, name=item['name'],
-                        folder=userDataFolder['document'],
-                        description=item['description'])
+                copy_to_home(user, importedData, ctx)
+
+        return {'failed': importedData['failed']}
+
+    @access.user(scope=TokenScope.DATA_WRITE)
+    @autoDescribeRoute(
+        Description('Resume a failed or interrupted registration job')
+        .notes('Schedules a new job, which skips every resource and DataONE '
+               'package already registered by the original one.')
+        .modelParam('id', 'The ID of the registration job.', model='job',
+                    plugin='jobs', level=AccessType.WRITE)
+        .errorResponse('ID was invalid.')
+        .errorResponse('The job is not a registration, or it has not failed '
+                       'nor been interrupted.')
+        .errorResponse('Write access was denied for the job.', 403)
+    )
+    def resumeImport(self, job, params):
+        user = self.getCurrentUser()
+        if job['type'] != JOB_TYPE:
+            raise RestException('Job %s is not a registration.' % job['_id'])
+        if not isResumable(job):
+            raise RestException(
+                'Job %s has not failed nor been interrupted.' % job['_id'])
+        return Job().filter(resumeImportJob(job, user), user)
+
+    @access.admin
+    @autoDescribeRoute(
+        Description('Register every DataONE package matching a Solr query '
+                    'into the catalog')
+        .notes('Runs as a job. Matching documents are processed in batches, '
+               'the packages they belong to are registered concurrently and '
+               'packages already in the catalog are skipped. Obsoleted '
+               'versions are left out.')
+        .param('query', 'A DataONE Solr query, e.g. datasource:"urn:node:KNB" '
+               'or keywords:soil.')
+        .param('limit', 'Maximum number of packages to register.',
+               required=False, dataType='integer')
+        .errorResponse('Admin access was denied.', 403)
+    )
+    def ingestCatalog(self, query, limit, params):
+        user = self.getCurrentUser()
+        if limit is not None and limit < 1:
+            raise RestException('Limit must be a positive integer.')
+        return Job().filter(ingest.createIngestJob(user, query, limit=limit),
+                            user)
+
+    @access.admin
+    @autoDescribeRoute(
+        Description('Resume a failed or interrupted catalog ingest job')
+        .notes('Schedules a new job, which starts from the last batch saved '
+               'by the original one.')
+        .modelParam('id', 'The ID of the ingest job.', model='job',
+                    plugin='jobs', level=AccessType.ADMIN)
+        .errorResponse('ID was invalid.')
+        .errorResponse('The job is not an ingest, or it has not failed nor '
+                       'been interrupted.')
+        .errorResponse('Admin access was denied.', 403)
+    )
+    def resumeIngest(self, job, params):
+        user = self.getCurrentUser()
+        if job['type'] != ingest.JOB_TYPE:
+            raise RestException('Job %s is not an ingest.' % job['_id'])
+        if not isResumable(job):
+            raise RestException(
+                'Job %s has not failed nor been interrupted.' % job['_id'])
+        return Job().filter(ingest.resumeIngestJob(job, user), user)
+
+    @access.admin
+    @autoDescribeRoute(
+        Description('Sync the DataONE packages of the catalog with DataONE')
+        .notes('Runs as a job, which registers again the packages that '
+               'changed upstream and the new versions of obsoleted ones, and '
+               'flags the packages gone upstream, within the time and '
+               'request budgets set in the plugin settings. Syncs are also '
+               'scheduled periodically if the sync interval setting is set.')
+        .errorResponse('Admin access was denied.', 403)
+    )
+    def syncCatalog(self, params):
+        user = self.getCurrentUser()
+        return Job().filter(sync.createSyncJob(user), user)
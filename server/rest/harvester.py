@@ -1,74 +1,370 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-import requests
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import six
 
 from girder.api import access
 from girder.api.describe import Description, autoDescribeRoute
 from girder.api.rest import boundHandler, RestException, filtermodel
 from girder.constants import TokenScope
+from girder.utility import path as path_util
 from girder.utility.model_importer import ModelImporter
 from ..dataone_register import \
     D1_BASE, \
     esc, \
-    get_aggregated_identifiers,\
-    get_documenting_identifiers, \
-    query, \
+    get_resource_map, \
+    iter_query, \
+    object_locations, \
     unesc
+from ..http_directory import \
+    DEFAULT_DIRECTORY_DEPTH, \
+    directory_name, \
+    fetch_listing
+from ..http_session import head
+from ..metrics import bind
+from ..constants import CATALOG_NAME, PluginSettings
+from ..progress import DEFAULT_PROGRESS_INTERVAL, ThrottledProgress
+from ..utils import \
+    CATALOG_MODELS, \
+    bulkCreateLinkFiles, \
+    createRegisteredFolder, \
+    findCatalogEntry, \
+    getOrCreateRootFolder, \
+    setCatalogEntry
+
+
+# Maximum number of DataONE packages fetched concurrently
+FETCH_WORKERS = 4
+# Maximum number of HTTP resources probed concurrently
+PROBE_WORKERS = 8
+# Maximum number of DataONE packages and HTTP directories of a data map
+# fetched concurrently, their requests sharing FETCH_WORKERS threads
+PACKAGE_WORKERS = 4
+# Maximum number of link files written with a single batch
+LINK_BATCH = 1000
+# Fields describing the upstream state of a DataONE object
+STATE_FIELDS = ["identifier", "formatType", "dateModified", "checksum",
+                "obsoletedBy"]
+
+
+def _probe_http(url):
+    """
+    HEAD a URL, returns the size and type of the file it points to.
+
+    :raises: An exception if the URL cannot be reached, or does not tell the
+        size of the file.
+    """
+    status, headers = head(url)
+    if status >= 400:
+        raise RestException('{} answered with status {}.'.format(url, status))
+    size = headers.get('Content-Length')
+    if size is None and 'Content-Range' in headers:
+        size = headers['Content-Range'].split('/')[-1]
+    if size is None:
+        raise RestException('The size of {} is unknown.'.format(url))
+    return {'url': url, 'size': int(size),
+            'mimeType': headers.get('Content-Type', 'application/octet-stream')}
+
+
+def _write_http_resources(parent, parentType, user, resources):
+    """
+    Create a link file for each probed resource, with a single batch of writes
+    when registering into a folder.
+
+    :param resources: A list of dicts as returned by :func:`_probe_http`, with
+        an additional ``name`` key.
+    :returns: The list of items, in the order of ``resources``.
+    """
+    meta = {'identifier': 'unknown', 'provider': 'HTTP'}
+    if parentType == 'folder':
+        return bulkCreateLinkFiles(
+            parent, user, [dict(resource, meta=meta) for resource in resources])
+
+    fileModel = ModelImporter.model('file')
+    itemModel = ModelImporter.model('item')
+    items = []
+    for resource in resources:
+        fileDoc = fileModel.createLinkFile(
+            url=resource['url'], parent=parent, name=resource['name'],
+            parentType=parentType, creator=user, size=resource['size'],
+            mimeType=resource['mimeType'], reuseExisting=True)
+        gc_item = itemModel.load(fileDoc['itemId'], force=True)
+        gc_item['meta'] = dict(meta)
+        items.append(itemModel.updateItem(gc_item))
+    return items
 
 
 def register_http_resource(parent, parentType, progress, user, url, name):
     progress.update(increment=1, message='Processing file {}.'.format(url))
-    headers = requests.head(url).headers
-    size = headers.get('Content-Length') or \
-        headers.get('Content-Range').split('/')[-1]
-    fileModel = ModelImporter.model('file')
-    fileDoc = fileModel.createLinkFile(
-        url=url, parent=parent, name=name, parentType=parentType,
-        creator=user, size=int(size),
-        mimeType=headers.get('Content-Type', 'application/octet-stream'),
-        reuseExisting=True)
-    gc_file = fileModel.filter(fileDoc, user)
-
-    gc_item = ModelImporter.model('item').load(
-        gc_file['itemId'], force=True)
-    gc_item['meta'] = {'identifier': 'unknown', 'provider': 'HTTP'}
-    gc_item = ModelImporter.model('item').updateItem(gc_item)
-    return gc_item
-
-
-def register_DataONE_resource(parent, parentType, progress, user, pid, name=None):
-    """Create a package description (Dict) suitable for dumping to JSON."""
-    progress.update(increment=1, message='Processing package {}.'.format(pid))
+    resource = dict(_probe_http(url), name=name)
+    return _write_http_resources(parent, parentType, user, [resource])[0]
+
+
+def _crawl_directory(url, depth, pages, probes, progress, failed):
+    """
+    Crawl a directory listing and its subdirectories down to ``depth`` levels,
+    a level at a time with the listings of a level fetched concurrently by
+    ``pages``. Every file is submitted to ``probes`` as soon as it is listed.
+
+    A subdirectory whose listing cannot be fetched is added to ``failed`` and
+    skipped.
+
+    :returns: The root of the tree of directories, as nested dicts with
+        ``url``, ``name``, ``files`` (a list of ``(name, url, future)``) and
+        ``dirs`` keys.
+    """
+    root = {'url': url, 'name': None, 'files': [], 'dirs': []}
+    seen = {url}
+    level = [root]
+    for levelDepth in range(depth + 1):
+        listings = [(directory, pages.submit(bind(fetch_listing),
+                                             directory['url']))
+                    for directory in level]
+        level = []
+        for directory, future in listings:
+            try:
+                entries = future.result()
+            except Exception as exc:
+                if directory is root:
+                    raise
+                failed.append({'dataId': directory['url'],
+                               'name': directory['name'],
+                               'error': str(exc) or repr(exc)})
+                continue
+            for name, entryUrl, isDirectory in entries:
+                if entryUrl in seen:
+                    continue
+                seen.add(entryUrl)
+                if not isDirectory:
+                    directory['files'].append((name, entryUrl, probes.submit(
+                        bind(_probe_http), entryUrl)))
+                elif levelDepth < depth:
+                    subdirectory = {'url': entryUrl, 'name': name, 'files': [],
+                                    'dirs': []}
+                    directory['dirs'].append(subdirectory)
+                    level.append(subdirectory)
+        progress.update(message='Listed {} directories at depth {}.'.format(
+            len(listings), levelDepth))
+        if not level:
+            break
+    return root
 
-    # query for things in the resource map
-    result = query("resourceMap:\"{}\"".format(esc(pid)),
-                   ["identifier", "formatType", "title", "size", "formatId",
-                    "fileName", "documents"])
 
-    if 'response' not in result or 'docs' not in result['response']:
+def _write_directory(folder, directory, user, progress, failed):
+    """
+    Create the folders and link files of a directory crawled by
+    :func:`_crawl_directory` under ``folder``, with a batch of writes per
+    LINK_BATCH files.
+    """
+    resources = []
+    for name, url, future in directory['files']:
+        progress.update(increment=1, message='Processing file {}.'.format(url))
+        try:
+            resources.append(dict(future.result(), name=name))
+        except Exception as exc:
+            failed.append({'dataId': url, 'name': name,
+                           'error': str(exc) or repr(exc)})
+    meta = {'identifier': 'unknown', 'provider': 'HTTP'}
+    for i in range(0, len(resources), LINK_BATCH):
+        bulkCreateLinkFiles(folder, user, [
+            dict(resource, meta=meta)
+            for resource in resources[i:i + LINK_BATCH]])
+
+    folderModel = ModelImporter.model('folder')
+    for subdirectory in directory['dirs']:
+        subfolder = folderModel.createFolder(
+            folder, subdirectory['name'], parentType='folder', creator=user,
+            reuseExisting=True)
+        _write_directory(subfolder, subdirectory, user, progress, failed)
+
+
+def _check_directory(parentType, url, depth):
+    """
+    Check that a directory can be registered into ``parentType``.
+
+    :returns: The URL of the directory listing and the number of subdirectory
+        levels to register.
+    """
+    if parentType not in ('folder', 'collection', 'user'):
         raise RestException(
-            "Failed to get a result for the query\n {}".format(result))
+            'A directory cannot be registered into a {}.'.format(parentType))
+    if depth is None:
+        depth = int(ModelImporter.model('setting').get(
+            PluginSettings.HTTP_DIRECTORY_DEPTH,
+            default=DEFAULT_DIRECTORY_DEPTH))
+    if not url.endswith('/'):
+        url += '/'
+    return url, depth
+
 
-    docs = result['response']['docs']
+def _write_http_directory(parent, parentType, progress, user, url, name, root,
+                          errors, failed=None):
+    """
+    Write the folder of a directory crawled by :func:`_crawl_directory`, and
+    report the files and subdirectories that could not be registered.
+    """
+    folder = createRegisteredFolder(
+        parent, parentType, name or directory_name(url), user,
+        'HTTPDirectory', url, 'identifier')
+    folder = ModelImporter.model('folder').setMetadata(
+        folder, {'provider': 'HTTPDirectory', 'identifier': url})
+    _write_directory(folder, root, user, progress, errors)
 
-    # Filter the Solr result by TYPE so we can construct the package
-    metadata = [doc for doc in docs if doc['formatType'] == 'METADATA']
-    data = [doc for doc in docs if doc['formatType'] == 'DATA']
-    children = [doc for doc in docs if doc['formatType'] == 'RESOURCE']
+    for error in errors:
+        progress.update(force=True, message='Could not register {}: {}'.format(
+            error['dataId'], error['error']))
+    if failed is not None:
+        failed.extend(errors)
+    return folder
+
+
+def register_http_directory(parent, parentType, progress, user, url,
+                            name=None, depth=None, failed=None,
+                            max_workers=PROBE_WORKERS):
+    """
+    Register an HTTP directory listing (e.g. an Apache or nginx autoindex) as
+    a folder, with a subfolder per subdirectory down to ``depth`` levels and a
+    link file per file.
+
+    Listings are fetched by FETCH_WORKERS threads and files are probed by
+    ``max_workers`` threads while the crawl goes on, then the link files of
+    each folder are written in batches.
+
+    :param depth: Number of subdirectory levels registered, defaults to the
+        ``wholetale.http_directory_depth`` setting.
+    :param failed: Optional list the files and subdirectories that could not
+        be registered are added to, as dicts with ``dataId``, ``name`` and
+        ``error`` keys. They are only reported to ``progress`` otherwise.
+    :returns: The folder of the directory.
+    """
+    url, depth = _check_directory(parentType, url, depth)
+    errors = []
+    progress.update(message='Listing {}.'.format(url))
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as pages, \
+            ThreadPoolExecutor(max_workers=max_workers) as probes:
+        root = _crawl_directory(url, depth, pages, probes, progress, errors)
+        return _write_http_directory(parent, parentType, progress, user, url,
+                                     name, root, errors, failed=failed)
+
+
+def _package_state(pid, docs):
+    """Summarize the Solr documents of a package, see :func:`_probe_package`."""
+    lines = sorted(
+        '|'.join(six.text_type(doc.get(field, '')) for field in STATE_FIELDS)
+        for doc in docs)
+    resourceMap = [doc for doc in docs if unesc(doc['identifier']) == pid]
+    modified = [doc['dateModified'] for doc in docs if 'dateModified' in doc]
+    return {
+        'resourceMap': pid,
+        'digest': hashlib.sha1(
+            '\n'.join(lines).encode('utf8')).hexdigest(),
+        'dateModified': max(modified) if modified else None,
+        'obsoletedBy': resourceMap[0].get('obsoletedBy') if resourceMap else None,
+        'children': [doc['identifier'] for doc in docs
+                     if doc.get('formatType') == 'RESOURCE' and
+                     unesc(doc['identifier']) != pid]
+    }
+
+
+def _probe_package(pid):
+    """
+    Summarize the upstream state of a package, i.e. of its resource map and
+    of everything it aggregates, with a single query for a few small fields.
+
+    :returns: A dict stored as the ``dataoneState`` metadata of the package
+        folder, whose ``digest`` changes whenever any member is modified,
+        added, removed or obsoleted.
+    """
+    docs = list(iter_query(
+        "resourceMap:\"{0}\" OR identifier:\"{0}\"".format(esc(pid)),
+        STATE_FIELDS))
+    return _package_state(pid, docs)
+
+
+def probe_packages(pids):
+    """
+    Summarize the upstream state of several packages at once, like
+    :func:`_probe_package` but with a single paged query.
+
+    :returns: A dict mapping each PID to its state, or to None if nothing is
+        left of the package upstream.
+    """
+    values = " OR ".join("\"{}\"".format(esc(pid)) for pid in pids)
+    docs = {pid: [] for pid in pids}
+    for doc in iter_query(
+            "resourceMap:({0}) OR identifier:({0})".format(values),
+            STATE_FIELDS + ["resourceMap"]):
+        owners = set(doc.get('resourceMap', []))
+        owners.add(unesc(doc['identifier']))
+        for pid in owners.intersection(docs):
+            docs[pid].append(doc)
+    return {pid: _package_state(pid, pidDocs) if pidDocs else None
+            for pid, pidDocs in docs.items()}
+
+
+def _is_registered(state):
+    """Whether a package in this exact state was registered before."""
+    return ModelImporter.model('folder').findOne({
+        'meta.dataoneState.resourceMap': state['resourceMap'],
+        'meta.dataoneState.digest': state['digest']
+    }, fields=['_id']) is not None
+
+
+def _query_package(pid):
+    """
+    Page through the Solr index for everything in the resource map and split
+    the documents by their format type.
+    """
+    metadata = []
+    data = []
+    children = []
+    pids = set()
+    for doc in iter_query("resourceMap:\"{}\"".format(esc(pid)),
+                          ["identifier", "formatType", "title", "size",
+                           "formatId", "fileName", "documents",
+                           "dateModified", "checksum", "datasource",
+                           "replicaMN"], stream=True):
+        pids.add(unesc(doc['identifier']))
+        if doc['formatType'] == 'METADATA':
+            metadata.append(doc)
+        elif doc['formatType'] == 'DATA':
+            data.append(doc)
+        elif doc['formatType'] == 'RESOURCE':
+            children.append(doc)
+    return metadata, data, children, pids
+
+
+def _fetch_package(pid, state=None):
+    """
+    Gather everything needed to register a single DataONE package. This only
+    talks to DataONE and does not write anything to Girder, so it is safe to
+    run in a worker thread.
+
+    Unless the upstream ``state`` of the package is given, the package is
+    probed first, and only its state and children are returned if it was
+    already registered in that state.
+    """
+    if state is None:
+        state = _probe_package(pid)
+        if _is_registered(state):
+            return {'pid': pid, 'state': state, 'children': state['children']}
+
+    metadata, data, children, pids = _query_package(pid)
 
     # Verify what's in Solr is matching
-    aggregation = get_aggregated_identifiers(pid)
-    pids = set([unesc(doc['identifier']) for doc in docs])
+    resource_map = get_resource_map(pid)
 
-    if aggregation != pids:
+    if resource_map.aggregated_identifiers != pids:
         raise RestException(
             "The contents of the Resource Map don't match what's in the Solr "
             "index. This is unexpected and unhandled.")
 
     # Find the primary/documenting metadata so we can later on find the
     # folder name
-    # TODO: Grabs the resmap a second time, fix this
-    documenting = get_documenting_identifiers(pid)
+    documenting = resource_map.documenting_identifiers
 
     # Stop now if multiple objects document others
     if len(documenting) != 1:
@@ -76,14 +372,14 @@ def register_DataONE_resource(parent, parentType, progress, user, pid, name=None
             "Found two objects in the resource map documenting other objects. "
             "This is unexpected and unhandled.")
 
-    # Add in URLs to resolve each metadata/data object by
-    for i in range(len(metadata)):
-        metadata[i]['url'] = \
-            "{}/resolve/{}".format(D1_BASE, metadata[i]['identifier'])
-
-    for i in range(len(data)):
-        data[i]['url'] = \
-            "{}/resolve/{}".format(D1_BASE, data[i]['identifier'])
+    # Add in URLs to read each metadata/data object from. Objects are read
+    # from their member nodes directly when known, the CN resolve URL, which
+    # redirects to one of them, is kept as a fallback.
+    for doc in metadata + data:
+        doc['resolveUrl'] = "{}/resolve/{}".format(D1_BASE, doc['identifier'])
+        locations = object_locations(doc)
+        doc['url'] = locations[0] if locations else doc['resolveUrl']
+        doc['replicaUrls'] = locations[1:]
 
     # Determine the folder name. This is usually the title of the metadata file
     # in the package but when there are multiple metadata files in the package,
@@ -100,43 +396,414 @@ def register_DataONE_resource(parent, parentType, progress, user, pid, name=None
 
     data += [doc for doc in metadata
              if doc['identifier'] != primary_metadata[0]['identifier']]
-    if not name:
-        name = primary_metadata[0]['title']
 
-    gc_folder = ModelImporter.model('folder').createFolder(
-        parent, name, description='',
-        parentType=parentType, creator=user, reuseExisting=True)
+    return {
+        'pid': pid,
+        'state': state,
+        'metadata': primary_metadata[0],
+        'data': data,
+        'children': [child['identifier'] for child in children]
+    }
+
+
+def _fetch_package_tree(pid, progress, max_workers=FETCH_WORKERS,
+                        checkpoint=None, executor=None):
+    """
+    Fetch a package and all of its descendants. Packages are fetched level by
+    level, with every package of a level fetched concurrently by at most
+    ``max_workers`` threads, so the wall time grows with the depth of the
+    hierarchy rather than with the number of child packages. Each package is
+    fetched once, even if it is nested several times or in a cycle.
+
+    Packages already registered according to ``checkpoint`` are not fetched
+    again, their description is taken from the checkpoint instead.
+
+    :param executor: Optional executor shared with other fetches, used instead
+        of a pool of ``max_workers`` threads. This function must not run in
+        one of its threads.
+    :returns: A dict mapping package PIDs to package descriptions.
+    """
+    if executor is None:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return _fetch_package_tree(pid, progress, checkpoint=checkpoint,
+                                       executor=executor)
+
+    def fetch(pid):
+        package = checkpoint.package(pid) if checkpoint else None
+        return package or _fetch_package(pid)
+
+    packages = {pid: executor.submit(bind(fetch), pid).result()}
+    level = packages[pid]['children']
+    while True:
+        # The same package can be nested more than once
+        level = [child for child in OrderedDict.fromkeys(level)
+                 if child not in packages]
+        if not level:
+            break
+        progress.update(message='Fetching {} child packages.'.format(
+            len(level)))
+        nextLevel = []
+        for child, package in zip(level, executor.map(bind(fetch), level)):
+            packages[child] = package
+            nextLevel += package['children']
+        level = nextLevel
+    return packages
+
+
+def _changed_members(folder, files):
+    """Filter out the files whose item metadata is already up to date."""
+    current = {
+        item['meta'].get('identifier'): item['meta']
+        for item in ModelImporter.model('item').find(
+            {'folderId': folder['_id']}, fields=['meta'])
+        if 'meta' in item
+    }
+    return [fileObj for fileObj in files
+            if any(current.get(fileObj['meta']['identifier'], {}).get(key) != value
+                   for key, value in fileObj['meta'].items())]
+
+
+def _write_package(parent, parentType, user, package, name, gc_folder=None):
+    """
+    Create or update the folder of a fetched package, only writing the
+    members that are new or changed upstream.
+    """
+    if gc_folder is None:
+        gc_folder = createRegisteredFolder(
+            parent, parentType, name or package['metadata']['title'], user,
+            'DataONE', package['pid'], 'dataoneState.resourceMap',
+            description='')
+    state = dict(package['state'])
+    state.pop('children')
     gc_folder = ModelImporter.model('folder').setMetadata(
-        gc_folder, {'identifier': primary_metadata[0]['identifier'],
-                    'provider': 'DataONE'})
+        gc_folder, {'identifier': package['metadata']['identifier'],
+                    'provider': 'DataONE',
+                    'dataoneState': state})
+
+    bulkCreateLinkFiles(gc_folder, user, _changed_members(gc_folder, [{
+        'name': fileObj.get('fileName', fileObj['identifier']),
+        'url': fileObj['url'],
+        'size': int(fileObj['size']),
+        'mimeType': fileObj['formatId'],
+        'meta': {key: fileObj[key]
+                 for key in ('identifier', 'dateModified', 'checksum',
+                             'resolveUrl', 'replicaUrls')
+                 if fileObj.get(key)}
+    } for fileObj in package['data']]))
+    return gc_folder
 
-    fileModel = ModelImporter.model('file')
-    itemModel = ModelImporter.model('item')
-    for fileObj in data:
-        try:
-            fileName = fileObj['fileName']
-        except KeyError:
-            fileName = fileObj['identifier']
 
-        gc_item = itemModel.createItem(
-            fileName, user, gc_folder, reuseExisting=True)
-        gc_item = itemModel.setMetadata(
-            gc_item, {'identifier': fileObj['identifier']})
+def _register_package(parent, parentType, progress, user, packages, pid,
+                      name=None, checkpoint=None, ancestors=()):
+    """
+    Write a fetched package and, recursively, its children to Girder. A child
+    that is also one of the ancestors of the package is skipped, so a cycle
+    in the resource maps cannot recurse forever.
+    """
+    progress.update(increment=1, message='Processing package {}.'.format(pid))
+    package = packages[pid]
+
+    if 'folder' in package:
+        # Registered by an earlier run, only its children may be missing
+        gc_folder = package['folder']
+    else:
+        gc_folder = ModelImporter.model('folder').findOne({
+            'parentId': parent['_id'], 'parentCollection': parentType,
+            'meta.dataoneState.resourceMap': pid})
+        state = gc_folder and gc_folder['meta']['dataoneState']
+        if not state or state['digest'] != package['state']['digest']:
+            if 'data' not in package:
+                # Unchanged upstream, but not registered in this parent
+                package.update(_fetch_package(pid, state=package['state']))
+            gc_folder = _write_package(parent, parentType, user, package,
+                                       name, gc_folder=gc_folder)
 
-        fileModel.createLinkFile(
-            url=fileObj['url'], parent=gc_item,
-            name=fileName, parentType='item',
-            creator=user, size=int(fileObj['size']),
-            mimeType=fileObj['formatId'], reuseExisting=True)
+        if checkpoint:
+            checkpoint.markPackage(pid, gc_folder, package['children'])
 
     # Recurse and add child packages if any exist
-    if children is not None and len(children) > 0:
-        for child in children:
-            register_DataONE_resource(gc_folder, 'folder', progress, user,
-                                      child['identifier'])
+    ancestors += (pid,)
+    for child in package['children']:
+        if child not in ancestors:
+            _register_package(gc_folder, 'folder', progress, user, packages,
+                              child, checkpoint=checkpoint, ancestors=ancestors)
     return gc_folder
 
 
+def register_DataONE_resource(parent, parentType, progress, user, pid, name=None,
+                              max_workers=FETCH_WORKERS, checkpoint=None):
+    """
+    Register a DataONE package, and any packages nested in it, as a folder
+    hierarchy of link files.
+
+    Package metadata is fetched from DataONE in parallel (see
+    :func:`_fetch_package_tree`), while all Girder writes happen afterwards in
+    the calling thread, in the order of the original hierarchy.
+
+    :param checkpoint: Optional record of the packages registered so far
+        (see :class:`..tasks.import_data.ImportCheckpoint`). Every package is
+        recorded once written, and packages recorded by an earlier run are
+        skipped.
+    """
+    packages = _fetch_package_tree(pid, progress, max_workers=max_workers,
+                                   checkpoint=checkpoint)
+    return _register_package(parent, parentType, progress, user, packages, pid,
+                             name=name, checkpoint=checkpoint)
+
+
+def _find_entry(data, catalog, progress):
+    """Return ``(modelType, doc)`` if ``data`` is registered in the catalog."""
+    if not catalog:
+        return None
+    doc = findCatalogEntry(data['repository'], data['dataId'])
+    if doc is None:
+        return None
+    progress.update(increment=1, message='Found {} in the catalog.'.format(
+        data['dataId']))
+    return CATALOG_MODELS[data['repository']], doc
+
+
+def _register_http_entries(parent, parentType, progress, user, probes,
+                           catalog, registered, checkpoint=None):
+    """
+    Write the link files of the HTTP data maps probed concurrently by
+    :func:`import_data`, in a single batch.
+
+    :param probes: A list of ``(index, data, future)`` whose futures hold the
+        results of :func:`_probe_http`.
+    :param registered: A dict the ``(modelType, doc)`` of every written entry
+        is added to, keyed on its index.
+    :returns: A list of failures, as dicts with ``dataId``, ``name`` and
+        ``error`` keys.
+    """
+    failed = []
+    resources = OrderedDict()
+    seen = set()
+    duplicates = []
+    for index, data, future in probes:
+        progress.update(increment=1, message='Processing file {}.'.format(
+            data['dataId']))
+        try:
+            resource = future.result()
+        except Exception as exc:
+            failed.append({'dataId': data['dataId'], 'name': data['name'],
+                           'error': str(exc) or repr(exc)})
+            continue
+        if catalog and resource['url'] in seen:
+            # A single entry per identifier in the catalog
+            duplicates.append((index, resource['url']))
+            continue
+        seen.add(resource['url'])
+        resources[index] = dict(resource, name=data['name'])
+
+    items = _write_http_resources(
+        parent, parentType, user, list(resources.values()))
+    byUrl = {}
+    for index, item in zip(resources, items):
+        url = resources[index]['url']
+        if catalog:
+            item = setCatalogEntry(item, 'HTTP', url)
+        byUrl[url] = item
+        registered[index] = ('item', item)
+        if checkpoint:
+            checkpoint.markEntry(index, 'item', item)
+    for index, url in duplicates:
+        registered[index] = ('item', byUrl[url])
+    return failed
+
+
+def _throttled(progress):
+    """
+    Wrap a progress context so that it is written at most once per
+    ``wholetale.progress_interval`` seconds while a registration runs.
+    """
+    interval = float(ModelImporter.model('setting').get(
+        PluginSettings.PROGRESS_INTERVAL, default=DEFAULT_PROGRESS_INTERVAL))
+    return ThrottledProgress(progress, interval)
+
+
+def _fetch_packages(executor, pages, probes, progress, parentType, pending,
+                    checkpoint=None):
+    """
+    Start fetching every DataONE package tree and crawling every HTTP
+    directory of ``pending`` in ``executor``. The requests themselves are
+    made by the ``pages`` and ``probes`` executors shared by all entries, and
+    nothing is written to Girder.
+
+    :returns: A list of ``(index, data, future)``, where entries with the same
+        identifier share the same future. Futures hold the packages fetched by
+        :func:`_fetch_package_tree`, or ``(url, root, errors)`` for a
+        directory crawled by :func:`_crawl_directory`.
+    """
+    def fetch(data):
+        if data['repository'] == 'HTTPDirectory':
+            url, depth = _check_directory(parentType, data['dataId'], None)
+            errors = []
+            progress.update(message='Listing {}.'.format(url))
+            return url, _crawl_directory(url, depth, pages, probes, progress,
+                                         errors), errors
+        return _fetch_package_tree(data['dataId'], progress,
+                                   checkpoint=checkpoint, executor=pages)
+
+    futures = {}
+    submitted = []
+    for index, data in pending:
+        if CATALOG_MODELS[data['repository']] != 'folder':
+            continue
+        if data['dataId'] not in futures:
+            futures[data['dataId']] = executor.submit(bind(fetch), data)
+        submitted.append((index, data, futures[data['dataId']]))
+    return submitted
+
+
+def _write_fetched(parent, parentType, progress, user, data, fetched, catalog,
+                   failed, checkpoint=None):
+    """Write a package or directory fetched by :func:`_fetch_packages`."""
+    if data['repository'] == 'HTTPDirectory':
+        url, root, errors = fetched
+        doc = _write_http_directory(parent, parentType, progress, user, url,
+                                    data['name'], root, errors, failed=failed)
+    else:
+        doc = _register_package(parent, parentType, progress, user, fetched,
+                                data['dataId'], name=data['name'],
+                                checkpoint=checkpoint)
+    if catalog:
+        doc = setCatalogEntry(doc, data['repository'], data['dataId'])
+    return doc
+
+
+def _collect_packages(parent, parentType, progress, user, submitted, catalog,
+                      registered, failed, checkpoint=None):
+    """
+    Wait for the packages and directories started by :func:`_fetch_packages`
+    and write them, in the calling thread, then add them to ``registered``.
+    The files of HTTP directories that could not be registered are added to
+    ``failed``.
+
+    :returns: The exception of the first package that failed, if any.
+    """
+    error = None
+    written = {}
+    for index, data, future in submitted:
+        if data['dataId'] not in written:
+            try:
+                written[data['dataId']] = _write_fetched(
+                    parent, parentType, progress, user, data, future.result(),
+                    catalog, failed, checkpoint=checkpoint)
+            except Exception as exc:
+                written[data['dataId']] = exc
+        doc = written[data['dataId']]
+        if isinstance(doc, Exception):
+            error = error or doc
+            continue
+        registered[index] = ('folder', doc)
+        if checkpoint:
+            checkpoint.markEntry(index, 'folder', doc)
+    return error
+
+
+def import_data(parent, parentType, progress, user, dataMap, checkpoint=None,
+                max_workers=PROBE_WORKERS, package_workers=PACKAGE_WORKERS):
+    """
+    Register every entry of a list of data maps under ``parent``.
+
+    HTTP resources are probed concurrently by ``max_workers`` threads while
+    up to ``package_workers`` DataONE packages and HTTP directories are
+    fetched at once, with FETCH_WORKERS threads making their requests. They
+    are then written in the calling thread, and the link files of HTTP
+    resources in a single batch. A resource
+    that cannot be probed is reported as a failure and does not prevent the
+    other ones from being registered, while a DataONE package that cannot be
+    registered fails the whole import once the other entries are registered.
+
+    When ``parent`` is the catalog, each provider and identifier is registered
+    at most once, and further registrations return the existing entry.
+
+    Updates of ``progress`` are coalesced, see :func:`_throttled`.
+
+    :param checkpoint: Optional record of the entries registered so far.
+        Entries recorded by an earlier run are loaded rather than registered
+        again.
+    :returns: A dict with the lists of registered folders and items, in the
+        order of ``dataMap``, and the list of ``failed`` entries.
+    """
+    catalog = parentType == 'folder' and \
+        parent['_id'] == getOrCreateRootFolder(CATALOG_NAME)['_id']
+    with _throttled(progress) as progress:
+        registered = {}
+        pending = []
+        for index, data in enumerate(dataMap):
+            if data['repository'] not in CATALOG_MODELS:
+                continue
+            entry = checkpoint.entry(index) if checkpoint else None
+            if entry is None:
+                entry = _find_entry(data, catalog, progress)
+            if entry is None:
+                pending.append((index, data))
+            else:
+                registered[index] = entry
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor, \
+                ThreadPoolExecutor(max_workers=FETCH_WORKERS) as pages, \
+                ThreadPoolExecutor(max_workers=package_workers) as packages:
+            futures = {}
+            probes = []
+            for index, data in pending:
+                if data['repository'] == 'HTTP':
+                    url = data['dataId']
+                    if url not in futures:
+                        futures[url] = executor.submit(bind(_probe_http), url)
+                    probes.append((index, data, futures[url]))
+            submitted = _fetch_packages(
+                packages, pages, executor, progress, parentType, pending,
+                checkpoint=checkpoint)
+            failed = []
+            error = _collect_packages(
+                parent, parentType, progress, user, submitted, catalog,
+                registered, failed, checkpoint=checkpoint)
+            failed.extend(_register_http_entries(
+                parent, parentType, progress, user, probes, catalog, registered,
+                checkpoint=checkpoint))
+    if error is not None:
+        raise error
+
+    importedData = dict(folder=[], item=[], failed=failed)
+    for index in sorted(registered):
+        modelType, doc = registered[index]
+        importedData[modelType].append(doc)
+    return importedData
+
+
+def copy_to_home(user, importedData, progress, checkpoint=None):
+    """
+    Copy registered folders and items into the user's Data folder.
+
+    :param checkpoint: Optional record of the folders and items copied so far,
+        those are not copied again.
+    """
+    userDataFolder = path_util.lookUpPath('/user/%s/Data' % user['login'], user)
+    with _throttled(progress) as progress:
+        for folder in importedData['folder']:
+            if checkpoint and checkpoint.copied(folder):
+                continue
+            ModelImporter.model('folder').copyFolder(
+                folder, creator=user, name=folder['name'],
+                parentType='folder', parent=userDataFolder['document'],
+                description=folder['description'],
+                public=folder['public'], progress=progress)
+            if checkpoint:
+                checkpoint.markCopied(folder)
+    for item in importedData['item']:
+        if checkpoint and checkpoint.copied(item):
+            continue
+        ModelImporter.model('item').copyItem(
+            item, creator=user, name=item['name'],
+            folder=userDataFolder['document'],
+            description=item['description'])
+        if checkpoint:
+            checkpoint.markCopied(item)
+
+
 @access.user(scope=TokenScope.DATA_READ)
 @filtermodel(model='folder')
 @autoDescribeRoute(
@@ -1,14 +1,35 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import json
 import os
 import re
-import requests
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from urllib.parse import urlparse
 from girder.api import access
 from girder.api.describe import Description, autoDescribeRoute
 from girder.api.docs import addModel
-from girder.api.rest import Resource, RestException
-from ..dataone_register import D1_lookup
+from girder.api.rest import Resource, RestException, setResponseHeader
+from ..cache import TTLCache
+from ..dataone_register import D1_lookup_batch
+from ..http_directory import directory_name
+from ..http_session import get_session, head
+from ..metrics import bind, trace, upstream
+
+
+# Number of threads shared by all lookups of the process
+LOOKUP_WORKERS = 8
+# Time (in seconds) an identifier that could not be resolved is not retried
+NEGATIVE_CACHE_TTL = 60
+# Maximum number of identifiers remembered as unresolvable
+NEGATIVE_CACHE_SIZE = 10000
+# Hosts whose URLs identify DataONE objects rather than files
+DATAONE_HOSTS = ('search.dataone.org', 'cn.dataone.org', 'doi.org',
+                 'dx.doi.org')
+_DOI_REGEX = re.compile(r'10\.\d{4,9}/')
+
+_executor = ThreadPoolExecutor(max_workers=LOOKUP_WORKERS)
+_unresolved = TTLCache(maxsize=NEGATIVE_CACHE_SIZE, ttl=NEGATIVE_CACHE_TTL)
 
 
 dataMap = {
@@ -22,7 +43,9 @@ dataMap = {
         },
         'repository': {
             'type': 'string',
-            'description': 'Name of a data repository holding the dataset.'
+            'description': ('Name of a data repository holding the dataset: '
+                            'DataONE, HTTP (a file) or HTTPDirectory (a '
+                            'directory listing).')
         },
         'doi': {
             'type': 'string',
@@ -56,7 +79,13 @@ def _http_lookup(pid):
     url = urlparse(pid)
     if url.scheme not in ('http', 'https'):
         return
-    headers = requests.head(pid).headers
+    headers = head(pid).headers
+
+    if url.path.endswith('/') and \
+            headers.get('Content-Type', '').startswith('text/html'):
+        # Most likely a directory listing, its size is only known once crawled
+        return dict(dataId=pid, doi='unknown', name=directory_name(pid),
+                    repository='HTTPDirectory', size=0)
 
     valid_target = headers.get('Content-Type') is not None
     valid_target = valid_target and ('Content-Length' in headers or
@@ -79,6 +108,66 @@ def _http_lookup(pid):
                 size=int(size))
 
 
+def resolvers(pid):
+    """
+    Tell which repositories may resolve an identifier.
+
+    URLs are files to be probed, unless they point to DataONE or to a DOI
+    resolver. URLs embedding a DOI may be either. Anything else (DOIs, UUIDs,
+    ...) can only be a DataONE identifier.
+
+    :returns: A tuple of 'DataONE' and/or 'HTTP'.
+    """
+    url = urlparse(pid)
+    if url.scheme not in ('http', 'https'):
+        return ('DataONE',)
+    if url.netloc.lower() in DATAONE_HOSTS:
+        return ('DataONE',)
+    if _DOI_REGEX.search(pid):
+        return ('DataONE', 'HTTP')
+    return ('HTTP',)
+
+
+def _lookup(dataId):
+    """
+    Resolve identifiers concurrently, each one only by the repositories that
+    may know it (see :func:`resolvers`).
+
+    :returns: A generator of ``(pid, dataMap)`` in the order identifiers are
+        resolved, where ``dataMap`` is None if a repository could not resolve
+        ``pid``.
+    """
+    pending = {'DataONE': [], 'HTTP': []}
+    for pid in dataId:
+        for repository in resolvers(pid):
+            if (repository, pid) not in _unresolved:
+                pending[repository].append(pid)
+
+    futures = {_executor.submit(bind(_http_lookup), pid): pid
+               for pid in pending['HTTP']}
+    if pending['DataONE']:
+        # DataONE identifiers are resolved together, in a few queries
+        futures[_executor.submit(
+            bind(D1_lookup_batch), pending['DataONE'])] = None
+
+    for future in as_completed(futures):
+        pid = futures[future]
+        if pid is None:
+            for pid, dataMap in future.result().items():
+                if isinstance(dataMap, RestException):
+                    _unresolved.set(('DataONE', pid), True)
+                    dataMap = None
+                yield pid, dataMap
+            continue
+        try:
+            dataMap = future.result()
+        except RestException:
+            dataMap = None
+        if not dataMap:
+            _unresolved.set(('HTTP', pid), True)
+        yield pid, dataMap or None
+
+
 class Repository(Resource):
 
     def __init__(self):
@@ -86,6 +175,10 @@ class Repository(Resource):
         self.resourceName = 'repository'
 
         self.route('GET', ('lookup',), self.lookupData)
+        self.route('GET', ('cache',), self.getCacheStats)
+        self.route('DELETE', ('cache',), self.purgeCache)
+        self.route('GET', ('metrics',), self.getMetrics)
+        self.route('DELETE', ('metrics',), self.resetMetrics)
 
     @access.public
     @autoDescribeRoute(
@@ -95,21 +188,72 @@ class Repository(Resource):
                'along with a basic metadata, such as size, name.')
         .jsonParam('dataId', paramType='query', required=True,
                    description='List of external datasets identificators.')
+        .param('stream', 'Whether to stream the data maps as newline '
+               'delimited JSON, in the order they are resolved, followed by '
+               'a summary record. Defaults to False.',
+               required=False, dataType='boolean', default=False)
         .responseClass('dataMap', array=True))
-    def lookupData(self, dataId, params):
-        from concurrent.futures import ThreadPoolExecutor, as_completed
-        results = []
-        futures = {}
-        with ThreadPoolExecutor(max_workers=4) as executor:
-            for pid in dataId:
-                futures[executor.submit(D1_lookup, pid)] = pid
-                futures[executor.submit(_http_lookup, pid)] = pid
-
-            for future in as_completed(futures):
-                try:
-                    if future.result():
-                        results.append(future.result())
-                except RestException:
-                    pass
-
-            return sorted(results, key=lambda k: k['name'])
+    def lookupData(self, dataId, stream, params):
+        if stream:
+            setResponseHeader('Content-Type', 'application/x-ndjson')
+
+            def records():
+                start = time.time()
+                resolved = set()
+                with trace('repository/lookup'):
+                    for pid, dataMap in _lookup(dataId):
+                        if dataMap:
+                            resolved.add(pid)
+                            yield (json.dumps(dataMap) + '\n').encode('utf8')
+                summary = {
+                    'resolved': len(resolved),
+                    'unresolved': [pid for pid in dataId if pid not in resolved],
+                    'seconds': time.time() - start
+                }
+                yield (json.dumps({'summary': summary}) + '\n').encode('utf8')
+            return records
+
+        with trace('repository/lookup'):
+            results = [dataMap for pid, dataMap in _lookup(dataId) if dataMap]
+        return sorted(results, key=lambda k: k['name'])
+
+    @access.admin
+    @autoDescribeRoute(
+        Description('Get statistics of the shared DataONE Solr cache.')
+        .errorResponse('Admin access was denied.', 403)
+    )
+    def getCacheStats(self, params):
+        return self.model('solr_cache', 'wholetale').stats()
+
+    @access.admin
+    @autoDescribeRoute(
+        Description('Remove all cached DataONE Solr responses.')
+        .param('resetStats', 'Whether hit/miss counters should be reset too.',
+               required=False, dataType='boolean', default=False)
+        .errorResponse('Admin access was denied.', 403)
+    )
+    def purgeCache(self, resetStats, params):
+        self.model('solr_cache', 'wholetale').purge(resetStats=resetStats)
+
+    @access.admin
+    @autoDescribeRoute(
+        Description('Get latency histograms of the calls made to external '
+                    'repositories.')
+        .notes('Calls are grouped by host, endpoint type (solr, resolve, head '
+               'or other) and response status, or exception name for calls '
+               'that failed. Durations are in seconds. The current rate '
+               'limit, concurrency and throttling counts are listed per host.')
+        .errorResponse('Admin access was denied.', 403)
+    )
+    def getMetrics(self, params):
+        metrics = upstream.snapshot()
+        metrics['hosts'] = get_session().governor.stats()
+        return metrics
+
+    @access.admin
+    @autoDescribeRoute(
+        Description('Reset the latency histograms of external calls.')
+        .errorResponse('Admin access was denied.', 403)
+    )
+    def resetMetrics(self, params):
+        upstream.reset()
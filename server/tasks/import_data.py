@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Registration of external data as a local job of the jobs plugin.
+
+The job records every registered data map entry and DataONE package, as well
+as every folder and item copied to the user's workspace, on the job document
+itself (under ``wtCheckpoint``), so that a job which failed or
+was interrupted by a restart can be resumed by a new job that skips
+everything already written to Girder.
+"""
+
+import datetime
+import sys
+import traceback
+
+from girder.plugins.jobs.constants import JobStatus
+from girder.plugins.jobs.models.job import Job
+from girder.utility.model_importer import ModelImporter
+
+from ..metrics import trace
+from ..rest.harvester import copy_to_home, import_data
+
+
+JOB_TYPE = 'wholetale.import_data'
+CHECKPOINT_FIELD = 'wtCheckpoint'
+# Time (in seconds) after which a running job that has not been updated is
+# deemed interrupted, e.g. by a restart of the server
+STALE_JOB_TIMEOUT = 600
+
+
+def isResumable(job):
+    """
+    Whether a job can be resumed: it failed, was canceled, or is still marked
+    as running but has not been updated for STALE_JOB_TIMEOUT seconds.
+    """
+    if job['status'] in (JobStatus.ERROR, JobStatus.CANCELED):
+        return True
+    return job['status'] == JobStatus.RUNNING and \
+        datetime.datetime.utcnow() - job['updated'] > \
+        datetime.timedelta(seconds=STALE_JOB_TIMEOUT)
+
+
+class JobProgress(object):
+    """
+    Report progress to a job, using the same interface as
+    :class:`girder.utility.progress.ProgressContext`.
+    """
+
+    def __init__(self, job):
+        self.job = job
+        self.total = 0
+        self.current = 0
+
+    def update(self, increment=None, total=None, current=None, message=None,
+               **kwargs):
+        if total is not None:
+            self.total = total
+        if current is not None:
+            self.current = current
+        if increment:
+            self.current += increment
+        self.job = Job().updateJob(
+            self.job, log=message + '\n' if message else None,
+            progressTotal=max(self.total, self.current),
+            progressCurrent=self.current, progressMessage=message)
+
+
+class ImportCheckpoint(object):
+    """
+    What an import job has registered so far. Entries are appended to the job
+    document as soon as they are written, packages are stored as a list since
+    DataONE identifiers may contain characters not allowed in Mongo keys.
+    """
+
+    def __init__(self, job):
+        self.job = job
+        state = job.get(CHECKPOINT_FIELD, {})
+        self._entries = {entry['index']: entry
+                         for entry in state.get('entries', [])}
+        self._packages = {package['pid']: package
+                          for package in state.get('packages', [])}
+        self._copied = set(state.get('copied', []))
+
+    def _push(self, field, value):
+        Job().collection.update_one(
+            {'_id': self.job['_id']},
+            {'$push': {'.'.join((CHECKPOINT_FIELD, field)): value},
+             '$set': {'updated': datetime.datetime.utcnow()}})
+
+    def entry(self, index):
+        """
+        Return ``(modelType, doc)`` for a data map entry registered by an
+        earlier run, or None if it has to be registered.
+        """
+        entry = self._entries.get(index)
+        if entry is None:
+            return None
+        doc = ModelImporter.model(entry['modelType']).load(
+            entry['id'], force=True)
+        return None if doc is None else (entry['modelType'], doc)
+
+    def markEntry(self, index, modelType, doc):
+        entry = {'index': index, 'modelType': modelType, 'id': doc['_id']}
+        self._entries[index] = entry
+        self._push('entries', entry)
+
+    def package(self, pid):
+        """
+        Return the description of a DataONE package registered by an earlier
+        run, or None if it has to be fetched and registered.
+        """
+        package = self._packages.get(pid)
+        if package is None:
+            return None
+        folder = ModelImporter.model('folder').load(
+            package['folderId'], force=True)
+        if folder is None:
+            # Removed since, register it again
+            return None
+        return {'pid': pid, 'folder': folder, 'children': package['children']}
+
+    def markPackage(self, pid, folder, children):
+        package = {'pid': pid, 'folderId': folder['_id'],
+                   'children': list(children)}
+        self._packages[pid] = package
+        self._push('packages', package)
+
+    def copied(self, doc):
+        """Whether a registered folder or item was copied by an earlier run."""
+        return doc['_id'] in self._copied
+
+    def markCopied(self, doc):
+        self._copied.add(doc['_id'])
+        self._push('copied', doc['_id'])
+
+
+def createImportJob(user, parent, parentType, dataMap, copyToHome,
+                    checkpoint=None, resumedFrom=None):
+    """Create and schedule a job registering ``dataMap`` under ``parent``."""
+    otherFields = {CHECKPOINT_FIELD: checkpoint or {}}
+    if resumedFrom is not None:
+        otherFields['wtResumedFrom'] = resumedFrom['_id']
+    jobModel = Job()
+    job = jobModel.createLocalJob(
+        module='girder.plugins.wholetale.tasks.import_data',
+        function='run', title='Registering resources', type=JOB_TYPE,
+        user=user, public=False, asynchronous=True,
+        kwargs={
+            'parentId': str(parent['_id']),
+            'parentType': parentType,
+            'dataMap': dataMap,
+            'copyToHome': copyToHome
+        },
+        otherFields=otherFields)
+    jobModel.scheduleJob(job)
+    return job
+
+
+def resumeImportJob(job, user):
+    """
+    Schedule a new job carrying over the checkpoint of a failed or interrupted
+    import job.
+    """
+    kwargs = job['kwargs']
+    parent = ModelImporter.model(kwargs['parentType']).load(
+        kwargs['parentId'], force=True)
+    return createImportJob(
+        user, parent, kwargs['parentType'], kwargs['dataMap'],
+        kwargs['copyToHome'], checkpoint=job.get(CHECKPOINT_FIELD),
+        resumedFrom=job)
+
+
+def run(job):
+    jobModel = Job()
+    job = jobModel.updateJob(job, status=JobStatus.RUNNING,
+                             log='Started registration\n')
+    try:
+        kwargs = job['kwargs']
+        user = ModelImporter.model('user').load(job['userId'], force=True)
+        parent = ModelImporter.model(kwargs['parentType']).load(
+            kwargs['parentId'], force=True)
+        progress = JobProgress(job)
+        with trace('dataset/register job {}'.format(job['_id'])):
+            checkpoint = ImportCheckpoint(job)
+            importedData = import_data(
+                parent, kwargs['parentType'], progress, user,
+                kwargs['dataMap'], checkpoint=checkpoint)
+        if kwargs['copyToHome']:
+            progress.update(message='Copying to workspace')
+            copy_to_home(user, importedData, progress, checkpoint=checkpoint)
+        if importedData['failed']:
+            # Resuming the job registers (and copies) the failed entries,
+            # everything in the checkpoint is skipped
+            log = ''.join('Could not register {dataId}: {error}\n'.format(
+                **failure) for failure in importedData['failed'])
+            jobModel.updateJob(progress.job, status=JobStatus.ERROR, log=log)
+        else:
+            jobModel.updateJob(progress.job, status=JobStatus.SUCCESS,
+                               log='Finished registration\n')
+    except Exception:
+        t, val, tb = sys.exc_info()
+        log = '%s: %s\n%s' % (t.__name__, repr(val), ''.join(
+            traceback.format_tb(tb)))
+        jobModel.updateJob(job, status=JobStatus.ERROR, log=log)
+        raise
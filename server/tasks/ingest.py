@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Bulk registration into the catalog of every DataONE package matching a Solr
+query, as a local job of the jobs plugin.
+
+Matching documents are read page by page, sorted on their identifier, and the
+packages they belong to are registered a batch at a time by a few threads.
+The identifier of the last document processed is saved on the job document
+(under ``wtIngest``) after every batch, so that an interrupted job can be
+resumed after the last batch with a range query, which neither skips nor
+repeats documents when the index changes in the meantime.
+
+The packages seen by a job are not saved: a resumed job may come across a
+package registered before the interruption again, but packages already in
+the catalog are not registered again.
+"""
+
+import datetime
+import sys
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from girder.plugins.jobs.constants import JobStatus
+from girder.plugins.jobs.models.job import Job
+from girder.utility.model_importer import ModelImporter
+from girder.utility.progress import noProgress
+
+from ..constants import CATALOG_NAME
+from ..dataone_register import esc, iter_query
+from ..metrics import bind, trace
+from ..rest.harvester import import_data
+from ..utils import getOrCreateRootFolder
+from .import_data import JobProgress
+
+
+JOB_TYPE = 'wholetale.catalog_ingest'
+CURSOR_FIELD = 'wtIngest'
+# Number of Solr documents processed between two saves of the cursor
+INGEST_BATCH = 100
+# Maximum number of packages registered concurrently
+INGEST_WORKERS = 4
+# Fields telling which package a Solr document belongs to
+INGEST_FIELDS = ['identifier', 'formatType', 'resourceMap']
+
+
+def _package_pids(doc):
+    """The PIDs of the packages a Solr document is part of."""
+    if doc.get('formatType') == 'RESOURCE':
+        return [doc['identifier']]
+    return doc.get('resourceMap', [])
+
+
+def _after(identifier):
+    """A Solr clause matching the documents sorted after an identifier."""
+    return 'id:{{"{}" TO *]'.format(
+        identifier.replace('\\', '\\\\').replace('"', '\\"'))
+
+
+def _register(catalog, user, pid):
+    """Register a package into the catalog, returns the error if it fails."""
+    try:
+        import_data(catalog, 'folder', noProgress, user, [{
+            'dataId': pid, 'doi': pid, 'name': None, 'repository': 'DataONE',
+            'size': 0}], package_workers=1)
+    except Exception as exc:
+        return exc
+
+
+def createIngestJob(user, query, limit=None, cursor=None, resumedFrom=None):
+    """Create and schedule a job registering the packages matching a query."""
+    otherFields = {CURSOR_FIELD: cursor or {
+        'lastId': None, 'registered': 0, 'failed': 0}}
+    if resumedFrom is not None:
+        otherFields['wtResumedFrom'] = resumedFrom['_id']
+    jobModel = Job()
+    job = jobModel.createLocalJob(
+        module='girder.plugins.wholetale.tasks.ingest',
+        function='run', title='Seeding the catalog', type=JOB_TYPE,
+        user=user, public=False, asynchronous=True,
+        kwargs={'query': query, 'limit': limit},
+        otherFields=otherFields)
+    jobModel.scheduleJob(job)
+    return job
+
+
+def resumeIngestJob(job, user):
+    """
+    Schedule a new job picking up a failed or interrupted ingest job from its
+    last saved batch.
+    """
+    return createIngestJob(
+        user, job['kwargs']['query'], limit=job['kwargs']['limit'],
+        cursor=job.get(CURSOR_FIELD), resumedFrom=job)
+
+
+class _Ingest(object):
+    """Register packages a batch at a time, and save the cursor after each."""
+
+    def __init__(self, job, user, executor):
+        self.job = job
+        self.user = user
+        self.executor = executor
+        self.catalog = getOrCreateRootFolder(CATALOG_NAME)
+        self.cursor = dict(job[CURSOR_FIELD])
+        self.progress = JobProgress(job)
+        self.progress.current = self.cursor['registered'] + \
+            self.cursor['failed']
+        self.seen = set()
+        self.batch = []
+
+    @property
+    def count(self):
+        return self.cursor['registered'] + self.cursor['failed']
+
+    def add(self, doc):
+        for pid in _package_pids(doc):
+            if pid not in self.seen:
+                self.seen.add(pid)
+                self.batch.append(pid)
+
+    def flush(self, lastId):
+        """Register the current batch, then save ``lastId`` as the cursor."""
+        failures = [
+            (pid, exc) for pid, exc in zip(self.batch, self.executor.map(
+                bind(lambda pid: _register(self.catalog, self.user, pid)),
+                self.batch))
+            if exc is not None]
+        registered = len(self.batch) - len(failures)
+        Job().collection.update_one({'_id': self.job['_id']}, {
+            '$set': {CURSOR_FIELD + '.lastId': lastId,
+                     'updated': datetime.datetime.utcnow()},
+            '$inc': {CURSOR_FIELD + '.registered': registered,
+                     CURSOR_FIELD + '.failed': len(failures)}})
+        self.cursor.update(lastId=lastId,
+                           registered=self.cursor['registered'] + registered,
+                           failed=self.cursor['failed'] + len(failures))
+        log = ''.join('Could not register {}: {}\n'.format(pid, exc)
+                      for pid, exc in failures)
+        self.progress.update(
+            increment=len(self.batch), message='{}Registered {} packages, {} '
+            'failed.'.format(log, self.cursor['registered'],
+                             self.cursor['failed']))
+        self.batch = []
+
+
+def run(job):
+    jobModel = Job()
+    job = jobModel.updateJob(job, status=JobStatus.RUNNING,
+                             log='Started seeding the catalog\n')
+    try:
+        query = job['kwargs']['query']
+        limit = job['kwargs']['limit']
+        user = ModelImporter.model('user').load(job['userId'], force=True)
+        with trace('dataset/ingest job {}'.format(job['_id'])), \
+                ThreadPoolExecutor(max_workers=INGEST_WORKERS) as executor:
+            ingest = _Ingest(job, user, executor)
+            lastId = ingest.cursor['lastId']
+            q = '({}) AND -obsoletedBy:*'.format(query)
+            if lastId is not None:
+                q += ' AND ' + _after(lastId)
+            processed = 0
+            # Pages are read whole rather than streamed: flushing a batch can
+            # take longer than Solr keeps a response open
+            for doc in iter_query(esc(q), INGEST_FIELDS):
+                if limit and ingest.count + len(ingest.batch) >= limit:
+                    break
+                ingest.add(doc)
+                # Pages are sorted on id, the identifier in the DataONE index
+                lastId = doc['identifier']
+                processed += 1
+                if processed % INGEST_BATCH == 0:
+                    ingest.flush(lastId)
+            ingest.flush(lastId)
+        jobModel.updateJob(ingest.progress.job, status=JobStatus.SUCCESS,
+                           log='Finished seeding the catalog\n')
+    except Exception:
+        t, val, tb = sys.exc_info()
+        log = '%s: %s\n%s' % (t.__name__, repr(val), ''.join(
+            traceback.format_tb(tb)))
+        jobModel.updateJob(job, status=JobStatus.ERROR, log=log)
+        raise
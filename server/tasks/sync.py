@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Incremental sync of the DataONE packages registered in the catalog, as a
+local job of the jobs plugin.
+
+Every Girder process checks periodically whether a sync is due (see
+:func:`scheduleSync`), and the first one to claim it schedules the job. The
+job probes the upstream state of the catalog packages a batch at a time, least
+recently synced first, and registers again only the packages whose state
+changed. It stops once its time or request budget is spent, and the next run
+picks up the packages that were not checked.
+
+Only the top-level state of a package is compared, i.e. its resource map and
+what it aggregates directly. Folders registered without a ``dataoneState``
+are left out.
+
+When a package is obsoleted, its new version is registered into the catalog
+(unless it already is) and the folder of the old one points to it with the
+``dataoneObsoletedBy`` metadata; it is not checked again. When nothing is
+left of a package upstream, its folder is kept but flagged with
+``dataoneGone`` until the package reappears.
+"""
+
+import datetime
+import sys
+import time
+import traceback
+
+from girder import logger
+from girder.plugins.jobs.constants import JobStatus
+from girder.plugins.jobs.models.job import Job
+from girder.utility.model_importer import ModelImporter
+from girder.utility.progress import noProgress
+
+from ..constants import CATALOG_NAME, PluginSettings
+from ..metrics import trace
+from ..rest.harvester import probe_packages, register_DataONE_resource
+from ..utils import findCatalogEntry, getOrCreateRootFolder, setCatalogEntry
+from .import_data import JobProgress
+
+
+JOB_TYPE = 'wholetale.catalog_sync'
+SYNC_FIELD = 'wtSyncedAt'
+SCHEDULE_FIELD = 'wtSyncScheduled'
+# Number of packages probed with a single query
+SYNC_BATCH = 50
+# Default time (in seconds) between two syncs, 0 means never
+DEFAULT_SYNC_INTERVAL = 0
+# Default time (in seconds) and number of upstream requests a sync may use
+DEFAULT_SYNC_TIME_BUDGET = 600.0
+DEFAULT_SYNC_REQUEST_BUDGET = 1000
+# How often (in seconds) each process checks whether a sync is due
+SYNC_CHECK_FREQUENCY = 60
+
+
+def createSyncJob(user):
+    """Create and schedule a job syncing the catalog."""
+    jobModel = Job()
+    job = jobModel.createLocalJob(
+        module='girder.plugins.wholetale.tasks.sync',
+        function='run', title='Syncing the catalog', type=JOB_TYPE,
+        user=user, public=False, asynchronous=True, kwargs={})
+    jobModel.scheduleJob(job)
+    return job
+
+
+def claimSync(catalog, interval):
+    """
+    Record that a sync is being scheduled, unless one was scheduled less than
+    ``interval`` seconds ago. The check and the update are a single atomic
+    operation, so only one process gets the claim.
+    """
+    now = datetime.datetime.utcnow()
+    due = now - datetime.timedelta(seconds=interval)
+    return ModelImporter.model('folder').collection.find_one_and_update(
+        {'_id': catalog['_id'], '$or': [
+            {SCHEDULE_FIELD: {'$exists': False}},
+            {SCHEDULE_FIELD: {'$lte': due}}]},
+        {'$set': {SCHEDULE_FIELD: now}}) is not None
+
+
+def scheduleSync():
+    """
+    Schedule a sync job if one is due. Called every SYNC_CHECK_FREQUENCY
+    seconds by each Girder process.
+
+    :returns: The job, or None if no sync was due.
+    """
+    try:
+        interval = int(ModelImporter.model('setting').get(
+            PluginSettings.CATALOG_SYNC_INTERVAL,
+            default=DEFAULT_SYNC_INTERVAL))
+        if interval <= 0:
+            return None
+        if not claimSync(getOrCreateRootFolder(CATALOG_NAME), interval):
+            return None
+        admin = ModelImporter.model('user').findOne({'admin': True})
+        return createSyncJob(admin)
+    except Exception:
+        # Keep the periodic check alive
+        logger.exception('Could not schedule a catalog sync.')
+
+
+def _candidates(catalog, limit):
+    """The catalog packages to check, least recently synced first."""
+    return list(ModelImporter.model('folder').find(
+        {'parentId': catalog['_id'], 'parentCollection': 'folder',
+         'meta.provider': 'DataONE',
+         'meta.dataoneState.digest': {'$exists': True},
+         'meta.dataoneObsoletedBy': {'$exists': False}},
+        sort=[(SYNC_FIELD, 1), ('_id', 1)], limit=limit,
+        fields=['name', 'meta.dataoneState', 'meta.dataoneGone']))
+
+
+class _Budget(object):
+    """The time and number of upstream requests left to a sync."""
+
+    def __init__(self, current, seconds, requestCount):
+        self.current = current
+        self.deadline = time.time() + seconds
+        self.requestCount = requestCount
+
+    @property
+    def spent(self):
+        return time.time() >= self.deadline or \
+            len(self.current.calls) >= self.requestCount
+
+
+def _register_successor(catalog, user, folder, state):
+    """
+    Register the new version of an obsoleted package into the catalog, unless
+    it already is, and point the folder of the old version to it.
+
+    :returns: Whether the new version was registered.
+    """
+    successor = state['obsoletedBy']
+    registered = findCatalogEntry('DataONE', successor) is None
+    if registered:
+        setCatalogEntry(register_DataONE_resource(
+            catalog, 'folder', noProgress, user, successor),
+            'DataONE', successor)
+    state = dict(state)
+    state.pop('children')
+    ModelImporter.model('folder').collection.update_one(
+        {'_id': folder['_id']},
+        {'$set': {'meta.dataoneObsoletedBy': successor,
+                  'meta.dataoneState': state}})
+    return registered
+
+
+def _sync_batch(catalog, user, batch, budget, progress):
+    """
+    Probe a batch of packages and register again the ones that changed, or
+    the new version of the ones that were obsoleted.
+
+    :returns: The number of packages checked and the number registered again.
+    """
+    folderModel = ModelImporter.model('folder')
+    states = probe_packages(
+        [folder['meta']['dataoneState']['resourceMap'] for folder in batch])
+    checked = []
+    changed = 0
+    for folder in batch:
+        pid = folder['meta']['dataoneState']['resourceMap']
+        state = states[pid]
+        if state is None:
+            if not folder['meta'].get('dataoneGone'):
+                folderModel.collection.update_one(
+                    {'_id': folder['_id']},
+                    {'$set': {'meta.dataoneGone': True}})
+            progress.update(message='{} is gone upstream.'.format(pid))
+            checked.append(folder['_id'])
+            continue
+        if folder['meta'].get('dataoneGone'):
+            folderModel.collection.update_one(
+                {'_id': folder['_id']}, {'$unset': {'meta.dataoneGone': ''}})
+
+        if state['obsoletedBy']:
+            if budget.spent:
+                break
+            try:
+                if _register_successor(catalog, user, folder, state):
+                    changed += 1
+            except Exception as exc:
+                progress.update(message='Could not register {}, the new '
+                                'version of {}: {}'.format(
+                                    state['obsoletedBy'], pid, exc))
+        elif state['digest'] != folder['meta']['dataoneState']['digest']:
+            if budget.spent:
+                # Checked first by the next run
+                break
+            try:
+                register_DataONE_resource(catalog, 'folder', noProgress, user,
+                                          pid, name=folder['name'])
+                changed += 1
+            except Exception as exc:
+                progress.update(message='Could not sync {}: {}'.format(
+                    pid, exc))
+        checked.append(folder['_id'])
+
+    folderModel.collection.update_many(
+        {'_id': {'$in': checked}},
+        {'$set': {SYNC_FIELD: datetime.datetime.utcnow()}})
+    return len(checked), changed
+
+
+def run(job):
+    jobModel = Job()
+    job = jobModel.updateJob(job, status=JobStatus.RUNNING,
+                             log='Started syncing the catalog\n')
+    try:
+        setting = ModelImporter.model('setting')
+        seconds = float(setting.get(PluginSettings.CATALOG_SYNC_TIME_BUDGET,
+                                    default=DEFAULT_SYNC_TIME_BUDGET))
+        requestCount = int(setting.get(
+            PluginSettings.CATALOG_SYNC_REQUEST_BUDGET,
+            default=DEFAULT_SYNC_REQUEST_BUDGET))
+        user = ModelImporter.model('user').load(job['userId'], force=True)
+        catalog = getOrCreateRootFolder(CATALOG_NAME)
+        progress = JobProgress(job)
+        checked = changed = 0
+        with trace('catalog sync job {}'.format(job['_id'])) as current:
+            budget = _Budget(current, seconds, requestCount)
+            # At most one batch per request of the budget
+            folders = _candidates(catalog, requestCount * SYNC_BATCH)
+            for i in range(0, len(folders), SYNC_BATCH):
+                if budget.spent:
+                    break
+                batchChecked, batchChanged = _sync_batch(
+                    catalog, user, folders[i:i + SYNC_BATCH], budget, progress)
+                checked += batchChecked
+                changed += batchChanged
+                progress.update(
+                    increment=batchChecked, total=len(folders),
+                    message='Checked {} packages, {} changed.'.format(
+                        checked, changed))
+            requestsUsed = len(current.calls)
+        jobModel.updateJob(
+            progress.job, status=JobStatus.SUCCESS,
+            log='Finished syncing the catalog: {} of {} packages checked, {} '
+                'changed, {} requests.\n'.format(
+                    checked, len(folders), changed, requestsUsed))
+    except Exception:
+        t, val, tb = sys.exc_info()
+        log = '%s: %s\n%s' % (t.__name__, repr(val), ''.join(
+            traceback.format_tb(tb)))
+        jobModel.updateJob(job, status=JobStatus.ERROR, log=log)
+        raise
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Per-host rate limiting, concurrency capping and retries of outbound calls.
+
+A single :class:`Governor` is owned by the shared HTTP session (see
+:mod:`.http_session`), so every code path of the process talking to the same
+host draws from the same token bucket and the same pool of concurrent slots.
+Only the hosts of the data repositories we harvest from (DataONE by default)
+are rate limited, other hosts are only capped and retried. When a host
+answers with 429 or 503 the call is retried with exponential backoff and
+jitter, or after the delay given by ``Retry-After``, and the rate for that
+host is halved, then recovers gradually as calls succeed again.
+
+A slot is held until the response headers are received: the body of a
+streamed response is read outside of the concurrency cap.
+"""
+
+import collections
+import contextlib
+import email.utils
+import random
+import threading
+import time
+
+
+# Statuses telling that the upstream is overloaded and the call may be retried
+RETRY_STATUSES = (429, 503)
+# Default number of calls per second and per host, 0 means unlimited
+DEFAULT_RATE_LIMIT = 10.0
+# Default hosts the rate limit applies to, along with their subdomains
+DEFAULT_THROTTLED_HOSTS = ('dataone.org',)
+# Maximum number of hosts whose state is kept, idle hosts used least recently
+# are forgotten beyond that
+MAX_HOSTS = 1024
+# Default number of concurrent calls per host
+DEFAULT_CONCURRENCY = 8
+# Default number of retries of a throttled call
+DEFAULT_MAX_RETRIES = 5
+# Base and upper bound (in seconds) of the exponential backoff
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+# Upper bound (in seconds) of the delays requested with Retry-After
+RETRY_AFTER_MAX = 60.0
+# Lowest rate a throttled host is slowed down to
+MIN_RATE = 0.5
+
+
+def retry_after(response):
+    """Parse the Retry-After header of a response into seconds, or None."""
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        delay = float(value)
+    except ValueError:
+        parsed = email.utils.parsedate_tz(value)
+        if parsed is None:
+            return None
+        delay = email.utils.mktime_tz(parsed) - time.time()
+    return min(max(delay, 0.0), RETRY_AFTER_MAX)
+
+
+def backoff(attempt):
+    """Exponential backoff with full jitter for the given (0-based) retry."""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+class TokenBucket(object):
+    """
+    Allow ``rate`` calls per second on average, with bursts of up to
+    ``capacity`` calls. Tokens are reserved in order, so waiting callers are
+    served first come, first served without polling.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token, returns how many seconds to wait before using it."""
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.capacity, self._tokens +
+                               (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class HostGovernor(object):
+    """The rate, concurrency and backoff state of a single host."""
+
+    def __init__(self, rate, concurrency):
+        self.max_rate = rate
+        self.bucket = TokenBucket(rate)
+        self.concurrency = concurrency
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.calls = 0
+        self.throttled = 0
+
+    @contextlib.contextmanager
+    def slot(self):
+        """
+        Wait for a free slot, for the end of any backoff and for a token. The
+        slot is released when leaving the block, i.e. before the body of a
+        streamed response is read.
+        """
+        with self._slots:
+            pause = self._paused_until - time.time()
+            if pause > 0:
+                time.sleep(pause)
+            self.bucket.acquire()
+            with self._lock:
+                self.in_flight += 1
+                self.calls += 1
+            try:
+                yield
+            finally:
+                with self._lock:
+                    self.in_flight -= 1
+
+    def on_throttled(self, delay):
+        """Pause every call to the host for ``delay`` seconds, and halve its
+        rate."""
+        with self._lock:
+            self.throttled += 1
+            self._paused_until = max(self._paused_until, time.time() + delay)
+            if self.max_rate > 0:
+                self.bucket.rate = max(MIN_RATE, self.bucket.rate / 2)
+
+    def on_success(self):
+        """Recover 5% of the configured rate."""
+        if self.max_rate > 0 and self.bucket.rate < self.max_rate:
+            with self._lock:
+                self.bucket.rate = min(self.max_rate,
+                                       self.bucket.rate + self.max_rate / 20)
+
+    def idle(self):
+        return not self.in_flight and self._paused_until <= time.time()
+
+    def stats(self):
+        return {'rate': self.bucket.rate, 'maxRate': self.max_rate,
+                'concurrency': self.concurrency, 'inFlight': self.in_flight,
+                'calls': self.calls, 'throttled': self.throttled}
+
+
+class Governor(object):
+    """
+    Rate limits, concurrency caps and retry policy, per host. ``rate`` only
+    applies to ``throttled_hosts`` and their subdomains.
+    """
+
+    def __init__(self, rate=DEFAULT_RATE_LIMIT, concurrency=DEFAULT_CONCURRENCY,
+                 max_retries=DEFAULT_MAX_RETRIES,
+                 throttled_hosts=DEFAULT_THROTTLED_HOSTS):
+        self.rate = rate
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.throttled_hosts = tuple(name.lower() for name in throttled_hosts)
+        self._hosts = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def throttles(self, host):
+        """Whether the rate limit applies to a host (a ``host[:port]``)."""
+        name = host.split(':')[0]
+        return any(name == throttled or name.endswith('.' + throttled)
+                   for throttled in self.throttled_hosts)
+
+    def _forget_idle(self):
+        for host in [host for host, governor in self._hosts.items()
+                     if governor.idle()][:len(self._hosts) - MAX_HOSTS]:
+            del self._hosts[host]
+
+    def host(self, host):
+        with self._lock:
+            governor = self._hosts.pop(host, None)
+            if governor is None:
+                governor = HostGovernor(
+                    self.rate if self.throttles(host) else 0,
+                    self.concurrency)
+            # Most recently used last
+            self._hosts[host] = governor
+            if len(self._hosts) > MAX_HOSTS:
+                self._forget_idle()
+            return governor
+
+    def call(self, host, send):
+        """
+        Call ``send()`` within the limits of ``host`` and retry it while the
+        host reports being overloaded, at most ``max_retries`` times.
+
+        :returns: The last response.
+        """
+        governor = self.host(host)
+        attempt = 0
+        while True:
+            with governor.slot():
+                response = send()
+            if response.status_code not in RETRY_STATUSES:
+                governor.on_success()
+                return response
+            if attempt >= self.max_retries:
+                return response
+            delay = retry_after(response)
+            governor.on_throttled(backoff(attempt) if delay is None else delay)
+            response.close()
+            attempt += 1
+
+    def stats(self):
+        with self._lock:
+            return {host: governor.stats()
+                    for host, governor in sorted(self._hosts.items())}
@@ -1,9 +1,269 @@
+import datetime
+import re
+from collections import OrderedDict
+
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import DuplicateKeyError
+from girder.api.rest import RestException
 from girder.utility.model_importer import ModelImporter
 
 
+# Field of the catalog entries holding their provider and external identifier
+CATALOG_KEY = 'wtCatalog'
+# Model of the catalog entries registered for each provider
+CATALOG_MODELS = {'DataONE': 'folder', 'HTTP': 'item',
+                  'HTTPDirectory': 'folder'}
+
+
 def getOrCreateRootFolder(name):
     collection = ModelImporter.model('collection').createCollection(
         name, public=False, reuseExisting=True)
     folder = ModelImporter.model('folder').createFolder(
         collection, name, parentType='collection', public=True, reuseExisting=True)
     return folder
+
+
+def ensureCatalogIndices():
+    """Allow a single catalog entry per provider and external identifier."""
+    for modelType in set(CATALOG_MODELS.values()):
+        ModelImporter.model(modelType).ensureIndex((
+            [(CATALOG_KEY + '.provider', 1), (CATALOG_KEY + '.identifier', 1)],
+            {'unique': True,
+             'partialFilterExpression': {CATALOG_KEY: {'$exists': True}}}))
+
+
+def findCatalogEntry(provider, identifier):
+    """
+    Return the folder or item registered in the catalog for an external
+    identifier, or None.
+    """
+    return ModelImporter.model(CATALOG_MODELS[provider]).findOne({
+        CATALOG_KEY + '.provider': provider,
+        CATALOG_KEY + '.identifier': identifier
+    })
+
+
+def setCatalogEntry(doc, provider, identifier):
+    """
+    Record ``doc`` as the catalog entry of an external identifier. If another
+    entry was recorded in the meantime, it wins and is returned instead, and
+    ``doc`` is removed, since it duplicates that entry.
+
+    :raises: RestException if ``doc`` is the entry of another identifier.
+    """
+    key = {'provider': provider, 'identifier': identifier}
+    model = ModelImporter.model(CATALOG_MODELS[provider])
+    try:
+        result = model.collection.update_one(
+            {'_id': doc['_id'], '$or': [{CATALOG_KEY: {'$exists': False}},
+                                        {CATALOG_KEY: key}]},
+            {'$set': {CATALOG_KEY: key}})
+    except DuplicateKeyError:
+        entry = findCatalogEntry(provider, identifier)
+        if entry['_id'] != doc['_id']:
+            model.remove(doc)
+        return entry
+    if not result.matched_count:
+        raise RestException(
+            '{} is already registered in the catalog for {}.'.format(
+                doc['name'], doc[CATALOG_KEY]['identifier']))
+    doc[CATALOG_KEY] = key
+    return doc
+
+
+def _registeredFor(doc, provider, identifier, metaKey):
+    """
+    Whether a folder was registered for an external identifier, or for none
+    at all. ``metaKey`` is the (dotted) metadata field holding the identifier.
+    """
+    entry = doc.get(CATALOG_KEY)
+    if entry is not None and entry != {'provider': provider,
+                                       'identifier': identifier}:
+        return False
+    value = doc.get('meta')
+    for field in metaKey.split('.'):
+        value = value.get(field) if isinstance(value, dict) else None
+    return value in (None, identifier)
+
+
+def createRegisteredFolder(parent, parentType, name, user, provider,
+                           identifier, metaKey, **kwargs):
+    """
+    Create the folder registering an external identifier under ``parent``, or
+    reuse the folder with the same name if it was registered for the same
+    identifier or for none at all. A folder registered for another identifier,
+    e.g. another version of a package with the same title, is left alone and
+    the new folder is called ``name (n)`` instead.
+    """
+    folderModel = ModelImporter.model('folder')
+    candidate = name
+    n = 0
+    while True:
+        existing = folderModel.findOne({
+            'parentId': parent['_id'], 'parentCollection': parentType,
+            'name': candidate})
+        if existing is None or _registeredFor(existing, provider, identifier,
+                                              metaKey):
+            return folderModel.createFolder(
+                parent, candidate, parentType=parentType, creator=user,
+                reuseExisting=True, **kwargs)
+        n += 1
+        candidate = '{} ({})'.format(name, n)
+
+
+def _linkFiles(itemIds, urls):
+    """Map ``(itemId, linkUrl)`` to the link files of some items."""
+    return {
+        (doc['itemId'], doc['linkUrl']): doc
+        for doc in ModelImporter.model('file').find(
+            {'itemId': {'$in': list(itemIds)}, 'linkUrl': {'$in': list(urls)}},
+            fields=['itemId', 'linkUrl', 'size'])
+    }
+
+
+def _renamedItem(folder, name, url, claimed):
+    """
+    Pick the name of the item linking to ``url`` when an item called ``name``
+    in ``folder`` links elsewhere. Like Girder does for duplicate names, the
+    item is called ``name (n)``, and an item already created that way for the
+    same URL is reused.
+    """
+    renamed = {
+        item['_id']: item['name'] for item in ModelImporter.model('item').find(
+            {'folderId': folder['_id'],
+             'name': {'$regex': '^{} \\(\\d+\\)$'.format(re.escape(name))}},
+            fields=['name'])
+    }
+    linked = _linkFiles(renamed, [url])
+    if linked:
+        itemId, _ = next(iter(linked))
+        return renamed[itemId]
+    taken = set(renamed.values()) | set(claimed)
+    n = 1
+    while '{} ({})'.format(name, n) in taken:
+        n += 1
+    return '{} ({})'.format(name, n)
+
+
+def bulkCreateLinkFiles(folder, user, files):
+    """
+    Create an item with a single link file for each entry of ``files`` using
+    a few batched writes, instead of several round trips per file.
+
+    An item with the same name in the folder is reused if it already links to
+    the same URL, and the item metadata is merged in. If it links elsewhere
+    (or is not a link), a new item called ``name (n)`` is created instead, as
+    Girder does for duplicate names. Size changes are propagated to the items,
+    the folder and its base parent. Note that, unlike the model methods, no
+    ``model.item.save``/``model.file.save`` events are triggered.
+
+    :param folder: The folder the items are created in.
+    :type folder: dict
+    :param user: The creator of the items and files.
+    :type user: dict
+    :param files: A list of dicts with ``name``, ``url``, ``size``,
+        ``mimeType`` and ``meta`` (item metadata) keys.
+    :type files: list
+    :returns: The list of items, in the order of ``files``.
+    """
+    itemModel = ModelImporter.model('item')
+    fileModel = ModelImporter.model('file')
+    now = datetime.datetime.utcnow()
+
+    # Later entries win, as they would when registering one by one
+    byKey = OrderedDict()
+    for fileObj in files:
+        byKey[(fileObj['name'].strip(), fileObj['url'])] = fileObj
+    if not byKey:
+        return []
+
+    names = set(name for name, url in byKey)
+    existing = {
+        item['name']: item for item in itemModel.find(
+            {'folderId': folder['_id'], 'name': {'$in': list(names)}},
+            fields=['name'])
+    }
+    links = _linkFiles([item['_id'] for item in existing.values()],
+                       set(url for name, url in byKey))
+    # Name of the item of each entry, and URL each name is used for
+    itemNames = {}
+    claimed = {}
+    for name, url in byKey:
+        item = existing.get(name)
+        if (item is None or (item['_id'], url) in links) and \
+                claimed.get(name, url) == url:
+            itemName = name
+        else:
+            itemName = _renamedItem(folder, name, url, claimed)
+        itemNames[(name, url)] = itemName
+        claimed[itemName] = url
+
+    itemModel.collection.bulk_write([
+        UpdateOne(
+            {'folderId': folder['_id'], 'name': itemNames[key]},
+            {'$setOnInsert': {
+                'lowerName': itemNames[key].lower(),
+                'description': '',
+                'creatorId': user['_id'],
+                'baseParentType': folder['baseParentType'],
+                'baseParentId': folder['baseParentId'],
+                'created': now,
+                'size': 0
+            }, '$set': dict(
+                [('meta.' + metaKey, value)
+                 for metaKey, value in fileObj.get('meta', {}).items()],
+                updated=now)},
+            upsert=True)
+        for key, fileObj in byKey.items()
+    ], ordered=False)
+    items = {
+        item['name']: item for item in itemModel.find(
+            {'folderId': folder['_id'], 'name': {'$in': list(claimed)}})
+    }
+    links = _linkFiles([item['_id'] for item in items.values()], set(
+        url for name, url in byKey))
+
+    fileOps = []
+    sizeChange = {}
+    for (name, url), fileObj in byKey.items():
+        item = items[itemNames[(name, url)]]
+        size = int(fileObj['size'])
+        link = {
+            'creatorId': user['_id'],
+            'mimeType': fileObj.get('mimeType'),
+            'linkUrl': url,
+            'size': size
+        }
+        doc = links.get((item['_id'], url))
+        if doc is None:
+            link.update({
+                'created': now,
+                'itemId': item['_id'],
+                'assetstoreId': None,
+                'name': name,
+                'exts': [ext.lower() for ext in name.split('.')[1:]]
+            })
+            fileOps.append(InsertOne(link))
+            delta = size
+        else:
+            fileOps.append(UpdateOne({'_id': doc['_id']}, {'$set': link}))
+            delta = size - doc.get('size', 0)
+        if delta:
+            sizeChange[item['_id']] = delta
+    fileModel.collection.bulk_write(fileOps, ordered=False)
+
+    if sizeChange:
+        itemModel.collection.bulk_write([
+            UpdateOne({'_id': itemId}, {'$inc': {'size': delta}})
+            for itemId, delta in sizeChange.items()
+        ], ordered=False)
+        total = sum(sizeChange.values())
+        ModelImporter.model('folder').collection.update_one(
+            {'_id': folder['_id']}, {'$inc': {'size': total}})
+        ModelImporter.model(folder['baseParentType']).collection.update_one(
+            {'_id': folder['baseParentId']}, {'$inc': {'size': total}})
+        for item in items.values():
+            item['size'] += sizeChange.get(item['_id'], 0)
+
+    return [items[itemNames[(fileObj['name'].strip(), fileObj['url'])]]
+            for fileObj in files]